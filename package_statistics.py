@@ -2,20 +2,277 @@
 
 
 from packstats import PackageStatistics
-from packstats.utils import Config
+from packstats.aggregate import AGGREGATORS
+from packstats.utils import ALL_AVAILABLE_ARCHS, Config
 import argparse
+import os
+import sys
 
 # Load Config file to set default values
 config = Config.instance()
 
 
+def run_server(argv):
+    parser = argparse.ArgumentParser(
+        prog="package_statistics serve",
+        description="Keep the package statistics in memory and answer queries over a local HTTP/JSON API",
+    )
+    parser.add_argument(
+        "arch",
+        type=str,
+        nargs="+",
+        help=f"The architectures to serve, {ALL_AVAILABLE_ARCHS} for every architecture of the mirrors",
+    )
+    parser.add_argument(
+        "-m",
+        "--mirror",
+        type=str,
+        action="append",
+        help="The Debian mirror to use, can be given several times",
+    )
+    parser.add_argument(
+        "--host",
+        type=str,
+        default=config["DEFAULT_SERVE_HOST"],
+        help="The address to listen on",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=config["DEFAULT_SERVE_PORT"],
+        help="The port to listen on",
+    )
+    parser.add_argument(
+        "--socket",
+        type=str,
+        help="Listen on this Unix socket instead of a TCP port",
+    )
+    parser.add_argument(
+        "--interval",
+        type=int,
+        default=config["DEFAULT_SERVE_REFRESH_INTERVAL"],
+        help="The number of seconds between two background refreshes",
+    )
+    args = parser.parse_args(argv)
+    if args.interval < 1:
+        parser.error("The refresh interval should be greater than 0")
+    from packstats.server import StatsService, serve
+
+    service = StatsService(
+        mirror_urls=args.mirror or [config["DEFAULT_MIRROR_URL"]],
+        archs=args.arch,
+        refresh_interval=args.interval,
+    )
+    serve(service, host=args.host, port=args.port, socket_path=args.socket)
+
+
+def run_history(argv):
+    from packstats.history import parse_time
+
+    def timestamp(value):
+        try:
+            return parse_time(value)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
+
+    parser = argparse.ArgumentParser(
+        prog="package_statistics history",
+        description="Query the statistics recorded by the refreshes run with --history",
+    )
+    parser.add_argument(
+        "query",
+        choices=["snapshots", "growth", "movers", "package"],
+        help="The recorded snapshots, the packages that gained the most files, the packages whose number of files changed the most or the history of --package",
+    )
+    parser.add_argument(
+        "arch",
+        type=str,
+        help="The architecture to query",
+    )
+    parser.add_argument(
+        "-m",
+        "--mirror",
+        type=str,
+        default=config["DEFAULT_MIRROR_URL"],
+        help="The Debian mirror to query",
+    )
+    parser.add_argument(
+        "--since",
+        type=timestamp,
+        default="30d",
+        help="Start of the period compared by growth and movers: a date or a duration like 12h, 30d or 2w (default: 30d)",
+    )
+    parser.add_argument(
+        "--until",
+        type=timestamp,
+        help="End of the compared period, a date or a duration (default: the latest snapshot)",
+    )
+    parser.add_argument(
+        "-n",
+        "--top",
+        type=int,
+        default=config["DEFAULT_TOP_N"],
+        help="The number of packages to show",
+    )
+    parser.add_argument(
+        "-p",
+        "--package",
+        type=str,
+        help="The package (section/name) whose history to show",
+    )
+    args = parser.parse_args(argv)
+    if args.query == "package" and not args.package:
+        parser.error("the package query needs --package")
+    if args.top < 1:
+        parser.error("The number of packages to be shown should be greater than 0")
+    from packstats import history
+    from packstats.release import branch_path
+
+    history_path = config["DEFAULT_DATA_DIR_PATH"] + "history.sqlite"
+    if not os.path.exists(history_path):
+        print("No history recorded yet, refresh with --history first")
+        sys.exit(1)
+    # One series per suite and component of the mirror
+    mirror = branch_path(args.mirror).rstrip("/")
+    with history.HistoryStore(history_path) as store:
+        # Series recorded by older versions under the mirror host
+        legacy = history.legacy_series(args.mirror)
+        if legacy is not None:
+            store.adopt_series(legacy, mirror)
+        if args.query == "snapshots":
+            history.print_snapshots(store.snapshots(mirror, args.arch))
+        elif args.query == "package":
+            history.print_package_history(
+                store.package_history(mirror, args.arch, args.package)
+            )
+        else:
+            query = store.growth if args.query == "growth" else store.movers
+            history.print_changes(
+                query(mirror, args.arch, args.since, args.top, until=args.until)
+            )
+
+
+def run_benchmark(argv):
+    from packstats import benchmark
+
+    parser = argparse.ArgumentParser(
+        prog="package_statistics benchmark",
+        description="Measure every stage on a synthetic Contents file served by a local mirror",
+    )
+    parser.add_argument(
+        "--lines",
+        type=int,
+        default=1000000,
+        help="The number of lines of the synthetic Contents file",
+    )
+    parser.add_argument(
+        "--packages",
+        type=int,
+        default=60000,
+        help="The number of packages of the synthetic Contents file",
+    )
+    parser.add_argument(
+        "--skew",
+        type=float,
+        default=1.1,
+        help="The exponent of the Zipf distribution of the number of files per package",
+    )
+    parser.add_argument(
+        "--multi-package-ratio",
+        type=float,
+        default=0.01,
+        help="The fraction of the paths shipped by two packages",
+    )
+    parser.add_argument(
+        "--stages",
+        type=lambda value: [name for name in value.split(",") if name],
+        default=None,
+        help=f"Comma separated stages to run: {', '.join(benchmark.STAGES)}",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="The number of runs of every stage, the fastest is kept",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=config["DEFAULT_WORKERS"],
+        help="The number of processes used by the parse and refresh stages",
+    )
+    parser.add_argument(
+        "--queries",
+        type=int,
+        default=20,
+        help="The number of cached queries averaged by the cached_query stage",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        help="Save the results to this JSON file",
+    )
+    parser.add_argument(
+        "--compare",
+        type=str,
+        help="Compare the results with an earlier JSON results file and fail on regressions",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="The relative slowdown or memory growth over --compare counted as a regression",
+    )
+    args = parser.parse_args(argv)
+    if min(args.lines, args.packages, args.repeat, args.workers, args.queries) < 1:
+        parser.error(
+            "--lines, --packages, --repeat, --workers and --queries should be greater than 0"
+        )
+    try:
+        results = benchmark.run_benchmark(
+            lines=args.lines,
+            packages=args.packages,
+            skew=args.skew,
+            multi_package_ratio=args.multi_package_ratio,
+            repeat=args.repeat,
+            workers=args.workers,
+            queries=args.queries,
+            stages=args.stages,
+        )
+    except ValueError as e:
+        parser.error(str(e))
+    benchmark.print_results(results)
+    if args.output:
+        benchmark.save_results(results, args.output)
+    if args.compare:
+        regressions = benchmark.compare_results(
+            benchmark.load_results(args.compare), results, args.tolerance
+        )
+        for stage, metric, old, new in regressions:
+            print(f"Regression in {stage}: {metric} {old:.6g} -> {new:.6g}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regression compared to {args.compare}")
+
+
 def run_cli():
-    parser = argparse.ArgumentParser()
+    if sys.argv[1:2] == ["serve"]:
+        return run_server(sys.argv[2:])
+    if sys.argv[1:2] == ["history"]:
+        return run_history(sys.argv[2:])
+    if sys.argv[1:2] == ["benchmark"]:
+        return run_benchmark(sys.argv[2:])
+    parser = argparse.ArgumentParser(
+        epilog="Run 'package_statistics serve -h' to keep the statistics in memory behind a local HTTP API, 'package_statistics history -h' to query the recorded history, 'package_statistics benchmark -h' to measure the performance"
+    )
     parser.add_argument(
         "arch",
         type=str,
+        nargs="+",
         default=config["DEFAULT_ARCH"],
-        help="The architecture for which to retrieve the package statistics",
+        help=f"The architectures for which to retrieve the package statistics, {ALL_AVAILABLE_ARCHS} for every architecture of the mirror",
     )
     parser.add_argument(
         "-m",
@@ -24,6 +281,22 @@ def run_cli():
         default=config["DEFAULT_MIRROR_URL"],
         help="The Debian mirror to use",
     )
+    parser.add_argument(
+        "--suite",
+        dest="suites",
+        type=str,
+        action="append",
+        default=None,
+        help="A suite of the mirror to combine (default: the suite of the mirror URL), can be given several times",
+    )
+    parser.add_argument(
+        "--component",
+        dest="components",
+        type=str,
+        action="append",
+        default=None,
+        help="A component of the mirror to combine (default: the component of the mirror URL), can be given several times, all for every component of the suite",
+    )
     parser.add_argument(
         "-n",
         "--top",
@@ -37,11 +310,266 @@ def run_cli():
         action="store_true",
         help="Refresh the package statistics by downloading and parsing the Contents file again",
     )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=config["DEFAULT_WORKERS"],
+        help="The number of processes used to parse large Contents files",
+    )
+    parser.add_argument(
+        "-t",
+        "--download-threads",
+        type=int,
+        default=config["DEFAULT_DOWNLOAD_THREADS"],
+        help="The number of concurrent downloads when several architectures are given",
+    )
+    parser.add_argument(
+        "--no-stream",
+        dest="stream",
+        action="store_false",
+        default=config["DEFAULT_STREAM"],
+        help="Download the Contents file to disk before parsing it instead of parsing it while it downloads",
+    )
+    parser.add_argument(
+        "-s",
+        "--segments",
+        type=int,
+        default=config["DEFAULT_SEGMENTS"],
+        help="Download the Contents file as this many parallel byte ranges, resumed if interrupted and checked against the Release file",
+    )
+    parser.add_argument(
+        "--extra-mirror",
+        dest="extra_mirrors",
+        type=str,
+        action="append",
+        default=None,
+        help="An equivalent mirror the --segments downloads may also use, can be given several times",
+    )
+    parser.add_argument(
+        "-k",
+        "--keep-contents",
+        action="store_true",
+        default=config["DEFAULT_KEEP_CONTENTS"],
+        help="Keep the downloaded Contents file on disk when streaming",
+    )
+    parser.add_argument(
+        "--revalidate",
+        action="store_true",
+        default=config["DEFAULT_REVALIDATE"],
+        help="Check the cached statistics against the mirror and only download the Contents file again if it changed",
+    )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        default=config["DEFAULT_INCREMENTAL"],
+        help="Update outdated cached statistics (see --revalidate) from the Contents pdiffs instead of downloading the whole Contents file",
+    )
+    parser.add_argument(
+        "--index-paths",
+        action="store_true",
+        default=config["DEFAULT_PATH_INDEX"],
+        help="Build an index of the file paths when refreshing, used by the --search options",
+    )
+    parser.add_argument(
+        "--history",
+        action="store_true",
+        default=config["DEFAULT_HISTORY"],
+        help="Record the statistics of every refresh in the history database, see 'package_statistics history'",
+    )
+    parser.add_argument(
+        "--approx",
+        action="store_true",
+        help="Compute approximate top packages with a bounded amount of memory, without touching the cached statistics",
+    )
+    parser.add_argument(
+        "--sketch-size",
+        type=int,
+        default=config["DEFAULT_SKETCH_SIZE"],
+        help="The number of counters kept by --approx, counts are off by at most the total number of files divided by this",
+    )
+    parser.add_argument(
+        "--breakdowns",
+        type=lambda value: [name for name in value.split(",") if name],
+        default=None,
+        help=f"Comma separated breakdowns to compute while parsing and cache: {', '.join(AGGREGATORS)}",
+    )
+    parser.add_argument(
+        "--metrics",
+        choices=["json", "prometheus"],
+        help="Measure every stage (time, bytes, lines, peak memory) and print the metrics to stderr in this format",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        type=str,
+        help="Write the --metrics output to this file instead, e.g. for the node_exporter textfile collector",
+    )
+    parser.add_argument(
+        "-o",
+        "--offline",
+        action="store_true",
+        help="Only answer from the cached statistics, never access the network",
+    )
+    parser.add_argument(
+        "-p",
+        "--package",
+        type=str,
+        help="Show the number of files of a single package (section/name) instead of the top packages",
+    )
+    parser.add_argument(
+        "-b",
+        "--breakdown",
+        type=str,
+        choices=list(AGGREGATORS),
+        help="Show the largest entries of a breakdown instead of the top packages",
+    )
+    parser.add_argument(
+        "--search-path",
+        type=str,
+        help="Show the packages shipping the given file",
+    )
+    parser.add_argument(
+        "--search-prefix",
+        type=str,
+        help="Show every file starting with the given path and the packages shipping it",
+    )
+    parser.add_argument(
+        "--search-name",
+        type=str,
+        help="Show every file with the given file name and the packages shipping it",
+    )
+    parser.add_argument(
+        "--compare",
+        choices=["total", "divergence"],
+        help="Compare several architectures: top packages by total number of files or packages whose number of files differs the most",
+    )
+    parser.add_argument(
+        "--only-on",
+        type=str,
+        help="Compare several architectures: packages only found on the given one",
+    )
     args = parser.parse_args()
+    if args.metrics_file and not args.metrics:
+        parser.error("--metrics-file needs --metrics")
+    if args.metrics:
+        from packstats.metrics import metrics
+
+        metrics.enable()
+        try:
+            run_query(parser, args)
+        finally:
+            metrics.export(args.metrics, args.metrics_file)
+    else:
+        run_query(parser, args)
+
+
+def run_query(parser, args):
+    searches = (args.search_path, args.search_prefix, args.search_name)
+    if args.suites or args.components:
+        if (
+            args.approx
+            or args.breakdown
+            or args.compare
+            or args.only_on
+            or args.extra_mirrors
+            or any(searches)
+        ):
+            parser.error(
+                "--approx, --breakdown, --compare, --only-on, --extra-mirror and --search-* can't be combined with --suite and --component"
+            )
+        if ALL_AVAILABLE_ARCHS in args.arch:
+            parser.error(
+                f"{ALL_AVAILABLE_ARCHS} can't be combined with --suite and --component"
+            )
+        from packstats.combined import CombinedStatistics
+
+        combined_stats = CombinedStatistics(
+            archs=args.arch,
+            mirror_url=args.mirror,
+            top_n=args.top,
+            refresh=args.refresh,
+            suites=args.suites,
+            components=args.components,
+            workers=args.workers,
+            download_threads=args.download_threads,
+            stream=args.stream,
+            keep_contents=args.keep_contents,
+            revalidate=args.revalidate,
+            incremental=args.incremental,
+            segments=args.segments,
+            history=args.history,
+            offline=args.offline,
+        )
+        if args.package:
+            combined_stats.print_package_count(args.package)
+        else:
+            combined_stats.print_top_packages()
+        return
+    if len(args.arch) > 1 or ALL_AVAILABLE_ARCHS in args.arch:
+        if args.package or args.breakdown or args.offline or any(searches):
+            parser.error(
+                "--package, --breakdown, --search-* and --offline can only be used with a single architecture"
+            )
+        from packstats import BatchStatistics
+
+        batch_stats = BatchStatistics(
+            archs=args.arch,
+            mirror_url=args.mirror,
+            top_n=args.top,
+            refresh=args.refresh,
+            workers=args.workers,
+            download_threads=args.download_threads,
+            keep_contents=args.keep_contents,
+            revalidate=args.revalidate,
+            incremental=args.incremental,
+            path_index=args.index_paths,
+            breakdowns=args.breakdowns,
+            segments=args.segments,
+            extra_mirrors=args.extra_mirrors,
+            history=args.history,
+        )
+        if args.approx:
+            batch_stats.print_approx_top_packages(args.sketch_size)
+        elif args.compare or args.only_on:
+            batch_stats.print_comparison(args.compare, args.only_on)
+        else:
+            batch_stats.print_top_packages()
+        return
+    if args.compare or args.only_on:
+        parser.error("--compare and --only-on need several architectures")
     package_stats = PackageStatistics(
-        arch=args.arch, mirror_url=args.mirror, top_n=args.top, refresh=args.refresh
+        arch=args.arch[0],
+        mirror_url=args.mirror,
+        top_n=args.top,
+        refresh=args.refresh,
+        workers=args.workers,
+        stream=args.stream,
+        keep_contents=args.keep_contents,
+        revalidate=args.revalidate,
+        incremental=args.incremental,
+        path_index=args.index_paths,
+        breakdowns=args.breakdowns,
+        segments=args.segments,
+        extra_mirrors=args.extra_mirrors,
+        history=args.history,
+        offline=args.offline,
     )
-    package_stats.print_top_packages()
+    if args.approx:
+        package_stats.print_approx_top_packages(args.sketch_size)
+    elif args.search_path:
+        packages = package_stats.find_path(args.search_path)
+        package_stats.print_paths([(args.search_path, packages)] if packages else [])
+    elif args.search_prefix:
+        package_stats.print_paths(package_stats.find_prefix(args.search_prefix))
+    elif args.search_name:
+        package_stats.print_paths(package_stats.find_basename(args.search_name))
+    elif args.breakdown:
+        package_stats.print_breakdown(args.breakdown)
+    elif args.package:
+        package_stats.print_package_count(args.package)
+    else:
+        package_stats.print_top_packages()
 
 
 if __name__ == "__main__":
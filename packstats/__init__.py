@@ -1 +1,15 @@
 from .stats import PackageStatistics
+
+
+def __getattr__(name):
+    # The batch module pulls in the thread, process and connection pools, only import it when used
+    if name == "BatchStatistics":
+        from .batch import BatchStatistics
+
+        return BatchStatistics
+    # Same for the asyncio API
+    if name == "AsyncPackageStatistics":
+        from .asyncstats import AsyncPackageStatistics
+
+        return AsyncPackageStatistics
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,156 @@
+import abc
+from collections import Counter
+from typing import Dict, List, Optional, Type
+
+# Aggregators by name, see register_aggregator
+AGGREGATORS = {}
+
+
+def register_aggregator(cls: Type["Aggregator"]) -> Type["Aggregator"]:
+    # Class decorator making an aggregator available by its name (CLI, config, cache)
+    AGGREGATORS[cls.name] = cls
+    return cls
+
+
+class Aggregator(abc.ABC):
+    """
+    A breakdown of the Contents file computed in the same pass as the package
+    counts. The parser hands every block to update() as two parallel lists:
+    the raw package fields of its lines and, only if needs_paths is set, their
+    file paths. Updates should stay per block (Counter.update over a list) so
+    an extra breakdown costs a few C level operations per line.
+    """
+
+    name = ""
+    needs_paths = False
+
+    @abc.abstractmethod
+    def fresh(self) -> "Aggregator":
+        # Empty aggregator with the same settings, used by worker processes
+        pass
+
+    @abc.abstractmethod
+    def update(self, paths: Optional[List[bytes]], fields: List[bytes]):
+        pass
+
+    @abc.abstractmethod
+    def merge(self, other: "Aggregator"):
+        # Add the results of a worker process
+        pass
+
+    @abc.abstractmethod
+    def _totals(self) -> Counter:
+        pass
+
+    def result(self) -> Dict[str, int]:
+        # Decoded breakdown, largest first
+        totals = self._totals()
+        return {
+            key.decode("utf-8", errors="replace") if key else "(none)": count
+            for key, count in sorted(
+                totals.items(), key=lambda item: item[1], reverse=True
+            )
+        }
+
+
+class CountingAggregator(Aggregator):
+    # Aggregator keeping a Counter of keys, only update() is left to implement
+
+    def __init__(self):
+        self.counts = Counter()
+
+    def fresh(self) -> "CountingAggregator":
+        return type(self)()
+
+    def merge(self, other: "CountingAggregator"):
+        self.counts.update(other.counts)
+
+    def _totals(self) -> Counter:
+        return self.counts
+
+
+def _section(package: bytes) -> bytes:
+    # main/section/name and section/name -> the part before the package name
+    return package.rpartition(b"/")[0]
+
+
+@register_aggregator
+class SectionFiles(CountingAggregator):
+    # Number of files per section, a file shipped by several packages counts for each
+    name = "section-files"
+
+    def update(self, paths: Optional[List[bytes]], fields: List[bytes]):
+        # Fields are only expanded once, when the result is computed
+        self.counts.update(fields)
+
+    def _totals(self) -> Counter:
+        totals = Counter()
+        for field, files in self.counts.items():
+            for package in field.split(b","):
+                totals[_section(package)] += files
+        return totals
+
+
+@register_aggregator
+class SectionPackages(Aggregator):
+    # Number of distinct packages per section
+    name = "section-packages"
+
+    def __init__(self):
+        self.fields = set()
+
+    def fresh(self) -> "SectionPackages":
+        return SectionPackages()
+
+    def update(self, paths: Optional[List[bytes]], fields: List[bytes]):
+        self.fields.update(fields)
+
+    def merge(self, other: "SectionPackages"):
+        self.fields.update(other.fields)
+
+    def _totals(self) -> Counter:
+        packages = {package for field in self.fields for package in field.split(b",")}
+        return Counter(_section(package) for package in packages)
+
+
+@register_aggregator
+class DirectoryFiles(CountingAggregator):
+    # Number of files per directory, cut to DEPTH components (usr/share/doc).
+    # Files in shallower directories count for their own directory.
+    name = "directory"
+    needs_paths = True
+    DEPTH = 3
+
+    def update(self, paths: Optional[List[bytes]], fields: List[bytes]):
+        depth = self.DEPTH
+        self.counts.update(
+            [
+                b"/".join(path.rpartition(b"/")[0].split(b"/", depth)[:depth])
+                for path in paths
+            ]
+        )
+
+
+@register_aggregator
+class ExtensionFiles(CountingAggregator):
+    # Number of files per file name extension, "(none)" for files without one
+    name = "extension"
+    needs_paths = True
+
+    def update(self, paths: Optional[List[bytes]], fields: List[bytes]):
+        self.counts.update([_extension(path) for path in paths])
+
+
+def _extension(path: bytes) -> bytes:
+    # Hidden files like .bashrc have no extension
+    stem, _, extension = path.rpartition(b"/")[2].rpartition(b".")
+    return extension if stem else b""
+
+
+def make_aggregators(names: List[str]) -> List[Aggregator]:
+    unknown = [name for name in names if name not in AGGREGATORS]
+    if unknown:
+        raise ValueError(
+            f"Unknown breakdowns {', '.join(unknown)}, available: {', '.join(AGGREGATORS)}"
+        )
+    return [AGGREGATORS[name]() for name in dict.fromkeys(names)]
@@ -0,0 +1,297 @@
+import asyncio
+import http.client
+import io
+import ssl
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
+from urllib.error import HTTPError
+from urllib.parse import urljoin, urlparse
+from .connection import DEFAULT_TIMEOUT, MAX_REDIRECTS, REDIRECT_STATUSES
+
+# Block size of read() without a size
+READ_BLOCK_SIZE = 64 * 1024
+# Largest number of header lines accepted in a response
+MAX_HEADERS = 100
+
+
+class AsyncResponse:
+    """
+    Response to a request of the AsyncConnectionPool. The body is read from
+    the asyncio stream of the connection, framed by its Content-Length, by
+    chunked transfer encoding or by the end of the connection.
+    """
+
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        version: str,
+        status: int,
+        reason: str,
+        headers: http.client.HTTPMessage,
+        method: str,
+        timeout: float,
+    ):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self._reader = reader
+        self._timeout = timeout
+        connection = headers.get("Connection", "").lower()
+        self.will_close = connection == "close" or (
+            version == "HTTP/1.0" and connection != "keep-alive"
+        )
+        self._chunked = "chunked" in headers.get("Transfer-Encoding", "").lower()
+        self._chunk_left = 0
+        length = headers.get("Content-Length")
+        self._remaining = None
+        if length is not None and not self._chunked:
+            self._remaining = int(length)
+        if method == "HEAD" or status in (204, 304):
+            self._chunked = False
+            self._remaining = 0
+        elif not self._chunked and self._remaining is None:
+            # The body ends with the connection
+            self.will_close = True
+        self.done = self._remaining == 0
+
+    async def _wait(self, awaitable):
+        return await asyncio.wait_for(awaitable, self._timeout)
+
+    async def read(self, size: int = -1) -> bytes:
+        # Up to size bytes of the body (all of it when size is negative), b"" at the end
+        if size < 0:
+            parts = []
+            while True:
+                part = await self.read(READ_BLOCK_SIZE)
+                if not part:
+                    return b"".join(parts)
+                parts.append(part)
+        if self.done or size == 0:
+            return b""
+        if self._chunked:
+            return await self._read_chunk(size)
+        if self._remaining is None:
+            data = await self._wait(self._reader.read(size))
+            self.done = not data
+            return data
+        data = await self._wait(self._reader.read(min(size, self._remaining)))
+        if not data:
+            raise http.client.IncompleteRead(b"", self._remaining)
+        self._remaining -= len(data)
+        self.done = self._remaining == 0
+        return data
+
+    async def _read_chunk(self, size: int) -> bytes:
+        if self._chunk_left == 0:
+            line = await self._wait(self._reader.readline())
+            try:
+                # Chunk extensions after a ; are ignored
+                self._chunk_left = int(line.split(b";", 1)[0].strip(), 16)
+            except ValueError:
+                raise http.client.HTTPException(f"Invalid chunk size {line!r}")
+            if self._chunk_left == 0:
+                # Trailer fields end with an empty line
+                while (await self._wait(self._reader.readline())).strip():
+                    pass
+                self.done = True
+                return b""
+        data = await self._wait(self._reader.read(min(size, self._chunk_left)))
+        if not data:
+            raise http.client.IncompleteRead(b"", self._chunk_left)
+        self._chunk_left -= len(data)
+        if self._chunk_left == 0:
+            await self._wait(self._reader.readexactly(2))
+        return data
+
+
+class BlockingReader:
+    """
+    File object reading an AsyncResponse from another thread, so that the
+    parsers running on an executor pull the body from the event loop.
+    """
+
+    def __init__(
+        self,
+        response: AsyncResponse,
+        loop: asyncio.AbstractEventLoop,
+        timeout: float = DEFAULT_TIMEOUT,
+    ):
+        self.response = response
+        self.headers = response.headers
+        self.loop = loop
+        self.timeout = timeout
+
+    def read(self, size: int = -1) -> bytes:
+        future = asyncio.run_coroutine_threadsafe(self.response.read(size), self.loop)
+        return future.result(self.timeout)
+
+
+Connection = Tuple[asyncio.StreamReader, asyncio.StreamWriter]
+
+
+class AsyncConnectionPool:
+    """
+    Pool of persistent HTTP/1.1 connections over asyncio streams, the
+    non-blocking counterpart of ConnectionPool. Only used from the event loop
+    that created its connections.
+    """
+
+    def __init__(self, max_per_host: int = 8, timeout: float = DEFAULT_TIMEOUT):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self._idle: Dict[Tuple, List[Connection]] = {}
+        self._ssl_context = None
+
+    async def _connect(self, scheme: str, host: str, port: int) -> Connection:
+        ssl_context = None
+        if scheme == "https":
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            ssl_context = self._ssl_context
+        return await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=ssl_context), self.timeout
+        )
+
+    async def _send(
+        self,
+        connection: Connection,
+        method: str,
+        host: str,
+        path: str,
+        headers: Dict[str, str],
+    ) -> AsyncResponse:
+        reader, writer = connection
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {host}"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await asyncio.wait_for(writer.drain(), self.timeout)
+        while True:
+            status_line = await asyncio.wait_for(reader.readline(), self.timeout)
+            if not status_line:
+                raise http.client.RemoteDisconnected(
+                    "Remote end closed connection without response"
+                )
+            try:
+                version, status, *reason = status_line.decode("latin-1").split(None, 2)
+                status = int(status)
+            except ValueError:
+                raise http.client.BadStatusLine(status_line.decode("latin-1"))
+            header_lines = []
+            while True:
+                line = await asyncio.wait_for(reader.readline(), self.timeout)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                header_lines.append(line)
+                if len(header_lines) > MAX_HEADERS:
+                    raise http.client.HTTPException(
+                        f"Got more than {MAX_HEADERS} headers"
+                    )
+            # Interim responses (100 Continue) are followed by the real one
+            if status >= 200:
+                break
+        response_headers = http.client.parse_headers(
+            io.BytesIO(b"".join(header_lines) + b"\r\n")
+        )
+        return AsyncResponse(
+            reader,
+            version,
+            status,
+            reason[0].strip() if reason else "",
+            response_headers,
+            method,
+            self.timeout,
+        )
+
+    @asynccontextmanager
+    async def request(
+        self, url: str, headers: Optional[Dict[str, str]] = None, method: str = "GET"
+    ):
+        # Yield the response of a request, raising HTTPError like urlopen for error statuses.
+        # Redirects are followed over the pooled connections of the new host.
+        # The connection goes back to the pool only if the response was read to the end.
+        for _ in range(MAX_REDIRECTS + 1):
+            key, connection, response = await self._request(url, headers, method)
+            location = response.headers.get("Location")
+            if response.status not in REDIRECT_STATUSES or not location:
+                break
+            await self._discard(key, connection, response)
+            url = urljoin(url, location)
+            if response.status == 303 and method != "HEAD":
+                method = "GET"
+        else:
+            raise HTTPError(
+                url, response.status, "Too many redirects", response.headers, None
+            )
+        if response.status >= 300:
+            await self._discard(key, connection, response)
+            raise HTTPError(
+                url, response.status, response.reason, response.headers, None
+            )
+        try:
+            yield response
+        except BaseException:
+            self._close(connection)
+            raise
+        self._release(key, connection, response)
+
+    async def _request(
+        self, url: str, headers: Optional[Dict[str, str]], method: str
+    ) -> Tuple[Tuple, Connection, AsyncResponse]:
+        # (pool key, connection, response) of a single request
+        parsed = urlparse(url)
+        port = parsed.port or (443 if parsed.scheme == "https" else 80)
+        key = (parsed.scheme, parsed.hostname, port)
+        path = parsed.path or "/"
+        if parsed.query:
+            path += "?" + parsed.query
+        # Bodies are decompressed by the parsers, not by the transport
+        headers = {"Accept-Encoding": "identity", **(headers or {})}
+        idle = self._idle.setdefault(key, [])
+        reused = bool(idle)
+        connection = idle.pop() if reused else await self._connect(*key)
+        try:
+            try:
+                response = await self._send(
+                    connection, method, parsed.netloc, path, headers
+                )
+            except (http.client.HTTPException, OSError, asyncio.IncompleteReadError):
+                if not reused:
+                    raise
+                # The server closed the idle connection, retry once on a new one
+                self._close(connection)
+                connection = await self._connect(*key)
+                response = await self._send(
+                    connection, method, parsed.netloc, path, headers
+                )
+        except BaseException:
+            self._close(connection)
+            raise
+        return key, connection, response
+
+    async def _discard(
+        self, key: Tuple, connection: Connection, response: AsyncResponse
+    ):
+        # Read the body of a response nobody uses, so the connection can be reused
+        try:
+            await response.read()
+        except BaseException:
+            self._close(connection)
+            raise
+        self._release(key, connection, response)
+
+    def _release(self, key: Tuple, connection: Connection, response: AsyncResponse):
+        idle = self._idle.setdefault(key, [])
+        if not response.done or response.will_close or len(idle) >= self.max_per_host:
+            self._close(connection)
+            return
+        idle.append(connection)
+
+    @staticmethod
+    def _close(connection: Connection):
+        connection[1].close()
+
+    def close(self):
+        for idle in self._idle.values():
+            for connection in idle:
+                self._close(connection)
+        self._idle = {}
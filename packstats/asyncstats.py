@@ -0,0 +1,333 @@
+import asyncio
+import functools
+from concurrent.futures import Executor
+from typing import Dict, List, Optional
+from urllib.error import HTTPError
+from urllib.parse import urljoin
+from .asyncpool import AsyncConnectionPool, BlockingReader
+from .metrics import metrics
+from .release import Release, contents_archs, remember_release, suite_url
+from .stats import PackageStatistics
+from .store import StatsStore, open_stats_store
+from .utils import ArchUtils, Config, Logger
+
+config = Config.instance()
+
+
+class StatsError(Exception):
+    # Raised by the async API where the CLI prints an error and exits
+    pass
+
+
+class AsyncPackageStatistics:
+    """
+    asyncio API over the package statistics of one mirror, for services that
+    can't block their event loop. HTTP requests go through a shared pool of
+    non-blocking connections, decompressing and parsing run on an executor,
+    and the cached statistics stay open between queries. Concurrent refreshes
+    of an architecture share a single download.
+
+        async with AsyncPackageStatistics(mirror_url) as package_stats:
+            top = await package_stats.top("amd64", 10)
+            files = await package_stats.lookup("amd64", "devel/gcc-12")
+    """
+
+    LOG_FILE_PATH = config["DEFAULT_LOG_DIR_PATH"] + "packstats.log"
+
+    def __init__(
+        self,
+        mirror_url: str = config["DEFAULT_MIRROR_URL"],
+        workers: int = config["DEFAULT_WORKERS"],
+        keep_contents: bool = config["DEFAULT_KEEP_CONTENTS"],
+        path_index: bool = config["DEFAULT_PATH_INDEX"],
+        breakdowns: Optional[List[str]] = None,
+        history: bool = config["DEFAULT_HISTORY"],
+        executor: Optional[Executor] = None,
+        pool: Optional[AsyncConnectionPool] = None,
+    ):
+        from .aggregate import AGGREGATORS
+
+        if workers < 1:
+            raise ValueError("The number of workers should be greater than 0")
+        breakdowns = list(
+            config["DEFAULT_BREAKDOWNS"] if breakdowns is None else breakdowns
+        )
+        unknown = [name for name in breakdowns if name not in AGGREGATORS]
+        if unknown:
+            raise ValueError(
+                f"Unknown breakdowns {', '.join(unknown)}, available: {', '.join(AGGREGATORS)}"
+            )
+        self.logger = Logger(AsyncPackageStatistics.LOG_FILE_PATH)
+        self.mirror_url = mirror_url
+        self.options = dict(
+            workers=workers,
+            keep_contents=keep_contents,
+            path_index=path_index,
+            breakdowns=breakdowns,
+            history=history,
+        )
+        # The event loop's default executor unless one is given. With workers > 1 the
+        # parsing itself runs in worker processes and the executor thread only feeds them.
+        self.executor = executor
+        self.pool = pool or AsyncConnectionPool()
+        self._owns_pool = pool is None
+        # PackageStatistics of every architecture, built on the executor
+        self._package_stats: Dict[str, asyncio.Future] = {}
+        # Open stats files and the signature of the file they were opened from
+        self._stores: Dict[str, tuple] = {}
+        # Refresh in flight for every architecture, awaited by every caller
+        self._refreshes: Dict[str, asyncio.Future] = {}
+
+    async def __aenter__(self) -> "AsyncPackageStatistics":
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        # Cancel the refreshes in flight and release the open files and connections
+        refreshes = list(self._refreshes.values())
+        for refresh in refreshes:
+            refresh.cancel()
+        await asyncio.gather(*refreshes, return_exceptions=True)
+        for _, store in self._stores.values():
+            store.close()
+        self._stores = {}
+        if self._owns_pool:
+            self.pool.close()
+
+    def _run(self, function, *args):
+        return asyncio.get_running_loop().run_in_executor(
+            self.executor, function, *args
+        )
+
+    async def _stats(self, arch: str) -> PackageStatistics:
+        # One PackageStatistics per architecture, only used for its paths and for the
+        # parts of the refresh that don't touch the network. The constructor migrates
+        # the caches of older versions, so it runs on the executor.
+        package_stats = self._package_stats.get(arch)
+        if package_stats is None:
+            package_stats = self._run(
+                functools.partial(
+                    PackageStatistics,
+                    arch=arch,
+                    mirror_url=self.mirror_url,
+                    top_n=config["DEFAULT_TOP_N"],
+                    refresh=False,
+                    stream=True,
+                    validate=False,
+                    logger=self.logger,
+                    **self.options,
+                )
+            )
+            self._package_stats[arch] = package_stats
+        try:
+            return await asyncio.shield(package_stats)
+        except Exception:
+            # The next caller tries again
+            if self._package_stats.get(arch) is package_stats:
+                del self._package_stats[arch]
+            raise
+
+    async def archs(self) -> List[str]:
+        # Architectures available on the mirror, from the cache shared with the sync API
+        arch_utils = await self._run(ArchUtils, self.mirror_url)
+        archs = await self._run(arch_utils.cached_archs)
+        if archs is not None:
+            return archs
+        try:
+            with metrics.stage("arch_discovery", mirror=arch_utils.mirror_domain):
+                release = await self._fetch_release()
+        except Exception as e:
+            self.logger.log_error(
+                f"An error occurred while trying to retrieve the available architectures for mirror {arch_utils.mirror_domain}: {e}"
+            )
+            raise StatsError(
+                f"Could not retrieve the available architectures of {self.mirror_url}: {e}"
+            ) from e
+        remember_release(self.mirror_url, release)
+        # Written from the executor, like every other cache file
+        await self._run(
+            arch_utils.write_arch_file, contents_archs(release, self.mirror_url)
+        )
+        return await self._run(arch_utils.cached_archs)
+
+    async def _fetch_release(self) -> Release:
+        # fetch_release over the async connection pool
+        try:
+            async with self.pool.request(
+                urljoin(suite_url(self.mirror_url), "Release")
+            ) as response:
+                return Release((await response.read()).decode("utf-8"))
+        except HTTPError as e:
+            if e.code != 404:
+                raise
+        async with self.pool.request(
+            urljoin(suite_url(self.mirror_url), "InRelease")
+        ) as response:
+            return Release((await response.read()).decode("utf-8"))
+
+    async def top(self, arch: str, n: int = config["DEFAULT_TOP_N"]) -> Dict[str, int]:
+        # The n packages with the most files, refreshed first if nothing is cached
+        if n < 1:
+            raise ValueError(
+                "The number of packages to be shown should be greater than 0"
+            )
+        package_stats = await self._stats(arch)
+        store = await self._store(arch)
+        with metrics.stage("rank", **package_stats._labels()):
+            if len(store) == 0:
+                raise StatsError(
+                    f"The package statistics of {arch} are empty, check the mirror URL and architecture"
+                )
+            return store.top(n)
+
+    async def lookup(self, arch: str, package: str) -> Optional[int]:
+        # Number of files of a single package (section/name), None if it isn't listed
+        store = await self._store(arch)
+        return store.get(package)
+
+    async def _store(self, arch: str) -> StatsStore:
+        package_stats = await self._stats(arch)
+        if not await self._run(package_stats.has_cached_stats):
+            await self.refresh(arch)
+        signature = await self._run(package_stats._stats_signature)
+        cached = self._stores.get(arch)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        try:
+            # Migrating a JSON cache of an older version rewrites it
+            store = await self._run(
+                open_stats_store,
+                package_stats.stats_file_path,
+                package_stats.legacy_stats_file_path,
+            )
+        except (OSError, ValueError) as e:
+            raise StatsError(
+                f"Could not open the package statistics of {arch}: {e}"
+            ) from e
+        # Queries don't await once they got a store, nobody is still reading the old one
+        cached = self._stores.get(arch)
+        if cached is not None:
+            cached[1].close()
+        self._stores[arch] = (signature, store)
+        return store
+
+    async def refresh(self, arch: str, force: bool = False) -> bool:
+        """
+        Bring the statistics of an architecture up to date and tell whether
+        they were rebuilt. The cached statistics are revalidated against the
+        mirror and only downloaded again if they changed, or always with force.
+        Callers arriving while a refresh is in flight wait for it instead.
+        """
+        refresh = self._refreshes.get(arch)
+        if refresh is None:
+            refresh = asyncio.ensure_future(self._refresh(arch, force))
+            self._refreshes[arch] = refresh
+            refresh.add_done_callback(lambda _: self._forget_refresh(arch, refresh))
+        # A cancelled caller doesn't cancel the refresh the others are waiting for
+        return await asyncio.shield(refresh)
+
+    def _forget_refresh(self, arch: str, refresh: asyncio.Future):
+        # The next caller starts a new refresh
+        if self._refreshes.get(arch) is refresh:
+            del self._refreshes[arch]
+
+    async def _refresh(self, arch: str, force: bool) -> bool:
+        package_stats = await self._stats(arch)
+        if arch not in await self.archs():
+            self.logger.log_error(
+                f"The given architecture {arch} is not available on this Debian Mirror {package_stats.mirror_domain}"
+            )
+            raise StatsError(
+                f"The architecture {arch} is not available on {self.mirror_url}"
+            )
+        # Single flight across processes too, like PackageStatistics.update_stats
+        signature = await self._run(package_stats._stats_signature)
+        lock = package_stats._refresh_lock()
+        acquire = self._run(lock.acquire)
+        try:
+            await asyncio.shield(acquire)
+        except asyncio.CancelledError:
+            # The lock is still taken by the executor thread, release it once it is
+            acquire.add_done_callback(
+                lambda future: future.exception() is None and lock.release()
+            )
+            raise
+        try:
+            if (
+                lock.waited
+                and await self._run(package_stats._stats_signature) != signature
+            ):
+                self.logger.log_info(
+                    "The stats were refreshed by another process, using its result"
+                )
+                return True
+            if (
+                not force
+                and await self._run(package_stats.has_cached_stats)
+                and await self._is_cache_fresh(package_stats)
+            ):
+                return False
+            await self._download_and_parse(package_stats)
+            return True
+        finally:
+            lock.release()
+
+    async def _is_cache_fresh(self, package_stats: PackageStatistics) -> bool:
+        # PackageStatistics.is_cache_fresh over the async connection pool
+        meta = await self._run(package_stats._load_contents_meta)
+        if meta.get("url") != package_stats.contents_url():
+            return False
+        try:
+            release = await self._fetch_release()
+            remember_release(self.mirror_url, release)
+        except Exception as e:
+            self.logger.log_warning(f"Could not fetch the Release file: {e}")
+            release = None
+        if release is not None:
+            fresh = package_stats.release_freshness(release, meta)
+            if fresh is not None:
+                return fresh
+
+        headers = package_stats.conditional_headers(meta)
+        if not headers:
+            return False
+        try:
+            async with self.pool.request(package_stats.contents_url(), headers):
+                self.logger.log_info(
+                    "The Contents file changed since the last download"
+                )
+                return False
+        except HTTPError as e:
+            if e.code == 304:
+                self.logger.log_info("The Contents file is not modified")
+                return True
+            self.logger.log_warning(f"Conditional request failed: {e}")
+        except Exception as e:
+            self.logger.log_warning(f"Conditional request failed: {e}")
+        # Keep serving the cached stats when the mirror can't be reached
+        self.logger.log_warning(
+            "Could not revalidate the cached statistics, using them anyway"
+        )
+        return True
+
+    async def _download_and_parse(self, package_stats: PackageStatistics):
+        # The event loop downloads, an executor thread decompresses and counts the
+        # packages as the body arrives and then writes the stats files
+        loop = asyncio.get_running_loop()
+        await self._run(package_stats._manage_cached_artifacts)
+        try:
+            async with self.pool.request(package_stats.contents_url()) as response:
+                package_dict = await self._run(
+                    package_stats.stream_contents,
+                    BlockingReader(response, loop, self.pool.timeout),
+                )
+            await self._run(package_stats._save_stats, package_dict)
+        except Exception as e:
+            self.logger.log_error(
+                f"An error occurred while trying to download and parse the Contents file: {e}"
+            )
+            raise StatsError(
+                f"Could not download and parse the Contents file of {package_stats.arch}: {e}"
+            ) from e
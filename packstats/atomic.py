@@ -0,0 +1,88 @@
+import os
+import time
+from contextlib import contextmanager
+from typing import IO, Iterator
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# Seconds between two attempts to take a lock where blocking locks aren't available
+LOCK_POLL_INTERVAL = 0.1
+
+
+class FileLock:
+    """
+    Exclusive advisory lock on a file, shared by every process (and thread)
+    opening the same path. waited tells whether another holder had to be
+    waited for, which callers use to reuse the work done meanwhile.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.waited = False
+        self._file = None
+
+    def acquire(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._file = open(self.path, "a+b")
+        self.waited = False
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self.waited = True
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+            return
+        while True:
+            try:
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_NBLCK, 1)
+                return
+            except OSError:
+                self.waited = True
+                time.sleep(LOCK_POLL_INTERVAL)
+
+    def release(self):
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        else:
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        self._file.close()
+        self._file = None
+
+    def __enter__(self) -> "FileLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+@contextmanager
+def atomic_write(path: str, mode: str = "wb") -> Iterator[IO]:
+    # Write to a temporary file next to path and rename it over path once complete,
+    # readers see either the old or the new file but never a partial one
+    import tempfile
+
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(
+        dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp creates files only readable by their owner
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
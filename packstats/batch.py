@@ -0,0 +1,288 @@
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+from .connection import ConnectionPool
+from .metrics import metrics
+from .parser import count_contents_file
+from .stats import PackageStatistics, print_approx_packages
+from .store import merge_stats_stores
+from .utils import ALL_AVAILABLE_ARCHS, ArchUtils, Config, Logger
+
+# NumPy is optional, it is only needed for the comparison matrix
+if TYPE_CHECKING:
+    from .matrix import ArchMatrix
+
+config = Config.instance()
+
+
+class BatchStatistics:
+    """
+    Package statistics for several architectures of one mirror. The mirror and the
+    architectures are validated once, Contents files are downloaded concurrently over
+    a shared connection pool and parsed in a pool of worker processes.
+    """
+
+    LOG_FILE_PATH = config["DEFAULT_LOG_DIR_PATH"] + "packstats.log"
+
+    def __init__(
+        self,
+        archs: List[str],
+        mirror_url: str,
+        top_n: int,
+        refresh: bool,
+        workers: int = config["DEFAULT_WORKERS"],
+        download_threads: int = config["DEFAULT_DOWNLOAD_THREADS"],
+        keep_contents: bool = config["DEFAULT_KEEP_CONTENTS"],
+        revalidate: bool = config["DEFAULT_REVALIDATE"],
+        incremental: bool = config["DEFAULT_INCREMENTAL"],
+        path_index: bool = config["DEFAULT_PATH_INDEX"],
+        breakdowns: Optional[List[str]] = None,
+        segments: int = config["DEFAULT_SEGMENTS"],
+        extra_mirrors: Optional[List[str]] = None,
+        history: bool = config["DEFAULT_HISTORY"],
+    ):
+        self.logger = Logger(BatchStatistics.LOG_FILE_PATH)
+        self.mirror_url = mirror_url
+        self.top_packs_count = top_n
+        self.download_threads = download_threads
+
+        if download_threads < 1:
+            print("The number of download threads should be greater than 0")
+            self.logger.log_error(
+                f"The number of download threads should be greater than 0. User input: {download_threads}"
+            )
+            sys.exit(1)
+        self.http_pool = ConnectionPool(max_per_host=download_threads)
+
+        self.logger.log_info(
+            f"Initializing BatchStatistics for architectures {archs} on mirror {mirror_url}"
+        )
+        self.archs = self._resolve_archs(archs)
+        # Without an explicit number of workers use one process per architecture, up to the core count
+        self.parse_processes = (
+            workers if workers > 1 else min(len(self.archs), os.cpu_count() or 1)
+        )
+        self.arch_stats = [
+            PackageStatistics(
+                arch=arch,
+                mirror_url=mirror_url,
+                top_n=top_n,
+                refresh=refresh,
+                workers=1,
+                # Downloaded first, then parsed in the process pool
+                stream=False,
+                keep_contents=keep_contents,
+                revalidate=revalidate,
+                incremental=incremental,
+                path_index=path_index,
+                breakdowns=breakdowns,
+                segments=segments,
+                extra_mirrors=extra_mirrors,
+                history=history,
+                validate=False,
+                logger=self.logger,
+                http_pool=self.http_pool,
+            )
+            for arch in self.archs
+        ]
+
+    def _resolve_archs(self, archs: List[str]) -> List[str]:
+        # Loading the architectures of the mirror validates it, once for the whole batch
+        available_archs = ArchUtils(self.mirror_url).get_available_archs()
+        if ALL_AVAILABLE_ARCHS in archs:
+            return sorted(set(available_archs))
+        for arch in archs:
+            if arch not in available_archs:
+                print(
+                    f"The given architecture {arch} is not available on this Debian Mirror"
+                )
+                self.logger.log_error(
+                    f"The given architecture {arch} is not available on this Debian Mirror {self.mirror_url}"
+                )
+                sys.exit(1)
+        # Keep the given order, without duplicates
+        return list(dict.fromkeys(archs))
+
+    def _update_arch(self, package_stats: PackageStatistics, parsers) -> str:
+        # Runs on a download thread, parsing is handed to the process pool. Like
+        # PackageStatistics.update_stats a refresh done meanwhile by another process is reused.
+        signature = package_stats._stats_signature()
+        with package_stats._refresh_lock() as lock:
+            if not (lock.waited and package_stats._stats_signature() != signature):
+                self._refresh_arch(package_stats, parsers)
+        return package_stats.arch
+
+    def _refresh_arch(self, package_stats: PackageStatistics, parsers):
+        # PackageStatistics._update_stats, with the parsing handed to the process pool
+        if not package_stats.needs_update():
+            return
+        if (
+            package_stats.incremental
+            and not package_stats.refresh
+            and package_stats.has_cached_stats()
+        ):
+            if package_stats.update_from_pdiffs():
+                return
+            self.logger.log_info(
+                f"Falling back to a full refresh for {package_stats.arch}"
+            )
+        package_stats._manage_cached_artifacts()
+        self.logger.log_info(f"Downloading the Contents file for {package_stats.arch}")
+        if package_stats.segments > 1:
+            package_stats.download_contents_file_segmented()
+        else:
+            package_stats.download_contents_file()
+        self.logger.log_info(f"Parsing the Contents file for {package_stats.arch}")
+        if package_stats.breakdown_names or package_stats.incremental:
+            # The breakdowns and the digest of the decompressed file are computed while
+            # parsing, on this thread
+            package_stats.parse_contents_file()
+        else:
+            # Decompressed and parsed in a worker process, measured as a whole
+            with metrics.stage("parse", **package_stats._labels()) as stage:
+                package_dict = parsers.submit(
+                    count_contents_file, package_stats.contents_file_path
+                ).result()
+                stage.bytes = os.path.getsize(package_stats.contents_file_path)
+            package_stats._save_stats(package_dict)
+        if not package_stats.keep_contents:
+            os.remove(package_stats.contents_file_path)
+
+    def update_stats(self):
+        with ThreadPoolExecutor(max_workers=self.download_threads) as threads:
+            with ProcessPoolExecutor(max_workers=self.parse_processes) as parsers:
+                futures = [
+                    threads.submit(self._update_arch, package_stats, parsers)
+                    for package_stats in self.arch_stats
+                ]
+                for future in futures:
+                    self.logger.log_info(f"Stats for {future.result()} are up to date")
+        self.http_pool.close()
+
+    def get_top_packages(self) -> Dict[str, Dict[str, int]]:
+        # Top packages of every architecture
+        self.update_stats()
+        return {
+            package_stats.arch: package_stats.sort_and_return_top_packages()
+            for package_stats in self.arch_stats
+        }
+
+    def get_combined_top_packages(self) -> Dict[str, int]:
+        # Top packages with the number of files summed over all architectures
+        with ExitStack() as stack:
+            combined = merge_stats_stores(
+                stack.enter_context(package_stats._open_stats())
+                for package_stats in self.arch_stats
+            )
+        return dict(
+            sorted(combined.items(), key=lambda item: item[1], reverse=True)[
+                : self.top_packs_count
+            ]
+        )
+
+    # Print the top packages of every architecture and of all of them combined
+    def print_top_packages(self):
+        for arch, top_packages in self.get_top_packages().items():
+            print(f"Top packages by number of files for {arch}:")
+            for i, (package, files) in enumerate(top_packages.items(), start=1):
+                print(f"{i}. {package} - {files} files")
+            print()
+        print(f"Top packages by number of files for {', '.join(self.archs)}:")
+        for i, (package, files) in enumerate(
+            self.get_combined_top_packages().items(), start=1
+        ):
+            print(f"{i}. {package} - {files} files")
+
+    def get_approx_top_packages(
+        self, sketch_size: int = config["DEFAULT_SKETCH_SIZE"]
+    ) -> Tuple[Dict[str, List[tuple]], List[tuple]]:
+        # Approximate top packages of every architecture and of all of them combined.
+        # The Contents files are streamed through one sketch per architecture and the
+        # sketches are merged, memory only depends on the sketch size.
+        with ThreadPoolExecutor(max_workers=self.download_threads) as threads:
+            sketches = list(
+                threads.map(
+                    lambda package_stats: package_stats.sketch_contents(sketch_size),
+                    self.arch_stats,
+                )
+            )
+        self.http_pool.close()
+        combined = sketches[0]
+        for sketch in sketches[1:]:
+            combined = combined.merge(sketch)
+        return (
+            {
+                arch: sketch.top(self.top_packs_count)
+                for arch, sketch in zip(self.archs, sketches)
+            },
+            combined.top(self.top_packs_count),
+        )
+
+    # Print the approximate top packages of every architecture and of all of them combined
+    def print_approx_top_packages(
+        self, sketch_size: int = config["DEFAULT_SKETCH_SIZE"]
+    ):
+        per_arch, combined = self.get_approx_top_packages(sketch_size)
+        for arch, top_packages in per_arch.items():
+            print(f"{arch}:")
+            print_approx_packages(top_packages)
+            print()
+        print(f"{', '.join(self.archs)}:")
+        print_approx_packages(combined)
+
+    def comparison_matrix(self) -> "ArchMatrix":
+        # Packages x architectures matrix of the number of files
+        try:
+            from .matrix import ArchMatrix
+        except ImportError:
+            print(
+                "Comparing architectures needs NumPy, install it with: pip install package_statistics[matrix]"
+            )
+            self.logger.log_error("NumPy is not installed, can't compare architectures")
+            sys.exit(1)
+
+        self.update_stats()
+        with ExitStack() as stack:
+            stores = {
+                package_stats.arch: stack.enter_context(package_stats._open_stats())
+                for package_stats in self.arch_stats
+            }
+            return ArchMatrix.from_stores(stores)
+
+    # Print a comparison of the architectures: the top packages over all of them,
+    # the packages that differ the most or the packages only found on one of them
+    def print_comparison(self, mode: str, only_on: str = None):
+        matrix = self.comparison_matrix()
+        if only_on is not None:
+            if only_on not in self.archs:
+                print(
+                    f"The architecture {only_on} is not one of {', '.join(self.archs)}"
+                )
+                sys.exit(1)
+            print(f"Packages only found on {only_on}:")
+            for i, (package, files) in enumerate(
+                matrix.only_on(only_on, self.top_packs_count), start=1
+            ):
+                print(f"{i}. {package} - {files} files")
+        elif mode == "divergence":
+            print(
+                f"Packages with the largest difference in files between {', '.join(self.archs)}:"
+            )
+            for i, (package, counts) in enumerate(
+                matrix.divergence(self.top_packs_count), start=1
+            ):
+                per_arch = ", ".join(
+                    f"{arch} {files}" for arch, files in counts.items()
+                )
+                print(f"{i}. {package} - {per_arch}")
+        else:
+            print(f"Top packages by total number of files for {', '.join(self.archs)}:")
+            for i, (package, files) in enumerate(
+                matrix.top_by_total(self.top_packs_count), start=1
+            ):
+                per_arch = ", ".join(
+                    f"{arch} {files}" for arch, files in matrix.package(package).items()
+                )
+                print(f"{i}. {package} - {files} files ({per_arch})")
@@ -0,0 +1,461 @@
+import collections
+import contextlib
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import random
+import shutil
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+from .localmirror import LocalMirror
+from .metrics import peak_rss
+from .release import branch_path
+
+# Version of the results file layout
+RESULTS_VERSION = 1
+# Block size used when reading files and responses
+READ_BLOCK_SIZE = 1024 * 1024
+# Sections and directories the synthetic packages and paths are drawn from
+SECTIONS = [
+    "admin",
+    "devel",
+    "doc",
+    "games",
+    "golang",
+    "libdevel",
+    "libs",
+    "net",
+    "python",
+    "science",
+    "utils",
+    "x11",
+]
+DIRECTORIES = [
+    "usr/bin",
+    "usr/lib/x86_64-linux-gnu",
+    "usr/share/doc",
+    "usr/share/man/man1",
+    "usr/share/locale/de/LC_MESSAGES",
+    "usr/include",
+    "usr/lib/python3/dist-packages",
+    "usr/share/icons/hicolor/48x48/apps",
+]
+EXTENSIONS = ["", ".so.1", ".h", ".py", ".gz", ".png", ".mo", ".html"]
+
+
+def generate_contents(
+    path: str,
+    lines: int = 1000000,
+    packages: int = 60000,
+    skew: float = 1.1,
+    multi_package_ratio: float = 0.01,
+    empty_packages: int = 10,
+    space_ratio: float = 0.001,
+    seed: int = 0,
+) -> Dict[str, int]:
+    """
+    Write a synthetic compressed Contents file and return its exact number of
+    files per package. The number of files per package follows a Zipf like
+    distribution (a few packages with tens of thousands of files, a long tail
+    with one or two) with the given skew, a fraction of the paths is shipped
+    by several packages, some contain spaces, and empty packages get
+    EMPTY_PACKAGE lines. Lines are sorted by path like in the real files.
+    """
+    rng = random.Random(seed)
+    names = [
+        f"{rng.choice(SECTIONS)}/pkg{index}-{rng.randrange(1000)}"
+        for index in range(packages)
+    ]
+    weights = [1 / (rank + 1) ** skew for rank in range(packages)]
+    owners = rng.choices(range(packages), weights=weights, k=lines)
+    counts = {}
+    rows = []
+    for line, owner in enumerate(owners):
+        name = names[owner]
+        field = name
+        if rng.random() < multi_package_ratio:
+            other = names[rng.randrange(packages)]
+            if other != name:
+                field += "," + other
+                counts[other] = counts.get(other, 0) + 1
+        counts[name] = counts.get(name, 0) + 1
+        file_name = f"file{line}" + rng.choice(EXTENSIONS)
+        if rng.random() < space_ratio:
+            file_name = "a " + file_name
+        directory = rng.choice(DIRECTORIES)
+        path_name = f"{directory}/{name.rpartition('/')[2]}/{file_name}"
+        rows.append((path_name, field))
+    rows.sort()
+    for index in range(empty_packages):
+        rows.append(("EMPTY_PACKAGE", f"{rng.choice(SECTIONS)}/empty{index}"))
+    with gzip.open(path, "wb") as f:
+        buffer = []
+        for path_name, field in rows:
+            # Real files pad the path column with spaces, EMPTY_PACKAGE lines aren't padded
+            if path_name == "EMPTY_PACKAGE":
+                buffer.append(f"{path_name} {field}\n")
+            else:
+                buffer.append(f"{path_name:<59} {field}\n")
+            if len(buffer) == 10000:
+                f.write("".join(buffer).encode("utf-8"))
+                buffer = []
+        f.write("".join(buffer).encode("utf-8"))
+    return counts
+
+
+def _use_data_dir(data_dir: str):
+    from .stats import PackageStatistics
+    from .utils import ArchUtils
+
+    PackageStatistics.DEFAULT_DATA_DIR_PATH = data_dir
+    ArchUtils.DEFAULT_DATA_DIR_PATH = data_dir
+
+
+# The stages run in a fresh process each so that their peak memory can be measured.
+# They return the measured seconds and the processed bytes and lines.
+
+
+def _stage_baseline(context: dict) -> Tuple[float, int, int]:
+    return 0.0, 0, 0
+
+
+def _stage_download(context: dict) -> Tuple[float, int, int]:
+    from urllib.request import urlopen
+
+    size = 0
+    started = time.perf_counter()
+    with urlopen(context["contents_url"]) as response:
+        for block in iter(lambda: response.read(READ_BLOCK_SIZE), b""):
+            size += len(block)
+    return time.perf_counter() - started, size, 0
+
+
+def _stage_decompress(context: dict) -> Tuple[float, int, int]:
+    size = 0
+    started = time.perf_counter()
+    with gzip.open(context["contents_path"], "rb") as f:
+        for block in iter(lambda: f.read(READ_BLOCK_SIZE), b""):
+            size += len(block)
+    return time.perf_counter() - started, size, 0
+
+
+def _stage_parse(context: dict) -> Tuple[float, int, int]:
+    from .parser import count_stream, parse_stream_parallel
+
+    started = time.perf_counter()
+    with open(context["plain_path"], "rb") as f:
+        if context["workers"] > 1:
+            parse_stream_parallel(f, context["workers"])
+        else:
+            count_stream(f)
+    return (
+        time.perf_counter() - started,
+        os.path.getsize(context["plain_path"]),
+        context["lines"],
+    )
+
+
+def _stage_dispatch(context: dict) -> Tuple[float, int, int]:
+    # The serial part of parse_stream_parallel: decompressing the file, cutting it into
+    # chunks and sending them to the workers, which only take their size here. However
+    # many workers are used, the parallel parse can't go faster than this.
+    from concurrent.futures import ProcessPoolExecutor
+    from .parser import iter_chunks
+
+    workers = context["workers"]
+    size = 0
+    started = time.perf_counter()
+    with gzip.open(context["contents_path"], "rb") as f, ProcessPoolExecutor(
+        max_workers=workers
+    ) as pool:
+        pending = collections.deque()
+        for chunk in iter_chunks(f):
+            pending.append(pool.submit(len, chunk))
+            if len(pending) >= workers * 2:
+                size += pending.popleft().result()
+        while pending:
+            size += pending.popleft().result()
+    return time.perf_counter() - started, size, context["lines"]
+
+
+def count_reference(stream) -> Dict[str, int]:
+    # The per line parser of the first versions, the reference the parse stage is
+    # compared with
+    package_dict = {}
+    for line in stream:
+        line = line.decode("utf-8").strip()
+        if line == "":
+            continue
+        file_name, packages = line.rsplit(" ", maxsplit=1)
+        for package in packages.split(","):
+            if file_name != "EMPTY_PACKAGE":
+                package_dict[package] = package_dict.get(package, 0) + 1
+    return package_dict
+
+
+def _stage_parse_reference(context: dict) -> Tuple[float, int, int]:
+    started = time.perf_counter()
+    with open(context["plain_path"], "rb") as f:
+        count_reference(f)
+    return (
+        time.perf_counter() - started,
+        os.path.getsize(context["plain_path"]),
+        context["lines"],
+    )
+
+
+def _stage_rank(context: dict) -> Tuple[float, int, int]:
+    # Opening the ranked stats file and reading the top packages, averaged over the queries
+    from .parser import count_stream
+    from .store import StatsStore, write_stats_store
+
+    with open(context["plain_path"], "rb") as f:
+        package_dict = count_stream(f)
+    path = os.path.join(context["work_dir"], "rank.bin")
+    write_stats_store(path, package_dict)
+    started = time.perf_counter()
+    for _ in range(context["queries"]):
+        with StatsStore(path) as store:
+            store.top(context["top_n"])
+    seconds = (time.perf_counter() - started) / context["queries"]
+    os.remove(path)
+    return seconds, 0, 0
+
+
+def _stage_refresh(context: dict) -> Tuple[float, int, int]:
+    from .stats import PackageStatistics
+
+    _use_data_dir(context["data_dir"])
+    started = time.perf_counter()
+    package_stats = PackageStatistics(
+        context["arch"],
+        context["mirror_url"],
+        context["top_n"],
+        True,
+        workers=context["workers"],
+    )
+    package_stats.get_top_packages()
+    return (
+        time.perf_counter() - started,
+        os.path.getsize(context["contents_path"]),
+        context["lines"],
+    )
+
+
+def _stage_cached_query(context: dict) -> Tuple[float, int, int]:
+    # A new PackageStatistics per query and the printed output, like a CLI invocation
+    from .stats import PackageStatistics
+
+    _use_data_dir(context["data_dir"])
+    started = time.perf_counter()
+    for _ in range(context["queries"]):
+        with contextlib.redirect_stdout(io.StringIO()):
+            PackageStatistics(
+                context["arch"], context["mirror_url"], context["top_n"], False
+            ).print_top_packages()
+    return (time.perf_counter() - started) / context["queries"], 0, 0
+
+
+STAGES = {
+    "baseline": _stage_baseline,
+    "download": _stage_download,
+    "decompress": _stage_decompress,
+    "parse": _stage_parse,
+    "parse_reference": _stage_parse_reference,
+    "dispatch": _stage_dispatch,
+    "rank": _stage_rank,
+    "refresh": _stage_refresh,
+    "cached_query": _stage_cached_query,
+}
+
+
+def _run_stage(name: str, context: dict, results):
+    seconds, size, lines = STAGES[name](context)
+    results.put((seconds, size, lines, peak_rss()))
+
+
+def measure_stage(name: str, context: dict) -> Tuple[float, int, int, Optional[int]]:
+    # Run a stage in a new interpreter, spawned rather than forked so that its peak
+    # memory doesn't include the memory of this process
+    spawn = multiprocessing.get_context("spawn")
+    results = spawn.Queue()
+    process = spawn.Process(target=_run_stage, args=(name, context, results))
+    process.start()
+    try:
+        while True:
+            try:
+                return results.get(timeout=1)
+            except queue.Empty:
+                if not process.is_alive():
+                    raise RuntimeError(
+                        f"The {name} stage failed with exit code {process.exitcode}"
+                    ) from None
+    finally:
+        process.join()
+
+
+def run_benchmark(
+    lines: int = 1000000,
+    packages: int = 60000,
+    skew: float = 1.1,
+    multi_package_ratio: float = 0.01,
+    repeat: int = 3,
+    workers: int = 1,
+    queries: int = 20,
+    stages: Optional[List[str]] = None,
+    seed: int = 0,
+) -> dict:
+    """
+    Generate a synthetic Contents file, serve it from a local mirror and
+    measure every stage. The fastest of `repeat` runs of a stage is kept,
+    the peak memory is the largest one.
+    """
+    stages = (
+        list(STAGES) if stages is None else list(dict.fromkeys(["baseline"] + stages))
+    )
+    unknown = [name for name in stages if name not in STAGES]
+    if unknown:
+        raise ValueError(
+            f"Unknown stages {', '.join(unknown)}, available: {', '.join(STAGES)}"
+        )
+    with tempfile.TemporaryDirectory(prefix="packstats-benchmark-") as work_dir:
+        contents_path = os.path.join(work_dir, "Contents.gz")
+        started = time.perf_counter()
+        counts = generate_contents(
+            contents_path,
+            lines=lines,
+            packages=packages,
+            skew=skew,
+            multi_package_ratio=multi_package_ratio,
+            seed=seed,
+        )
+        generation_seconds = time.perf_counter() - started
+        compressed_bytes = os.path.getsize(contents_path)
+        plain_path = os.path.join(work_dir, "Contents")
+        with gzip.open(contents_path, "rb") as source, open(plain_path, "wb") as target:
+            shutil.copyfileobj(source, target, READ_BLOCK_SIZE)
+
+        with LocalMirror(os.path.join(work_dir, "mirror")) as mirror:
+            arch = "amd64"
+            mirror.publish_archive(contents_path, arch)
+            data_dir = os.path.join(work_dir, "data") + "/"
+            # Architecture discovery isn't benchmarked
+            mirror_dir = data_dir + branch_path(mirror.mirror_url)
+            os.makedirs(mirror_dir)
+            with open(mirror_dir + "available_archs.txt", "w") as f:
+                f.write(arch + "\n")
+            context = {
+                "arch": arch,
+                "mirror_url": mirror.mirror_url,
+                "contents_url": mirror.mirror_url + f"Contents-{arch}.gz",
+                "contents_path": contents_path,
+                "plain_path": plain_path,
+                "work_dir": work_dir,
+                "data_dir": data_dir,
+                "lines": lines,
+                "workers": workers,
+                "queries": queries,
+                "top_n": 10,
+            }
+            results = {}
+            for name in stages:
+                if name == "cached_query" and "refresh" not in stages:
+                    # Needs the cache written by a refresh
+                    measure_stage("refresh", context)
+                runs = [measure_stage(name, context) for _ in range(repeat)]
+                seconds = min(run[0] for run in runs)
+                size, processed_lines = runs[0][1], runs[0][2]
+                peaks = [run[3] for run in runs if run[3] is not None]
+                results[name] = {
+                    "seconds": seconds,
+                    "bytes": size,
+                    "lines": processed_lines,
+                    "mb_per_s": size / seconds / 1e6 if size and seconds else None,
+                    "lines_per_s": (
+                        processed_lines / seconds
+                        if processed_lines and seconds
+                        else None
+                    ),
+                    "peak_rss_bytes": max(peaks) if peaks else None,
+                }
+    return {
+        "version": RESULTS_VERSION,
+        "created_at": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {
+            "lines": lines,
+            "packages": packages,
+            "skew": skew,
+            "multi_package_ratio": multi_package_ratio,
+            "repeat": repeat,
+            "workers": workers,
+            "queries": queries,
+            "seed": seed,
+        },
+        "contents": {
+            "compressed_bytes": compressed_bytes,
+            "packages": len(counts),
+            "generation_seconds": generation_seconds,
+        },
+        "stages": results,
+    }
+
+
+def compare_results(
+    baseline: dict, current: dict, tolerance: float = 0.1
+) -> List[Tuple[str, str, float, float]]:
+    # (stage, metric, baseline value, current value) of every stage that got slower or
+    # used more memory than the baseline by more than the tolerance
+    regressions = []
+    for name, stage in current["stages"].items():
+        before = baseline.get("stages", {}).get(name)
+        if before is None or name == "baseline":
+            continue
+        for metric in ("seconds", "peak_rss_bytes"):
+            old, new = before.get(metric), stage.get(metric)
+            if old and new and new > old * (1 + tolerance):
+                regressions.append((name, metric, old, new))
+    return regressions
+
+
+def save_results(results: dict, path: str):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=4)
+
+
+def load_results(path: str) -> dict:
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def print_results(results: dict):
+    contents = results["contents"]
+    parameters = results["parameters"]
+    print(
+        f"Synthetic Contents file: {parameters['lines']} lines, {contents['packages']} packages, {contents['compressed_bytes']} bytes compressed"
+    )
+    for name, stage in results["stages"].items():
+        throughput = []
+        if stage["mb_per_s"]:
+            throughput.append(f"{stage['mb_per_s']:.1f} MB/s")
+        if stage["lines_per_s"]:
+            throughput.append(f"{stage['lines_per_s'] / 1e6:.2f} M lines/s")
+        peak = stage["peak_rss_bytes"]
+        print(
+            f"{name:<15} {stage['seconds'] * 1000:10.2f} ms  {', '.join(throughput):<30} peak RSS {peak / 1e6 if peak else 0:.1f} MB"
+        )
+    stages = results["stages"]
+    if "parse" in stages and "parse_reference" in stages:
+        print(
+            f"parse is {stages['parse_reference']['seconds'] / stages['parse']['seconds']:.2f}x faster than the per line reference parser"
+        )
+    if "parse" in stages and "dispatch" in stages and parameters["workers"] == 1:
+        print(
+            f"the parallel parse is bounded by the dispatch, at {stages['dispatch']['mb_per_s'] / stages['parse']['mb_per_s']:.1f}x the single process parse"
+        )
@@ -0,0 +1,231 @@
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from itertools import product
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+from .atomic import FileLock, atomic_write
+from .release import branch_url, cached_release, component_name, suite_name
+from .stats import PackageStatistics
+from .store import StatsStore, merge_stats_stores, write_stats_store
+from .utils import ArchUtils, Config, Logger
+
+config = Config.instance()
+
+# Component argument selecting every component listed in the Release file of the suite
+ALL_COMPONENTS = "all"
+
+
+class CombinedStatistics:
+    """
+    Package statistics of several suites and components (and architectures)
+    of one mirror merged into a single view, e.g. stable with main, contrib
+    and non-free for amd64. Every suite, component and architecture is a
+    partial, cached and refreshed on its own like a single PackageStatistics.
+    The view is the sum of its partials: adding a component to a view only
+    downloads and parses that component, and the merged table is cached
+    until one of its partials changes.
+    """
+
+    LOG_FILE_PATH = config["DEFAULT_LOG_DIR_PATH"] + "packstats.log"
+
+    def __init__(
+        self,
+        archs: List[str],
+        mirror_url: str,
+        top_n: int,
+        refresh: bool,
+        suites: Optional[List[str]] = None,
+        components: Optional[List[str]] = None,
+        workers: int = config["DEFAULT_WORKERS"],
+        download_threads: int = config["DEFAULT_DOWNLOAD_THREADS"],
+        stream: bool = config["DEFAULT_STREAM"],
+        keep_contents: bool = config["DEFAULT_KEEP_CONTENTS"],
+        revalidate: bool = config["DEFAULT_REVALIDATE"],
+        incremental: bool = config["DEFAULT_INCREMENTAL"],
+        segments: int = config["DEFAULT_SEGMENTS"],
+        history: bool = config["DEFAULT_HISTORY"],
+        offline: bool = False,
+    ):
+        self.logger = Logger(CombinedStatistics.LOG_FILE_PATH)
+        self.mirror_url = mirror_url
+        self.top_packs_count = top_n
+        self.offline = offline
+        if download_threads < 1:
+            print("The number of download threads should be greater than 0")
+            self.logger.log_error(
+                f"The number of download threads should be greater than 0. User input: {download_threads}"
+            )
+            sys.exit(1)
+        self.download_threads = download_threads
+        # Keep the given order, without duplicates
+        self.archs = list(dict.fromkeys(archs))
+        self.suites = list(dict.fromkeys(suites or [suite_name(mirror_url)]))
+        self.components = self._resolve_components(
+            list(dict.fromkeys(components or [component_name(mirror_url)]))
+        )
+        self.logger.log_info(
+            f"Initializing CombinedStatistics for suites {self.suites}, components {self.components} and architectures {self.archs} on mirror {mirror_url}"
+        )
+        self.partials = [
+            PackageStatistics(
+                arch=arch,
+                mirror_url=branch_url(mirror_url, suite, component),
+                top_n=top_n,
+                refresh=refresh,
+                workers=workers,
+                stream=stream,
+                keep_contents=keep_contents,
+                revalidate=revalidate,
+                incremental=incremental,
+                segments=segments,
+                history=history,
+                offline=offline,
+                logger=self.logger,
+            )
+            for suite, component, arch in product(
+                self.suites, self.components, self.archs
+            )
+        ]
+
+        # The merged view, next to the partials of the mirror
+        self.view_dir_path = (
+            PackageStatistics.DEFAULT_DATA_DIR_PATH
+            + f"{urlparse(mirror_url).netloc}/views/"
+            + "/".join(
+                "+".join(names) for names in (self.suites, self.components, self.archs)
+            )
+            + "/"
+        )
+        self.stats_file_path = self.view_dir_path + "packages_stats.bin"
+        # Signatures of the partial stats files the view was merged from
+        self.manifest_file_path = self.view_dir_path + "partials.json"
+        self.lock_file_path = self.view_dir_path + "merge.lock"
+
+    def _resolve_components(self, components: List[str]) -> List[str]:
+        if ALL_COMPONENTS not in components:
+            return components
+        resolved = {}
+        for suite in self.suites:
+            for component in self._suite_components(suite):
+                resolved[component] = None
+        if not resolved:
+            print(f"No component found for {', '.join(self.suites)}")
+            self.logger.log_error(
+                f"No component found for suites {self.suites} on mirror {self.mirror_url}"
+            )
+            sys.exit(1)
+        return list(resolved)
+
+    def _suite_components(self, suite: str) -> List[str]:
+        # Components listed in the Release file of the suite (fetched once per TTL and
+        # shared with the architecture discovery), or the cached ones offline
+        if self.offline:
+            suite_dir_path = (
+                PackageStatistics.DEFAULT_DATA_DIR_PATH
+                + f"{urlparse(self.mirror_url).netloc}/{suite}/"
+            )
+            try:
+                return sorted(os.listdir(suite_dir_path))
+            except OSError:
+                return []
+        url = branch_url(self.mirror_url, suite, component_name(self.mirror_url))
+        try:
+            return cached_release(url, ArchUtils.ARCHS_TTL).components()
+        except Exception as e:
+            print(f"Could not list the components of {suite}: {e}")
+            self.logger.log_error(
+                f"Could not fetch the Release file of suite {suite} on mirror {self.mirror_url}: {e}"
+            )
+            sys.exit(1)
+
+    def _partial_name(self, package_stats: PackageStatistics) -> str:
+        return f"{package_stats.suite}/{package_stats.component}/{package_stats.arch}"
+
+    def _partial_signatures(self) -> Dict[str, list]:
+        return {
+            self._partial_name(package_stats): list(
+                package_stats._stats_signature() or ()
+            )
+            for package_stats in self.partials
+        }
+
+    def _load_manifest(self) -> Optional[Dict[str, list]]:
+        try:
+            with open(self.manifest_file_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def is_view_fresh(self) -> bool:
+        # The merged view was built from the current stats file of every partial
+        return (
+            os.path.exists(self.stats_file_path)
+            and self._load_manifest() == self._partial_signatures()
+        )
+
+    def update_stats(self):
+        # Bring every partial up to date (concurrently, each one behind its own refresh
+        # lock), then merge them unless the cached view is still current
+        with ThreadPoolExecutor(max_workers=self.download_threads) as threads:
+            for package_stats, _ in zip(
+                self.partials,
+                threads.map(lambda partial: partial.update_stats(), self.partials),
+            ):
+                self.logger.log_info(
+                    f"Stats for {self._partial_name(package_stats)} are up to date"
+                )
+        self.update_view()
+
+    def update_view(self):
+        if self.is_view_fresh():
+            self.logger.log_info(f"The merged view {self.view_dir_path} is up to date")
+            return
+        with FileLock(self.lock_file_path):
+            # Merged by another process meanwhile
+            if self.is_view_fresh():
+                return
+            signatures = self._partial_signatures()
+            self.logger.log_info(
+                f"Merging {len(self.partials)} partial statistics into {self.view_dir_path}"
+            )
+            with ExitStack() as stack:
+                merged = merge_stats_stores(
+                    stack.enter_context(package_stats._open_stats())
+                    for package_stats in self.partials
+                )
+            write_stats_store(self.stats_file_path, merged)
+            with atomic_write(self.manifest_file_path, "w") as f:
+                json.dump(signatures, f)
+
+    def _open_view(self) -> StatsStore:
+        self.update_stats()
+        return StatsStore(self.stats_file_path)
+
+    def get_top_packages(self) -> Dict[str, int]:
+        with self._open_view() as store:
+            return store.top(self.top_packs_count)
+
+    def get_package_count(self, package: str) -> Optional[int]:
+        with self._open_view() as store:
+            return store.get(package)
+
+    def describe(self) -> str:
+        return f"{', '.join(self.suites)} {', '.join(self.components)} {', '.join(self.archs)}"
+
+    # Print the top packages of the merged view to the console
+    def print_top_packages(self):
+        top_packages = self.get_top_packages()
+        print(f"Top packages by number of files for {self.describe()}:")
+        for i, (package, files) in enumerate(top_packages.items(), start=1):
+            print(f"{i}. {package} - {files} files")
+
+    # Print the number of files of a single package in the merged view
+    def print_package_count(self, package: str):
+        files = self.get_package_count(package)
+        if files is None:
+            print(f"Package {package} was not found in {self.describe()}")
+        else:
+            print(f"{package} - {files} files")
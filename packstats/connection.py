@@ -0,0 +1,119 @@
+import http.client
+import queue
+import threading
+from contextlib import contextmanager
+from typing import Dict, Optional
+from urllib.error import HTTPError
+from urllib.parse import urljoin, urlparse
+
+# Timeout in seconds for a single socket operation
+DEFAULT_TIMEOUT = 60
+# Redirects followed by a request, like urlopen
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of persistent HTTP/1.1 connections, one queue per host.
+    Used when many files are fetched from the same mirror so that every
+    request doesn't pay for a new TCP (and TLS) handshake.
+    """
+
+    def __init__(self, max_per_host: int = 8, timeout: int = DEFAULT_TIMEOUT):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _idle_queue(self, key) -> queue.Queue:
+        with self._lock:
+            if key not in self._idle:
+                self._idle[key] = queue.Queue(maxsize=self.max_per_host)
+            return self._idle[key]
+
+    def _connect(self, scheme: str, netloc: str) -> http.client.HTTPConnection:
+        if scheme == "https":
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    @contextmanager
+    def request(
+        self, url: str, headers: Optional[Dict[str, str]] = None, method: str = "GET"
+    ):
+        # Yield the response of a request, raising HTTPError like urlopen for error statuses.
+        # Redirects are followed over the pooled connections of the new host.
+        # The connection goes back to the pool only if the response was read to the end.
+        for _ in range(MAX_REDIRECTS + 1):
+            idle, connection, response = self._send(url, headers, method)
+            location = response.headers.get("Location")
+            if response.status not in REDIRECT_STATUSES or not location:
+                break
+            response.read()
+            self._release(idle, connection, response)
+            url = urljoin(url, location)
+            if response.status == 303 and method != "HEAD":
+                method = "GET"
+        else:
+            raise HTTPError(
+                url, response.status, "Too many redirects", response.headers, None
+            )
+        if response.status >= 300:
+            response.read()
+            self._release(idle, connection, response)
+            raise HTTPError(
+                url, response.status, response.reason, response.headers, None
+            )
+        try:
+            yield response
+        except BaseException:
+            connection.close()
+            raise
+        self._release(idle, connection, response)
+
+    def _send(self, url: str, headers: Optional[Dict[str, str]], method: str):
+        # (idle queue, connection, response) of a single request
+        parsed = urlparse(url)
+        key = (parsed.scheme, parsed.netloc)
+        idle = self._idle_queue(key)
+        path = parsed.path or "/"
+        if parsed.query:
+            path += "?" + parsed.query
+        try:
+            connection = idle.get_nowait()
+            reused = True
+        except queue.Empty:
+            connection = self._connect(*key)
+            reused = False
+        try:
+            try:
+                connection.request(method, path, headers=headers or {})
+                response = connection.getresponse()
+            except (http.client.HTTPException, OSError):
+                if not reused:
+                    raise
+                # The server closed the idle connection, retry once on a new one
+                connection.close()
+                connection = self._connect(*key)
+                connection.request(method, path, headers=headers or {})
+                response = connection.getresponse()
+        except BaseException:
+            connection.close()
+            raise
+        return idle, connection, response
+
+    def _release(self, idle: queue.Queue, connection, response):
+        if not response.isclosed() or response.will_close:
+            connection.close()
+            return
+        try:
+            idle.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle.values():
+                while not idle.empty():
+                    idle.get_nowait().close()
+            self._idle = {}
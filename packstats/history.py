@@ -0,0 +1,339 @@
+import re
+import sqlite3
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+from .release import component_name, suite_name
+from .utils import Config
+
+# Every refresh is a snapshot of a series (mirror, architecture). Only the packages whose
+# number of files changed since the previous snapshot of the series get a row in changes,
+# a removed package gets a row with 0 files. current holds the latest counts of every
+# series so that a new snapshot is diffed without replaying the changes.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS series (
+    id INTEGER PRIMARY KEY,
+    mirror TEXT NOT NULL,
+    arch TEXT NOT NULL,
+    UNIQUE (mirror, arch)
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    series_id INTEGER NOT NULL REFERENCES series (id),
+    taken_at INTEGER NOT NULL,
+    sha256 TEXT,
+    packages INTEGER NOT NULL,
+    files INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS snapshots_by_time ON snapshots (series_id, taken_at);
+CREATE TABLE IF NOT EXISTS packages (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS changes (
+    series_id INTEGER NOT NULL,
+    package_id INTEGER NOT NULL,
+    snapshot_id INTEGER NOT NULL,
+    files INTEGER NOT NULL,
+    PRIMARY KEY (series_id, package_id, snapshot_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS changes_by_snapshot ON changes (series_id, snapshot_id);
+CREATE TABLE IF NOT EXISTS current (
+    series_id INTEGER NOT NULL,
+    package_id INTEGER NOT NULL,
+    files INTEGER NOT NULL,
+    PRIMARY KEY (series_id, package_id)
+) WITHOUT ROWID;
+"""
+
+# Seconds waited for another process writing to the database
+BUSY_TIMEOUT = 30
+# Package names looked up per query, below the SQLite limit on query parameters
+LOOKUP_BATCH_SIZE = 900
+
+# Relative times accepted by parse_time: 90m, 12h, 30d, 2w
+TIME_UNITS = {"m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+
+# Number of files of a package at the newest snapshot of the series not after the given one
+FILES_AT = """
+SELECT files FROM changes
+WHERE series_id = :series AND package_id = moved.package_id AND snapshot_id <= {}
+ORDER BY snapshot_id DESC LIMIT 1
+"""
+
+
+def parse_time(value: str, now: Optional[float] = None) -> float:
+    # "30d" (relative to now) or an ISO date "2026-09-01" / date and time to a Unix timestamp
+    match = re.fullmatch(r"(\d+)([mhdw])", value.strip())
+    if match:
+        now = time.time() if now is None else now
+        return now - int(match.group(1)) * TIME_UNITS[match.group(2)]
+    try:
+        return datetime.fromisoformat(value.strip()).timestamp()
+    except ValueError:
+        raise ValueError(
+            f"Invalid time {value!r}, expected a date or a duration like 30d"
+        ) from None
+
+
+def legacy_series(mirror_url: str) -> Optional[str]:
+    # Older versions recorded a single series per mirror host, for the suite and
+    # component of the default mirror. None for the other suites and components.
+    default_url = Config.instance()["DEFAULT_MIRROR_URL"]
+    if (suite_name(mirror_url), component_name(mirror_url)) != (
+        suite_name(default_url),
+        component_name(default_url),
+    ):
+        return None
+    return urlparse(mirror_url).netloc
+
+
+class HistoryStore:
+    """
+    Number of files of every package at every refresh, for every mirror and
+    architecture, in a SQLite database. A snapshot only stores the packages
+    that changed since the previous one, so a daily snapshot costs disk space
+    in proportion to the day's changes, and growth queries only read the
+    changes between the two snapshots compared.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+        # Readers don't block the process recording a snapshot
+        self._db.execute("PRAGMA journal_mode=WAL")
+        with self._db:
+            self._db.executescript(SCHEMA)
+
+    def __enter__(self) -> "HistoryStore":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    def _series(self, mirror: str, arch: str) -> Optional[int]:
+        row = self._db.execute(
+            "SELECT id FROM series WHERE mirror = ? AND arch = ?", (mirror, arch)
+        ).fetchone()
+        return row[0] if row else None
+
+    def adopt_series(self, old_mirror: str, mirror: str):
+        # Rename the series of old_mirror to mirror, for the architectures mirror has
+        # no series of its own yet
+        with self._db:
+            self._db.execute(
+                "UPDATE series SET mirror = ? WHERE mirror = ? AND arch NOT IN (SELECT arch FROM series WHERE mirror = ?)",
+                (mirror, old_mirror, mirror),
+            )
+
+    def record(
+        self,
+        mirror: str,
+        arch: str,
+        package_dict: Dict[str, int],
+        taken_at: Optional[float] = None,
+        sha256: Optional[str] = None,
+    ) -> int:
+        # Add a snapshot of the given counts and return its id
+        taken_at = int(time.time() if taken_at is None else taken_at)
+        with self._db:
+            # Taken before reading current, concurrent writers of a series are serialized
+            self._db.execute("BEGIN IMMEDIATE")
+            self._db.execute(
+                "INSERT OR IGNORE INTO series (mirror, arch) VALUES (?, ?)",
+                (mirror, arch),
+            )
+            series = self._series(mirror, arch)
+            last = self._db.execute(
+                "SELECT MAX(taken_at) FROM snapshots WHERE series_id = ?", (series,)
+            ).fetchone()[0]
+            if last is not None and taken_at < last:
+                raise ValueError(
+                    f"Snapshots have to be recorded in time order, the last one is from {last}"
+                )
+            current = {
+                name: (package_id, files)
+                for name, package_id, files in self._db.execute(
+                    "SELECT name, package_id, files FROM current JOIN packages ON packages.id = package_id WHERE series_id = ?",
+                    (series,),
+                )
+            }
+            snapshot = self._db.execute(
+                "INSERT INTO snapshots (series_id, taken_at, sha256, packages, files) VALUES (?, ?, ?, ?, ?)",
+                (
+                    series,
+                    taken_at,
+                    sha256,
+                    len(package_dict),
+                    sum(package_dict.values()),
+                ),
+            ).lastrowid
+
+            new_names = [name for name in package_dict if name not in current]
+            self._db.executemany(
+                "INSERT OR IGNORE INTO packages (name) VALUES (?)",
+                ((name,) for name in new_names),
+            )
+            package_ids = {
+                name: package_id for name, (package_id, _) in current.items()
+            }
+            for start in range(0, len(new_names), LOOKUP_BATCH_SIZE):
+                names = new_names[start : start + LOOKUP_BATCH_SIZE]
+                package_ids.update(
+                    self._db.execute(
+                        f"SELECT name, id FROM packages WHERE name IN ({', '.join('?' * len(names))})",
+                        names,
+                    )
+                )
+            changed = [
+                (package_ids[name], files)
+                for name, files in package_dict.items()
+                if current.get(name, (None, None))[1] != files
+            ]
+            removed = [
+                package_id
+                for name, (package_id, _) in current.items()
+                if name not in package_dict
+            ]
+            self._db.executemany(
+                "INSERT INTO changes (series_id, package_id, snapshot_id, files) VALUES (?, ?, ?, ?)",
+                [(series, package_id, snapshot, files) for package_id, files in changed]
+                + [(series, package_id, snapshot, 0) for package_id in removed],
+            )
+            self._db.executemany(
+                "INSERT OR REPLACE INTO current (series_id, package_id, files) VALUES (?, ?, ?)",
+                [(series, package_id, files) for package_id, files in changed],
+            )
+            self._db.executemany(
+                "DELETE FROM current WHERE series_id = ? AND package_id = ?",
+                [(series, package_id) for package_id in removed],
+            )
+        return snapshot
+
+    def snapshots(self, mirror: str, arch: str) -> List[Tuple[int, int, int]]:
+        # (taken_at, number of packages, number of files) of every snapshot, oldest first
+        return self._db.execute(
+            "SELECT taken_at, packages, files FROM snapshots WHERE series_id = ? ORDER BY taken_at, id",
+            (self._series(mirror, arch),),
+        ).fetchall()
+
+    def package_history(
+        self, mirror: str, arch: str, package: str
+    ) -> List[Tuple[int, int]]:
+        # (taken_at, number of files) whenever the number of files of the package changed
+        return self._db.execute(
+            """
+            SELECT taken_at, changes.files FROM changes
+            JOIN snapshots ON snapshots.id = snapshot_id
+            JOIN packages ON packages.id = package_id
+            WHERE changes.series_id = ? AND name = ?
+            ORDER BY snapshot_id
+            """,
+            (self._series(mirror, arch), package),
+        ).fetchall()
+
+    def _snapshot_at(self, series: int, timestamp: Optional[float]) -> Optional[int]:
+        # Newest snapshot taken at or before the timestamp (the latest one without it),
+        # the oldest snapshot when the timestamp is older than the whole history
+        if timestamp is None:
+            row = self._db.execute(
+                "SELECT id FROM snapshots WHERE series_id = ? ORDER BY taken_at DESC, id DESC LIMIT 1",
+                (series,),
+            ).fetchone()
+        else:
+            row = (
+                self._db.execute(
+                    "SELECT id FROM snapshots WHERE series_id = ? AND taken_at <= ? ORDER BY taken_at DESC, id DESC LIMIT 1",
+                    (series, int(timestamp)),
+                ).fetchone()
+                or self._db.execute(
+                    "SELECT id FROM snapshots WHERE series_id = ? ORDER BY taken_at, id LIMIT 1",
+                    (series,),
+                ).fetchone()
+            )
+        return row[0] if row else None
+
+    def changes(
+        self, mirror: str, arch: str, since: float, until: Optional[float] = None
+    ) -> List[Tuple[str, int, int]]:
+        # (package, files before, files after) of the packages that changed between the
+        # snapshots at since and at until (the latest one by default)
+        series = self._series(mirror, arch)
+        if series is None:
+            return []
+        before = self._snapshot_at(series, since)
+        after = self._snapshot_at(series, until)
+        if after <= before:
+            return []
+        return self._db.execute(
+            f"""
+            SELECT name,
+                COALESCE(({FILES_AT.format(":before")}), 0),
+                ({FILES_AT.format(":after")})
+            FROM (
+                SELECT DISTINCT package_id FROM changes
+                WHERE series_id = :series AND snapshot_id > :before AND snapshot_id <= :after
+            ) AS moved
+            JOIN packages ON packages.id = moved.package_id
+            """,
+            {"series": series, "before": before, "after": after},
+        ).fetchall()
+
+    def growth(
+        self,
+        mirror: str,
+        arch: str,
+        since: float,
+        n: int,
+        until: Optional[float] = None,
+    ) -> List[Tuple[str, int, int]]:
+        # The n packages that gained the most files
+        changes = [
+            change
+            for change in self.changes(mirror, arch, since, until)
+            if change[2] > change[1]
+        ]
+        changes.sort(key=lambda change: (change[1] - change[2], change[0]))
+        return changes[:n]
+
+    def movers(
+        self,
+        mirror: str,
+        arch: str,
+        since: float,
+        n: int,
+        until: Optional[float] = None,
+    ) -> List[Tuple[str, int, int]]:
+        # The n packages whose number of files changed the most, in either direction
+        changes = self.changes(mirror, arch, since, until)
+        changes.sort(key=lambda change: (-abs(change[2] - change[1]), change[0]))
+        return changes[:n]
+
+
+def _format_time(timestamp: int) -> str:
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M")
+
+
+def print_changes(changes: List[Tuple[str, int, int]]):
+    if not changes:
+        print("No package changed in this period")
+    for i, (package, before, after) in enumerate(changes, start=1):
+        print(f"{i}. {package} - {before} -> {after} files ({after - before:+d})")
+
+
+def print_package_history(history: List[Tuple[int, int]]):
+    if not history:
+        print("No history for this package")
+    for taken_at, files in history:
+        print(f"{_format_time(taken_at)} - {files} files")
+
+
+def print_snapshots(snapshots: List[Tuple[int, int, int]]):
+    if not snapshots:
+        print("No snapshot recorded for this mirror and architecture")
+    for taken_at, packages, files in snapshots:
+        print(f"{_format_time(taken_at)} - {packages} packages, {files} files")
@@ -0,0 +1,104 @@
+import functools
+import gzip
+import hashlib
+import os
+import shutil
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+# Block size used when hashing the published files
+READ_BLOCK_SIZE = 1024 * 1024
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    # Static file handler without the request log on stderr
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalMirror:
+    """
+    Stand-in Debian mirror serving dists/stable/{Release,<component>/Contents-<arch>.gz}
+    from a directory on a local port. Used by the benchmark and the test suite.
+    """
+
+    def __init__(self, root: str, handler_class=QuietHandler):
+        self.root = root
+        self.main_dir = os.path.join(root, "debian", "dists", "stable", "main")
+        os.makedirs(self.main_dir, exist_ok=True)
+        handler = functools.partial(handler_class, directory=root)
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.mirror_url = (
+            f"http://127.0.0.1:{self.server.server_port}/debian/dists/stable/main/"
+        )
+
+    def __enter__(self) -> "LocalMirror":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _archive_path(self, arch: str, component: str) -> str:
+        component_dir = os.path.join(self.main_dir, "..", component)
+        os.makedirs(component_dir, exist_ok=True)
+        return os.path.join(component_dir, f"Contents-{arch}.gz")
+
+    def publish(
+        self,
+        contents: bytes,
+        arch: str = "amd64",
+        release: bool = True,
+        component: str = "main",
+    ):
+        with open(self._archive_path(arch, component), "wb") as f:
+            # Without a timestamp, so that several mirrors serve identical files
+            f.write(gzip.compress(contents, mtime=0))
+        self._update_release(release)
+
+    def publish_archive(
+        self,
+        archive_path: str,
+        arch: str = "amd64",
+        release: bool = True,
+        component: str = "main",
+    ):
+        # Publish an already compressed Contents file
+        shutil.copyfile(archive_path, self._archive_path(arch, component))
+        self._update_release(release)
+
+    def _update_release(self, release: bool):
+        suite_dir = os.path.join(self.main_dir, "..")
+        release_path = os.path.join(suite_dir, "Release")
+        if not release:
+            if os.path.exists(release_path):
+                os.remove(release_path)
+            return
+        # List every published Contents file
+        entries = []
+        archs = set()
+        components = sorted(name for name in os.listdir(suite_dir) if name != "Release")
+        for name in components:
+            for file_name in sorted(os.listdir(os.path.join(suite_dir, name))):
+                if not file_name.endswith(".gz"):
+                    continue
+                sha256 = hashlib.sha256()
+                size = 0
+                with open(os.path.join(suite_dir, name, file_name), "rb") as f:
+                    for block in iter(lambda: f.read(READ_BLOCK_SIZE), b""):
+                        sha256.update(block)
+                        size += len(block)
+                archs.add(file_name[len("Contents-") : -len(".gz")])
+                entries.append(f" {sha256.hexdigest()} {size} {name}/{file_name}\n")
+        with open(release_path, "w") as f:
+            f.write(
+                f"Suite: stable\nArchitectures: {' '.join(sorted(archs))}\nComponents: {' '.join(components)}\nSHA256:\n"
+                + "".join(entries)
+            )
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,102 @@
+import sys
+from typing import Dict, Iterable, List, Optional, Tuple
+import numpy as np
+from .store import StatsStore
+
+
+class ArchMatrix:
+    """
+    Number of files of every package on every architecture, as a packages x
+    architectures integer array sharing a single package name table. Packages
+    missing on an architecture have 0 files there.
+    """
+
+    def __init__(self, packages: List[str], archs: List[str], counts: np.ndarray):
+        self.packages = packages
+        self.archs = archs
+        self.counts = counts
+        self._rows = {package: row for row, package in enumerate(packages)}
+
+    @classmethod
+    def from_stores(cls, stores: Dict[str, StatsStore]) -> "ArchMatrix":
+        # Build the matrix from the stats store of every architecture
+        rows = {}
+        columns = []
+        for store in stores.values():
+            names, files = zip(*store.items()) if len(store) else ((), ())
+            columns.append(
+                (
+                    np.fromiter(
+                        (
+                            rows.setdefault(sys.intern(name), len(rows))
+                            for name in names
+                        ),
+                        dtype=np.int64,
+                        count=len(names),
+                    ),
+                    np.array(files, dtype=np.uint32),
+                )
+            )
+        counts = np.zeros((len(rows), len(stores)), dtype=np.uint32)
+        for column, (indices, files) in enumerate(columns):
+            counts[indices, column] = files
+        return cls(list(rows), list(stores), counts)
+
+    def _column(self, arch: str) -> int:
+        try:
+            return self.archs.index(arch)
+        except ValueError:
+            raise ValueError(f"Architecture {arch} is not in the matrix") from None
+
+    def _ranked(self, scores: np.ndarray, n: Optional[int]) -> np.ndarray:
+        # Row indices of the n highest (positive) scores, highest first. Ties keep the
+        # package order, like the per architecture ranking.
+        candidates = np.flatnonzero(scores > 0)
+        if n is not None and n < len(candidates):
+            threshold = np.partition(scores[candidates], -n)[-n]
+            candidates = candidates[scores[candidates] >= threshold]
+        order = np.argsort(-scores[candidates], kind="stable")
+        return candidates[order][:n]
+
+    def package(self, package: str) -> Dict[str, int]:
+        # Number of files of a package on every architecture
+        row = self._rows.get(package)
+        if row is None:
+            return {}
+        return dict(zip(self.archs, self.counts[row].tolist()))
+
+    def top_by_total(self, n: int) -> List[Tuple[str, int]]:
+        # Packages with the most files summed over all architectures
+        totals = self.counts.sum(axis=1, dtype=np.int64)
+        return [
+            (self.packages[row], int(totals[row])) for row in self._ranked(totals, n)
+        ]
+
+    def divergence(
+        self, n: int, archs: Optional[Iterable[str]] = None
+    ) -> List[Tuple[str, Dict[str, int]]]:
+        # Packages whose number of files differs the most between the given architectures
+        # (all of them by default): the spread between the largest and the smallest count
+        columns = (
+            [self._column(arch) for arch in archs]
+            if archs is not None
+            else list(range(len(self.archs)))
+        )
+        counts = self.counts[:, columns].astype(np.int64)
+        spread = counts.max(axis=1) - counts.min(axis=1)
+        return [
+            (
+                self.packages[row],
+                dict(zip((self.archs[c] for c in columns), counts[row].tolist())),
+            )
+            for row in self._ranked(spread, n)
+        ]
+
+    def only_on(self, arch: str, n: Optional[int] = None) -> List[Tuple[str, int]]:
+        # Packages shipping files on the given architecture and on none of the others
+        column = self._column(arch)
+        others = np.delete(self.counts, column, axis=1).any(axis=1)
+        scores = np.where(others, 0, self.counts[:, column]).astype(np.int64)
+        return [
+            (self.packages[row], int(scores[row])) for row in self._ranked(scores, n)
+        ]
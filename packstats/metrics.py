@@ -0,0 +1,210 @@
+import json
+import platform
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Formats accepted by Metrics.export
+FORMATS = ("json", "prometheus")
+# Runs kept for the JSON output, the Prometheus totals cover every run
+MAX_RECENT_STAGES = 1000
+
+
+def peak_rss() -> Optional[int]:
+    # Peak resident set size of the current process in bytes. ru_maxrss survives the exec
+    # of a spawned interpreter and would include the parent's memory, VmHWM doesn't.
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if platform.system() == "Darwin" else peak * 1024
+
+
+class Stage:
+    """
+    One run of a pipeline stage: its wall time, the bytes and lines it
+    processed and the peak RSS of the process when it ended. Code running in
+    a stage adds to bytes and lines as it goes.
+    """
+
+    __slots__ = ("name", "labels", "seconds", "bytes", "lines", "peak_rss_bytes")
+
+    def __init__(self, name: str, labels: Dict[str, str]):
+        self.name = name
+        self.labels = labels
+        self.seconds = 0.0
+        self.bytes = 0
+        self.lines = 0
+        self.peak_rss_bytes = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "stage": self.name,
+            "labels": self.labels,
+            "seconds": self.seconds,
+            "bytes": self.bytes,
+            "lines": self.lines,
+            "bytes_per_second": self.bytes / self.seconds if self.seconds else None,
+            "lines_per_second": self.lines / self.seconds if self.seconds else None,
+            "peak_rss_bytes": self.peak_rss_bytes,
+        }
+
+
+class MeasuredReader:
+    # File object wrapper counting the bytes and lines read through it and the time
+    # spent waiting for them (decompressing, for a gzip stream)
+    def __init__(self, source: BinaryIO):
+        self.source = source
+        self.seconds = 0.0
+        self.bytes = 0
+        self.lines = 0
+
+    def read(self, size: int = -1) -> bytes:
+        started = time.perf_counter()
+        data = self.source.read(size)
+        self.seconds += time.perf_counter() - started
+        self.bytes += len(data)
+        self.lines += data.count(b"\n")
+        return data
+
+
+class Metrics:
+    """
+    Process wide record of the pipeline stages (validate, arch_discovery,
+    download, decompress, parse, serialize, rank). Nothing is measured until
+    enable() is called, disabled stages cost a function call.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._stages = deque(maxlen=MAX_RECENT_STAGES)
+        # (stage, labels) -> [runs, seconds, bytes, lines, peak RSS]
+        self._totals = {}
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+            self._totals = {}
+
+    def add(
+        self, name: str, seconds: float, bytes: int = 0, lines: int = 0, **labels: str
+    ):
+        # Record a stage measured by the caller
+        if not self.enabled:
+            return
+        stage = Stage(name, labels)
+        stage.seconds, stage.bytes, stage.lines = seconds, bytes, lines
+        self._finish(stage)
+
+    def _finish(self, stage: Stage):
+        stage.peak_rss_bytes = peak_rss()
+        key = (stage.name, tuple(sorted(stage.labels.items())))
+        with self._lock:
+            self._stages.append(stage)
+            total = self._totals.setdefault(key, [0, 0.0, 0, 0, None])
+            total[0] += 1
+            total[1] += stage.seconds
+            total[2] += stage.bytes
+            total[3] += stage.lines
+            if stage.peak_rss_bytes is not None:
+                total[4] = max(total[4] or 0, stage.peak_rss_bytes)
+
+    @contextmanager
+    def stage(self, name: str, **labels: str) -> Iterator[Stage]:
+        # Time the body as one run of the stage, recorded even if it fails
+        stage = Stage(name, labels)
+        if not self.enabled:
+            yield stage
+            return
+        started = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            stage.seconds = time.perf_counter() - started
+            self._finish(stage)
+
+    def reader(self, source: BinaryIO) -> BinaryIO:
+        # Wrap a stream in a MeasuredReader, only when measuring
+        return MeasuredReader(source) if self.enabled else source
+
+    def stages(self) -> List[Stage]:
+        with self._lock:
+            return list(self._stages)
+
+    def to_json(self) -> str:
+        return (
+            json.dumps(
+                {"stages": [stage.to_dict() for stage in self.stages()]}, indent=4
+            )
+            + "\n"
+        )
+
+    def to_prometheus(self) -> str:
+        # Prometheus text format (node_exporter textfile collector). Runs of the same stage
+        # and labels are summed, the peak RSS is the largest one.
+        with self._lock:
+            totals = {key: list(total) for key, total in self._totals.items()}
+        metrics = [
+            ("runs_total", "counter", "Number of runs of the stage", 0),
+            ("seconds_total", "counter", "Wall time spent in the stage", 1),
+            ("bytes_total", "counter", "Bytes processed by the stage", 2),
+            ("lines_total", "counter", "Contents lines processed by the stage", 3),
+            ("peak_rss_bytes", "gauge", "Peak resident set size after the stage", 4),
+        ]
+        out = []
+        for suffix, kind, description, position in metrics:
+            name = f"packstats_stage_{suffix}"
+            out.append(f"# HELP {name} {description}")
+            out.append(f"# TYPE {name} {kind}")
+            for (stage, labels), total in totals.items():
+                if total[position] is None:
+                    continue
+                label_text = ",".join(
+                    f'{key}="{_escape(value)}"'
+                    for key, value in (("stage", stage),) + labels
+                )
+                out.append(f"{name}{{{label_text}}} {total[position]}")
+        return "\n".join(out) + "\n"
+
+    def export(self, format: str, path: Optional[str] = None):
+        # Print the metrics to stderr or write them to a file, published atomically so that
+        # a collector never reads a partial file
+        from .atomic import atomic_write
+
+        if format not in FORMATS:
+            raise ValueError(
+                f"Unknown metrics format {format}, available: {', '.join(FORMATS)}"
+            )
+        text = self.to_json() if format == "json" else self.to_prometheus()
+        if path is None:
+            sys.stderr.write(text)
+            return
+        with atomic_write(path, "w") as f:
+            f.write(text)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# Shared by every module of the package
+metrics = Metrics()
@@ -0,0 +1,354 @@
+import gzip
+import queue
+import sys
+import threading
+from collections import Counter, deque
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    BinaryIO,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+from .sketch import SpaceSaving
+
+if TYPE_CHECKING:
+    from .aggregate import Aggregator
+
+# Size of the decompressed blocks handed to each worker process
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+# Size and number of the network blocks buffered ahead of the parser
+PREFETCH_BLOCK_SIZE = 256 * 1024
+PREFETCH_MAX_BLOCKS = 64
+# Lines only need to be stripped when a block contains unusual whitespace (single bytes,
+# found with a fast memchr) or lines ending with a space
+_STRIP_MARKERS = (b"\t", b"\r", b"\x0b", b"\x0c")
+
+
+def count_fields(
+    block: bytes, fields: Counter, aggregators: Optional[List["Aggregator"]] = None
+) -> Counter:
+    # Count the raw package field (last column) of every line in a block of Contents lines.
+    # Lines are never decoded here, the per line work is a single rpartition
+    # and the counting itself happens in C inside Counter.update.
+    if b"EMPTY_PACKAGE" in block:
+        block = _drop_empty_packages(block)
+    lines = block.split(b"\n")
+    if aggregators:
+        return _aggregate_lines(lines, fields, aggregators)
+    if not any(marker in block for marker in _STRIP_MARKERS):
+        line_fields = [line.rpartition(b" ")[2] for line in lines]
+        # A line ending with a space has an empty last column, like a blank line. Only the
+        # empty line after the final newline is expected, searching the block for " \n"
+        # would cost more than this count.
+        if line_fields.count(b"") == block.endswith(b"\n"):
+            fields.update(line_fields)
+            return fields
+    fields.update([line.rstrip().rpartition(b" ")[2] for line in lines])
+    return fields
+
+
+def _drop_empty_packages(block: bytes) -> bytes:
+    # Cut the EMPTY_PACKAGE lines out of a block. They are rare, so only the lines around
+    # a match are looked at instead of filtering every line of the block.
+    parts = []
+    kept_from = 0
+    position = block.find(b"EMPTY_PACKAGE")
+    while position != -1:
+        line_start = block.rfind(b"\n", 0, position) + 1
+        line_end = block.find(b"\n", position)
+        if line_end == -1:
+            line_end = len(block)
+        if block[line_start:line_end].strip().rpartition(b" ")[0] == b"EMPTY_PACKAGE":
+            parts.append(block[kept_from:line_start])
+            kept_from = line_end + 1
+        position = block.find(b"EMPTY_PACKAGE", line_end)
+    if not parts:
+        return block
+    parts.append(block[kept_from:])
+    return b"".join(parts)
+
+
+def _aggregate_lines(
+    lines: List[bytes], fields: Counter, aggregators: List["Aggregator"]
+) -> Counter:
+    # Same count as above, with the lines split once and shared by every aggregator
+    parts = [line.rstrip().rpartition(b" ") for line in lines if line]
+    line_fields = [part[2] for part in parts]
+    fields.update(line_fields)
+    paths = None
+    if any(aggregator.needs_paths for aggregator in aggregators):
+        paths = [part[0].rstrip() for part in parts]
+    for aggregator in aggregators:
+        aggregator.update(paths, line_fields)
+    return fields
+
+
+def decode_fields(fields: Counter) -> Dict[str, int]:
+    # Expand the comma separated package fields and decode every distinct name once.
+    # Fields are visited in first seen order, so packages keep the order of the serial parser.
+    package_dict = {}
+    for field, files in fields.items():
+        if not field:
+            # Blank lines
+            continue
+        for package in field.decode("utf-8").split(","):
+            package = sys.intern(package)
+            package_dict[package] = package_dict.get(package, 0) + files
+    return package_dict
+
+
+def count_stream(
+    stream: BinaryIO,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    aggregators: Optional[List["Aggregator"]] = None,
+) -> Dict[str, int]:
+    # Count the number of files associated with every package in a decompressed Contents stream.
+    # The given aggregators are filled in the same pass.
+    fields = Counter()
+    for chunk in iter_chunks(stream, chunk_size):
+        count_fields(chunk, fields, aggregators)
+    return decode_fields(fields)
+
+
+def count_contents_file(path: str) -> Dict[str, int]:
+    # Count the packages of a compressed Contents file on disk (process pool entry point)
+    with gzip.open(path, "rb") as buffer:
+        return count_stream(buffer)
+
+
+def count_lines(lines: Iterable[bytes]) -> Dict[str, int]:
+    # Count the number of files associated with every package in the given Contents lines
+    return decode_fields(count_fields(b"\n".join(lines), Counter()))
+
+
+def count_chunk(chunk: bytes) -> Counter:
+    # Worker entry point, the chunk always ends on a line boundary
+    return count_fields(chunk, Counter())
+
+
+def aggregate_chunk(
+    chunk: bytes, aggregators: List["Aggregator"]
+) -> Tuple[Counter, List["Aggregator"]]:
+    # Worker entry point filling empty copies of the aggregators
+    aggregators = [aggregator.fresh() for aggregator in aggregators]
+    return count_fields(chunk, Counter(), aggregators), aggregators
+
+
+def iter_chunks(
+    stream: BinaryIO, chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> Iterator[bytes]:
+    # Read the decompressed stream in large blocks and cut them on the last newline
+    # so that no Contents line is ever split between two workers
+    remainder = b""
+    while True:
+        block = stream.read(chunk_size)
+        if not block:
+            break
+        block = remainder + block
+        cut = block.rfind(b"\n")
+        if cut == -1:
+            remainder = block
+            continue
+        remainder = block[cut + 1 :]
+        yield block[: cut + 1]
+    if remainder:
+        yield remainder
+
+
+def merge_counts(package_dict: Dict, counts: Dict):
+    # Merge a partial counter into the global one, keeping first seen order
+    for package, files in counts.items():
+        package_dict[package] = package_dict.get(package, 0) + files
+
+
+def parse_stream_parallel(
+    stream: BinaryIO,
+    workers: int,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    aggregators: Optional[List["Aggregator"]] = None,
+) -> Dict[str, int]:
+    # Decompression stays in this process, counting is spread over a pool of workers.
+    # Results are merged in submission order so the output matches the serial parser.
+    # Decompressing and sending the chunks is serial, it bounds the speedup whatever
+    # the number of workers (see the dispatch stage of the benchmark).
+    from concurrent.futures import ProcessPoolExecutor
+
+    fields = Counter()
+
+    def merge(result):
+        if aggregators:
+            result, partial_aggregators = result
+            for aggregator, partial in zip(aggregators, partial_aggregators):
+                aggregator.merge(partial)
+        merge_counts(fields, result)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for chunk in iter_chunks(stream, chunk_size):
+            if aggregators:
+                pending.append(pool.submit(aggregate_chunk, chunk, aggregators))
+            else:
+                pending.append(pool.submit(count_chunk, chunk))
+            # Bound the number of chunks held in memory
+            if len(pending) >= workers * 2:
+                merge(pending.popleft().result())
+        while pending:
+            merge(pending.popleft().result())
+    return decode_fields(fields)
+
+
+def sketch_chunk(chunk: bytes, capacity: int) -> SpaceSaving:
+    # Worker entry point for approximate counts. Only the packages of a single chunk
+    # are ever counted exactly, so memory is bounded by the chunk and the sketch size.
+    sketch = SpaceSaving(capacity)
+    sketch.update_counts(decode_fields(count_fields(chunk, Counter())))
+    return sketch
+
+
+def sketch_stream(
+    stream: BinaryIO, capacity: int, chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> SpaceSaving:
+    # Approximate number of files of the largest packages of a decompressed Contents stream
+    sketch = SpaceSaving(capacity)
+    for chunk in iter_chunks(stream, chunk_size):
+        sketch.update_counts(decode_fields(count_fields(chunk, Counter())))
+    return sketch
+
+
+def sketch_stream_parallel(
+    stream: BinaryIO,
+    capacity: int,
+    workers: int,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> SpaceSaving:
+    # Every worker sketches its own chunks, the partial sketches are merged in order
+    from concurrent.futures import ProcessPoolExecutor
+
+    sketch = SpaceSaving(capacity)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for chunk in iter_chunks(stream, chunk_size):
+            pending.append(pool.submit(sketch_chunk, chunk, capacity))
+            if len(pending) >= workers * 2:
+                sketch = sketch.merge(pending.popleft().result())
+        while pending:
+            sketch = sketch.merge(pending.popleft().result())
+    return sketch
+
+
+class PrefetchReader:
+    """
+    Read-only file object that pulls blocks from a source (usually an HTTP
+    response) on a background thread, so that network I/O overlaps with
+    decompression and parsing. Every block can also be copied to a file and
+    fed to a hash object.
+    """
+
+    def __init__(
+        self,
+        source: BinaryIO,
+        copy_to: Optional[BinaryIO] = None,
+        hasher: Optional[Any] = None,
+    ):
+        self.source = source
+        self.copy_to = copy_to
+        self.hasher = hasher
+        self.bytes_read = 0
+        self._blocks = queue.Queue(maxsize=PREFETCH_MAX_BLOCKS)
+        self._buffer = b""
+        self._offset = 0
+        self._eof = False
+        self._error = None
+        # Set by close() when the consumer stops before the end of the stream
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._fill, daemon=True)
+        self._thread.start()
+
+    def _fill(self):
+        try:
+            while not self._cancelled.is_set():
+                block = self.source.read(PREFETCH_BLOCK_SIZE)
+                if not block:
+                    break
+                if self.copy_to is not None:
+                    self.copy_to.write(block)
+                if self.hasher is not None:
+                    self.hasher.update(block)
+                self._put(block)
+        except Exception as e:
+            self._error = e
+        finally:
+            # An empty block marks the end of the stream
+            self._put(b"")
+
+    def _put(self, block: bytes):
+        # Wait for room in the queue, unless the consumer is gone
+        while not self._cancelled.is_set():
+            try:
+                self._blocks.put(block, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def read(self, size: int = -1) -> bytes:
+        parts = []
+        while size < 0 or size > 0:
+            if self._offset >= len(self._buffer):
+                if self._eof:
+                    break
+                self._buffer = self._blocks.get()
+                self._offset = 0
+                if not self._buffer:
+                    self._eof = True
+                    self._thread.join()
+                    if self._error is not None:
+                        raise self._error
+                    break
+            end = len(self._buffer) if size < 0 else self._offset + size
+            part = self._buffer[self._offset : end]
+            self._offset += len(part)
+            self.bytes_read += len(part)
+            parts.append(part)
+            if size > 0:
+                size -= len(part)
+        return b"".join(parts)
+
+    def readable(self) -> bool:
+        return True
+
+    def close(self):
+        # Stop the background thread without reading the rest of the stream. The source
+        # is only closed when the stream was abandoned midway.
+        if self._eof:
+            return
+        self._eof = True
+        self._cancelled.set()
+        close = getattr(self.source, "close", None)
+        if close is not None:
+            try:
+                close()
+            except Exception:
+                pass
+        # Free the queued blocks, the thread doesn't wait for room anymore
+        try:
+            while True:
+                self._blocks.get_nowait()
+        except queue.Empty:
+            pass
+
+
+class HashingReader:
+    # File object wrapper feeding everything read through it to a hash object
+    def __init__(self, source: BinaryIO, hasher: Any):
+        self.source = source
+        self.hasher = hasher
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.source.read(size)
+        self.hasher.update(data)
+        return data
@@ -0,0 +1,376 @@
+import heapq
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from .atomic import atomic_write
+
+# Binary path index layout (all integers are little endian u32 unless noted):
+#   header          magic, version, block size, path count, package count, names size, data size
+#   name offsets    package count + 1 offsets into the names blob, indexed by package id
+#   block offsets   block count + 1 offsets into the path data
+#   basename order  path ordinals sorted by file name (last path component)
+#   names           the concatenated utf-8 package names
+#   path data       the paths sorted by their bytes, front coded in blocks of block size entries.
+#                   Every entry is varint(shared prefix length), varint(suffix length), suffix,
+#                   varint(number of packages), varint(package id)...; the first entry of a block
+#                   is stored in full so every block can be decoded on its own.
+MAGIC = b"PKPI"
+VERSION = 1
+HEADER = struct.Struct("<4sIIIIII")
+U32 = struct.Struct("<I")
+BLOCK_SIZE = 16
+# Number of records sorted in memory before they are spilled to a temporary run file
+RUN_SIZE = 256 * 1024
+_SMALL_VARINTS = [bytes((value,)) for value in range(0x80)]
+
+
+def _little_endian(values: array) -> array:
+    # Offsets are written in bulk from arrays, which use the native byte order
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+def _varint(value: int) -> bytes:
+    if value < 0x80:
+        return _SMALL_VARINTS[value]
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _shared_prefix(first: bytes, second: bytes) -> int:
+    # Length of the common prefix, found by comparing slices instead of single bytes
+    low, high = 0, min(len(first), len(second))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if first[:middle] == second[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _read_varint(data, position: int) -> Tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+def _contents_records(
+    lines: Iterable[bytes], package_ids: Dict[bytes, int]
+) -> Iterator[bytes]:
+    # "path\0package field" records of every Contents line. Package ids are assigned
+    # in first seen order while the lines go by.
+    for line in lines:
+        head, _, field = line.rstrip().rpartition(b" ")
+        path = head.rstrip()
+        if not path or path == b"EMPTY_PACKAGE":
+            continue
+        for package in field.split(b","):
+            if package not in package_ids:
+                package_ids[package] = len(package_ids)
+        yield path + b"\0" + field
+
+
+def _sorted_records(records: Iterable[bytes], tmp_dir: str) -> Iterator[bytes]:
+    # External sort: runs of RUN_SIZE records are sorted in memory and merged from disk,
+    # so memory stays bounded whatever the size of the Contents file
+    runs = []
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= RUN_SIZE:
+            runs.append(_spill(sorted(batch), tmp_dir))
+            batch = []
+    batch.sort()
+    if not runs:
+        yield from batch
+        return
+    if batch:
+        runs.append(_spill(batch, tmp_dir))
+    del batch
+    files = [open(run, "rb") for run in runs]
+    try:
+        yield from heapq.merge(*((line[:-1] for line in f) for f in files))
+    finally:
+        for f in files:
+            f.close()
+
+
+def _spill(records: List[bytes], tmp_dir: str) -> str:
+    # Records never contain newlines, Contents files are line based
+    fd, run_path = tempfile.mkstemp(dir=tmp_dir, suffix=".run")
+    with os.fdopen(fd, "wb") as f:
+        f.write(b"\n".join(records) + b"\n")
+    return run_path
+
+
+def write_path_index(path: str, lines: Iterable[bytes]):
+    # Build the path index of the given (decompressed) Contents lines
+    package_ids = {}
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(path) or ".")
+    try:
+        block_offsets = array("I", [0])
+        count = 0
+        previous = b""
+        data_path = os.path.join(tmp_dir, "paths")
+        field_ids = {}
+        with open(data_path, "wb") as data:
+
+            def basenames() -> Iterator[bytes]:
+                # Writes the path data and yields "basename\0ordinal" records on the way
+                nonlocal count, previous
+                offset = 0
+                for record in _sorted_records(
+                    _contents_records(lines, package_ids), tmp_dir
+                ):
+                    file_path, _, field = record.partition(b"\0")
+                    ids = field_ids.get(field)
+                    if ids is None:
+                        ids = field_ids[field] = b"".join(
+                            _varint(package_ids[package])
+                            for package in field.split(b",")
+                        )
+                    shared = 0
+                    if count % BLOCK_SIZE:
+                        shared = _shared_prefix(previous, file_path)
+                    elif count:
+                        block_offsets.append(offset)
+                    suffix = file_path[shared:]
+                    entry = (
+                        _varint(shared)
+                        + _varint(len(suffix))
+                        + suffix
+                        + _varint(field.count(b",") + 1)
+                        + ids
+                    )
+                    data.write(entry)
+                    offset += len(entry)
+                    yield file_path.rpartition(b"/")[2] + b"\0%010d" % count
+                    previous = file_path
+                    count += 1
+                block_offsets.append(offset)
+
+            order_path = os.path.join(tmp_dir, "order")
+            with open(order_path, "wb") as order:
+                ordinals = array("I")
+                for record in _sorted_records(basenames(), tmp_dir):
+                    ordinals.append(int(record.rpartition(b"\0")[2]))
+                    if len(ordinals) >= RUN_SIZE:
+                        _little_endian(ordinals).tofile(order)
+                        del ordinals[:]
+                _little_endian(ordinals).tofile(order)
+            data_size = data.tell()
+        if count == 0:
+            block_offsets = array("I", [0])
+
+        names = sorted(package_ids, key=package_ids.__getitem__)
+        name_offsets = array("I", [0])
+        for name in names:
+            name_offsets.append(name_offsets[-1] + len(name))
+
+        with atomic_write(path) as f:
+            f.write(
+                HEADER.pack(
+                    MAGIC,
+                    VERSION,
+                    BLOCK_SIZE,
+                    count,
+                    len(names),
+                    name_offsets[-1],
+                    data_size,
+                )
+            )
+            f.write(_little_endian(name_offsets).tobytes())
+            f.write(_little_endian(block_offsets).tobytes())
+            with open(order_path, "rb") as order:
+                shutil.copyfileobj(order, f)
+            f.write(b"".join(names))
+            with open(data_path, "rb") as data:
+                shutil.copyfileobj(data, f)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def build_path_index(contents_path: str, index_path: str):
+    # Build the path index of a compressed Contents file on disk
+    import gzip
+
+    with gzip.open(contents_path, "rb") as f:
+        write_path_index(index_path, f)
+
+
+class PathIndex:
+    """
+    Read-only, memory mapped view of a path index. Exact and prefix lookups
+    binary search the first path of every block and decode a single block,
+    file name lookups binary search the basename order table.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (
+            magic,
+            version,
+            self.block_size,
+            self.count,
+            package_count,
+            names_size,
+            data_size,
+        ) = HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != VERSION:
+            self._map.close()
+            raise ValueError(f"{path} is not a path index file")
+        self.block_count = -(-self.count // self.block_size)
+        self._name_offsets_start = HEADER.size
+        self._block_offsets_start = (
+            self._name_offsets_start + (package_count + 1) * U32.size
+        )
+        self._order_start = (
+            self._block_offsets_start + (self.block_count + 1) * U32.size
+        )
+        self._names_start = self._order_start + self.count * U32.size
+        self._data_start = self._names_start + names_size
+        if len(self._map) != self._data_start + data_size:
+            self._map.close()
+            raise ValueError(f"{path} is truncated or corrupted")
+        self._packages = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def close(self):
+        self._map.close()
+
+    def _u32(self, start: int, index: int) -> int:
+        return U32.unpack_from(self._map, start + index * U32.size)[0]
+
+    def _package(self, package_id: int) -> str:
+        name = self._packages.get(package_id)
+        if name is None:
+            start, end = struct.unpack_from(
+                "<II", self._map, self._name_offsets_start + package_id * U32.size
+            )
+            name = self._packages[package_id] = self._map[
+                self._names_start + start : self._names_start + end
+            ].decode("utf-8")
+        return name
+
+    def _block(self, block: int) -> Iterator[Tuple[bytes, List[int]]]:
+        # Decode the (path, package ids) entries of a block
+        position = self._data_start + self._u32(self._block_offsets_start, block)
+        end = self._data_start + self._u32(self._block_offsets_start, block + 1)
+        data = self._map
+        path = b""
+        while position < end:
+            shared, position = _read_varint(data, position)
+            length, position = _read_varint(data, position)
+            path = path[:shared] + data[position : position + length]
+            position += length
+            package_count, position = _read_varint(data, position)
+            ids = []
+            for _ in range(package_count):
+                package_id, position = _read_varint(data, position)
+                ids.append(package_id)
+            yield path, ids
+
+    def _block_head(self, block: int) -> bytes:
+        # The first path of a block is stored in full
+        position = self._data_start + self._u32(self._block_offsets_start, block)
+        _, position = _read_varint(self._map, position)
+        length, position = _read_varint(self._map, position)
+        return self._map[position : position + length]
+
+    def _first_block(self, key: bytes) -> int:
+        # Last block whose first path is smaller than the key
+        low, high = 0, self.block_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._block_head(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return max(low - 1, 0)
+
+    def _entry(self, ordinal: int) -> Tuple[bytes, List[int]]:
+        for position, entry in enumerate(self._block(ordinal // self.block_size)):
+            if position == ordinal % self.block_size:
+                return entry
+
+    def _result(self, entry: Tuple[bytes, List[int]]) -> Tuple[str, List[str]]:
+        path, ids = entry
+        return (
+            path.decode("utf-8", errors="replace"),
+            [self._package(package_id) for package_id in ids],
+        )
+
+    def _scan(self, key: bytes) -> Iterator[Tuple[bytes, List[int]]]:
+        # Entries from the first path greater than or equal to the key onwards
+        for block in range(self._first_block(key), self.block_count):
+            for entry in self._block(block):
+                if entry[0] >= key:
+                    yield entry
+
+    def packages(self, path: str) -> List[str]:
+        # Packages shipping the given path, empty if no package does
+        key = path.lstrip("/").encode("utf-8")
+        packages = []
+        for entry in self._scan(key):
+            if entry[0] != key:
+                break
+            packages.extend(self._result(entry)[1])
+        return packages
+
+    def prefix(
+        self, prefix: str, limit: Optional[int] = None
+    ) -> Iterator[Tuple[str, List[str]]]:
+        # Every path starting with the prefix, in path order
+        key = prefix.lstrip("/").encode("utf-8")
+        for found, entry in enumerate(self._scan(key)):
+            if not entry[0].startswith(key) or found == limit:
+                break
+            yield self._result(entry)
+
+    def basename(
+        self, name: str, limit: Optional[int] = None
+    ) -> Iterator[Tuple[str, List[str]]]:
+        # Every path whose last component is the given file name
+        key = name.encode("utf-8")
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            path = self._entry(self._u32(self._order_start, middle))[0]
+            if path.rpartition(b"/")[2] < key:
+                low = middle + 1
+            else:
+                high = middle
+        for rank in range(low, self.count):
+            if rank - low == limit:
+                break
+            entry = self._entry(self._u32(self._order_start, rank))
+            if entry[0].rpartition(b"/")[2] != key:
+                break
+            yield self._result(entry)
@@ -0,0 +1,172 @@
+import re
+from typing import BinaryIO, List, Optional, Tuple
+from .release import parse_deb822, parse_hash_list
+
+# ed commands as written by diff --ed: "5a", "3,7c", "12d"
+ED_COMMAND = re.compile(rb"^(\d+)(?:,(\d+))?([acd])$")
+
+
+class PdiffError(Exception):
+    # Raised when a pdiff can't be applied, callers fall back to a full refresh
+    pass
+
+
+class PdiffIndex:
+    """
+    The Contents-<arch>.diff/Index file: the SHA256 of the current Contents
+    file, of the previous versions (history) and of the patches between them.
+    """
+
+    def __init__(self, text: str):
+        fields = parse_deb822(text)
+        current = fields.get("SHA256-Current", "").split()
+        if len(current) != 2:
+            raise PdiffError("The pdiff Index has no SHA256-Current field")
+        self.current_sha256, self.current_size = current[0], int(current[1])
+        self.history = parse_hash_list(fields.get("SHA256-History", ""))
+        self.patches = {
+            name: digest
+            for digest, _, name in parse_hash_list(fields.get("SHA256-Patches", ""))
+        }
+        self.downloads = {
+            name: digest
+            for digest, _, name in parse_hash_list(fields.get("SHA256-Download", ""))
+        }
+        # Merged patches go straight from a historical version to the current one
+        self.merged = fields.get("X-Patch-Precedence", "") == "merged"
+
+    def patches_from(self, sha256: str) -> Optional[List[str]]:
+        # Names of the patches to apply, in order, to go from the given version to the
+        # current one. None if the version is not in the history (broken chain).
+        if sha256 == self.current_sha256:
+            return []
+        for position, (digest, _, name) in enumerate(self.history):
+            if digest == sha256:
+                if self.merged:
+                    return [name]
+                return [patch for _, _, patch in self.history[position:]]
+        return None
+
+
+def parse_ed_script(script: bytes) -> List[Tuple[int, int, List[bytes]]]:
+    # Turn an ed script into (first line, last line, new lines) replacements, sorted by
+    # line number. Appending after line n replaces the empty range (n + 1, n).
+    operations = []
+    lines = script.split(b"\n")
+    if lines and lines[-1] == b"":
+        lines.pop()
+    position = 0
+    while position < len(lines):
+        match = ED_COMMAND.match(lines[position])
+        if match is None:
+            raise PdiffError(f"Unsupported ed command {lines[position]!r}")
+        position += 1
+        first = int(match.group(1))
+        last = int(match.group(2) or first)
+        command = match.group(3)
+        new_lines = []
+        if command in b"ac":
+            while position < len(lines) and lines[position] != b".":
+                new_lines.append(lines[position])
+                position += 1
+            if position == len(lines):
+                raise PdiffError("Unterminated ed text block")
+            position += 1
+        if command == b"a":
+            first, last = first + 1, first
+        operations.append((first, last, new_lines))
+    operations.sort(key=lambda operation: (operation[0], operation[1]))
+    # diff --ed writes commands bottom up, the line ranges must never overlap
+    for previous, following in zip(operations, operations[1:]):
+        if following[0] <= previous[1]:
+            raise PdiffError("Overlapping ed commands")
+    return operations
+
+
+class _LineCursor:
+    # Forward only view of a stream by line number, unchanged lines are copied in blocks
+    def __init__(self, source: BinaryIO, block_size: int):
+        self.source = source
+        self.block_size = block_size
+        self.buffer = b""
+        self.position = 0
+
+    def _fill(self) -> bool:
+        block = self.source.read(self.block_size)
+        if not block:
+            return False
+        self.buffer = self.buffer[self.position :] + block
+        self.position = 0
+        return True
+
+    def copy_lines(self, count: int, write):
+        while count > 0:
+            newlines = self.buffer.count(b"\n", self.position)
+            if newlines >= count:
+                end = self.position - 1
+                for _ in range(count):
+                    end = self.buffer.find(b"\n", end + 1)
+                write(self.buffer[self.position : end + 1])
+                self.position = end + 1
+                return
+            # The whole buffer is before the requested line
+            write(self.buffer[self.position :])
+            count -= newlines
+            self.buffer = b""
+            self.position = 0
+            if not self._fill():
+                raise PdiffError(
+                    "The ed script refers to lines past the end of the file"
+                )
+
+    def take_lines(self, count: int) -> List[bytes]:
+        lines = []
+        while len(lines) < count:
+            end = self.buffer.find(b"\n", self.position)
+            if end == -1:
+                if not self._fill():
+                    raise PdiffError(
+                        "The ed script refers to lines past the end of the file"
+                    )
+                continue
+            lines.append(self.buffer[self.position : end])
+            self.position = end + 1
+        return lines
+
+    def copy_rest(self, write):
+        write(self.buffer[self.position :])
+        while True:
+            block = self.source.read(self.block_size)
+            if not block:
+                break
+            write(block)
+
+
+def apply_ed_script(
+    source: BinaryIO,
+    operations: List[Tuple[int, int, List[bytes]]],
+    out_file: BinaryIO,
+    hasher,
+    block_size: int = 1024 * 1024,
+) -> Tuple[List[bytes], List[bytes]]:
+    # Stream the source to out_file while applying the replacements and hashing the
+    # result. Returns the removed and the added lines so counts can be adjusted.
+    removed = []
+    added = []
+
+    def write(data: bytes):
+        out_file.write(data)
+        hasher.update(data)
+
+    cursor = _LineCursor(source, block_size)
+    line = 1
+    for first, last, new_lines in operations:
+        cursor.copy_lines(first - line, write)
+        if last >= first:
+            removed.extend(cursor.take_lines(last - first + 1))
+        line = last + 1
+        if new_lines:
+            write(b"\n".join(new_lines) + b"\n")
+            added.extend(new_lines)
+    cursor.copy_rest(write)
+    return removed, added
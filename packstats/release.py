@@ -0,0 +1,145 @@
+import threading
+import time
+from typing import Dict, List, Tuple
+from urllib.parse import urljoin, urlparse
+
+# Timeout in seconds for the small index files (Release, pdiff Index)
+INDEX_TIMEOUT = 30
+
+# Release files fetched by this process: suite URL -> (fetch time, Release)
+_releases = {}
+_releases_lock = threading.Lock()
+
+
+def parse_deb822(text: str) -> Dict[str, str]:
+    # Parse a single deb822 paragraph (Release, InRelease, pdiff Index files).
+    # Continuation lines of multi line fields are kept as separate lines of the value.
+    fields = {}
+    field = None
+    for line in text.splitlines():
+        if line.startswith("-----BEGIN PGP SIGNATURE"):
+            break
+        if line.startswith("-----BEGIN PGP SIGNED MESSAGE") or line.startswith("Hash:"):
+            continue
+        if line.startswith((" ", "\t")) and field is not None:
+            fields[field] += "\n" + line.strip()
+        elif ":" in line:
+            field, value = line.split(":", 1)
+            fields[field] = value.strip()
+    return fields
+
+
+def parse_hash_list(value: str) -> List[Tuple[str, int, str]]:
+    # Parse the "<hash> <size> <name>" lines of a checksum field
+    entries = []
+    for line in value.splitlines():
+        parts = line.split()
+        if len(parts) == 3:
+            entries.append((parts[0], int(parts[1]), parts[2]))
+    return entries
+
+
+def suite_url(mirror_url: str) -> str:
+    # http://host/debian/dists/stable/main/ -> http://host/debian/dists/stable/
+    return urljoin(mirror_url.rstrip("/") + "/", "..")
+
+
+def component_name(mirror_url: str) -> str:
+    # http://host/debian/dists/stable/main/ -> main
+    return urlparse(mirror_url).path.rstrip("/").rsplit("/", 1)[-1]
+
+
+def suite_name(mirror_url: str) -> str:
+    # http://host/debian/dists/stable/main/ -> stable
+    return urlparse(suite_url(mirror_url)).path.rstrip("/").rsplit("/", 1)[-1]
+
+
+def branch_url(mirror_url: str, suite: str, component: str) -> str:
+    # URL of another suite and component of the same mirror
+    return urljoin(suite_url(mirror_url), f"../{suite}/{component}/")
+
+
+def branch_path(mirror_url: str) -> str:
+    # host/suite/component/, where the files of a mirror URL live in the data directory
+    return f"{urlparse(mirror_url).netloc}/{suite_name(mirror_url)}/{component_name(mirror_url)}/"
+
+
+class Release:
+    """
+    The Release file of a suite, listing its architectures, components and
+    the checksums of every index file (including the Contents files).
+    """
+
+    def __init__(self, text: str):
+        self.fields = parse_deb822(text)
+
+    def architectures(self) -> List[str]:
+        return self.fields.get("Architectures", "").split()
+
+    def components(self) -> List[str]:
+        return self.fields.get("Components", "").split()
+
+    def files(self, algorithm: str = "SHA256") -> Dict[str, Tuple[str, int]]:
+        return {
+            name: (digest, size)
+            for digest, size, name in parse_hash_list(self.fields.get(algorithm, ""))
+        }
+
+    def contents_entry(
+        self, mirror_url: str, arch: str, compressed: bool = True
+    ) -> Tuple[str, int]:
+        # SHA256 and size of the (compressed) Contents file of the given architecture
+        name = f"{component_name(mirror_url)}/Contents-{arch}"
+        if compressed:
+            name += ".gz"
+        return self.files().get(name, (None, None))
+
+
+def fetch_release(mirror_url: str) -> Release:
+    # Always fetched, the freshness checks need the current file. Falls back to the
+    # signed InRelease file on mirrors without a plain Release file.
+    from urllib.error import HTTPError
+    from urllib.request import urlopen
+
+    try:
+        with urlopen(
+            urljoin(suite_url(mirror_url), "Release"), timeout=INDEX_TIMEOUT
+        ) as response:
+            release = Release(response.read().decode("utf-8"))
+    except HTTPError as e:
+        if e.code != 404:
+            raise
+        with urlopen(
+            urljoin(suite_url(mirror_url), "InRelease"), timeout=INDEX_TIMEOUT
+        ) as response:
+            release = Release(response.read().decode("utf-8"))
+    remember_release(mirror_url, release)
+    return release
+
+
+def remember_release(mirror_url: str, release: Release):
+    # Keep a fetched Release file for cached_release
+    with _releases_lock:
+        _releases[suite_url(mirror_url)] = (time.time(), release)
+
+
+def cached_release(mirror_url: str, ttl: float) -> Release:
+    # The Release file of the suite, fetched at most once per ttl seconds by this process
+    # (every component of the suite shares it)
+    with _releases_lock:
+        fetched_at, release = _releases.get(suite_url(mirror_url), (0, None))
+    if release is not None and fetched_at + ttl > time.time():
+        return release
+    return fetch_release(mirror_url)
+
+
+def contents_archs(release: Release, mirror_url: str) -> List[str]:
+    # Architectures with a Contents file in the component of the mirror URL (including
+    # all and the udeb- ones), the Architectures field when no Contents file is listed
+    prefix = f"{component_name(mirror_url)}/Contents-"
+    archs = [
+        name[len(prefix) : -len(".gz")]
+        for name in release.files()
+        if name.startswith(prefix) and name.endswith(".gz")
+    ]
+    return archs or release.architectures()
@@ -0,0 +1,420 @@
+import hashlib
+import heapq
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+from .atomic import atomic_write
+from .connection import ConnectionPool
+from .utils import Logger
+
+# Size of the byte ranges the file is split into
+DEFAULT_SEGMENT_SIZE = 4 * 1024 * 1024
+# Bytes requested from every mirror to check range support and measure its throughput
+PROBE_SIZE = 64 * 1024
+# Block size used when reading a response
+READ_BLOCK_SIZE = 256 * 1024
+# Attempts per segment before giving up, every attempt may use another mirror
+MAX_SEGMENT_ATTEMPTS = 3
+# Failed requests after which a mirror is no longer used
+MAX_MIRROR_FAILURES = 3
+# Weight of the last segment in the throughput estimate of a mirror
+THROUGHPUT_SMOOTHING = 0.5
+
+
+class DownloadError(Exception):
+    pass
+
+
+class Mirror:
+    """
+    A mirror serving the file and its measured throughput in bytes per second,
+    updated after every segment it delivered.
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.throughput = 0.0
+        self.active = 0
+        self.failures = 0
+        self.ranges = False
+        self.size = None
+        self.headers = None
+
+    def record(self, size: int, seconds: float):
+        throughput = size / max(seconds, 1e-6)
+        if self.throughput:
+            throughput = (
+                THROUGHPUT_SMOOTHING * throughput
+                + (1 - THROUGHPUT_SMOOTHING) * self.throughput
+            )
+        self.throughput = throughput
+
+    @property
+    def usable(self) -> bool:
+        return self.ranges and self.failures < MAX_MIRROR_FAILURES
+
+
+def _content_range(value: Optional[str]) -> Tuple[int, int, Optional[int]]:
+    # "bytes 0-65535/1234567" -> (0, 65535, 1234567), the total may be "*"
+    try:
+        unit, _, spec = value.partition(" ")
+        span, _, total = spec.partition("/")
+        start, _, end = span.partition("-")
+        if unit != "bytes":
+            raise ValueError(value)
+        return int(start), int(end), None if total == "*" else int(total)
+    except (AttributeError, ValueError):
+        raise DownloadError(f"Invalid Content-Range header {value!r}") from None
+
+
+class SegmentedDownload:
+    """
+    Download of a single file as parallel byte range requests, spread over one
+    or more mirrors serving the same file. Every connection picks the mirror
+    with the best measured throughput per connection in use, so faster mirrors
+    serve more segments and failing ones are dropped.
+
+    Segments are written in place to path + ".part" and listed in a state file
+    once complete, an interrupted download resumes with the missing ones. The
+    SHA256 is computed while downloading: completed segments are hashed in
+    order, and connections never run more than a window of segments ahead of
+    the hashed prefix, which bounds the memory used to
+    window * segment_size. The file is only published at path when its
+    digest matches the expected one.
+    """
+
+    def __init__(
+        self,
+        urls: List[str],
+        path: str,
+        size: Optional[int] = None,
+        sha256: Optional[str] = None,
+        connections: int = 4,
+        segment_size: int = DEFAULT_SEGMENT_SIZE,
+        pool: Optional[ConnectionPool] = None,
+        logger: Optional[Logger] = None,
+    ):
+        if connections < 1:
+            raise ValueError("The number of connections should be greater than 0")
+        if segment_size < 1:
+            raise ValueError("The segment size should be greater than 0")
+        self.mirrors = [Mirror(url) for url in dict.fromkeys(urls)]
+        self.path = path
+        self.part_path = path + ".part"
+        self.state_path = path + ".part.json"
+        self.size = size
+        self.expected_sha256 = sha256
+        self.connections = connections
+        self.segment_size = segment_size
+        self.window = 2 * connections
+        self.pool = pool
+        self.logger = logger
+        # Response headers of the first mirror, used for the cache validators
+        self.headers = None
+
+        self._cond = threading.Condition()
+        self._state_lock = threading.Lock()
+        self._pending = []
+        self._attempts = {}
+        self._done = set()
+        self._buffers = {}
+        self._in_flight = 0
+        self._hashed = 0
+        self._sha256 = hashlib.sha256()
+        self._error = None
+        self._part = None
+
+    def _log(self, message: str):
+        if self.logger is not None:
+            self.logger.log_info(message)
+
+    def run(self) -> str:
+        # Download the file and return its SHA256
+        own_pool = self.pool is None
+        if own_pool:
+            self.pool = ConnectionPool(max_per_host=self.connections)
+        try:
+            self._probe()
+            if any(mirror.usable for mirror in self.mirrors):
+                return self._download_segments()
+            reachable = [
+                mirror for mirror in self.mirrors if mirror.headers is not None
+            ]
+            if not reachable:
+                raise DownloadError("None of the mirrors could be reached")
+            self._log("No mirror supports range requests, downloading in one piece")
+            return self._download_whole(reachable[0])
+        finally:
+            if own_pool:
+                self.pool.close()
+                self.pool = None
+
+    def _probe(self):
+        # Request the first bytes from every mirror at once: range support, size and a first
+        # throughput estimate including the latency of the mirror
+        with ThreadPoolExecutor(max_workers=len(self.mirrors)) as executor:
+            list(executor.map(self._probe_mirror, self.mirrors))
+        self.headers = self.mirrors[0].headers
+        if self.size is None:
+            sizes = [mirror.size for mirror in self.mirrors if mirror.usable]
+            self.size = sizes[0] if sizes else None
+        for mirror in self.mirrors:
+            if mirror.usable and mirror.size != self.size:
+                # Not in sync with the other mirrors
+                self._log(
+                    f"Not using {mirror.url}: {mirror.size} bytes instead of {self.size}"
+                )
+                mirror.ranges = False
+
+    def _probe_mirror(self, mirror: Mirror):
+        started = time.monotonic()
+        try:
+            with self.pool.request(
+                mirror.url, {"Range": f"bytes=0-{PROBE_SIZE - 1}"}
+            ) as response:
+                mirror.headers = response.headers
+                if response.status != 206:
+                    # The body is the whole file, the connection is closed without reading it
+                    self._log(f"{mirror.url} doesn't support range requests")
+                    return
+                start, end, total = _content_range(
+                    response.headers.get("Content-Range")
+                )
+                data = response.read()
+                if start != 0 or total is None or len(data) != end - start + 1:
+                    raise DownloadError("Unexpected probe response")
+        except Exception as e:
+            mirror.failures = MAX_MIRROR_FAILURES
+            self._log(f"Not using {mirror.url}: {e}")
+            return
+        mirror.ranges = True
+        mirror.size = total
+        mirror.record(len(data), time.monotonic() - started)
+        self._log(
+            f"{mirror.url}: {total} bytes, {mirror.throughput / 1e6:.2f} MB/s measured"
+        )
+
+    def _download_whole(self, mirror: Mirror) -> str:
+        sha256 = hashlib.sha256()
+        try:
+            with self.pool.request(mirror.url) as response, atomic_write(
+                self.path
+            ) as out_file:
+                self.headers = response.headers
+                while True:
+                    block = response.read(READ_BLOCK_SIZE)
+                    if not block:
+                        break
+                    sha256.update(block)
+                    out_file.write(block)
+                self._check_digest(sha256.hexdigest())
+        except DownloadError:
+            raise
+        except Exception as e:
+            raise DownloadError(f"Downloading {mirror.url} failed: {e}") from e
+        return sha256.hexdigest()
+
+    def _check_digest(self, digest: str):
+        if self.expected_sha256 is not None and digest != self.expected_sha256:
+            raise DownloadError(
+                f"SHA256 mismatch: expected {self.expected_sha256}, got {digest}"
+            )
+
+    def _segment(self, index: int) -> Tuple[int, int]:
+        start = index * self.segment_size
+        return start, min(start + self.segment_size, self.size) - 1
+
+    def _load_state(self, count: int):
+        # Segments completed by an interrupted download of the same file. Without the
+        # expected SHA256 another version of the file can't be told apart, nothing is reused.
+        try:
+            with open(self.state_path, "r") as f:
+                state = json.load(f)
+            resumable = (
+                self.expected_sha256 is not None
+                and state.get("sha256") == self.expected_sha256
+                and state.get("size") == self.size
+                and state.get("segment_size") == self.segment_size
+                and os.path.getsize(self.part_path) == self.size
+            )
+        except (OSError, ValueError):
+            resumable = False
+        if resumable:
+            self._done = {index for index in state["done"] if 0 <= index < count}
+            self._log(f"Resuming the download, {len(self._done)}/{count} segments done")
+            return
+        with open(self.part_path, "wb") as f:
+            f.truncate(self.size)
+
+    def _save_state(self):
+        with self._state_lock:
+            with self._cond:
+                done = sorted(self._done)
+            with atomic_write(self.state_path, "w") as f:
+                json.dump(
+                    {
+                        "sha256": self.expected_sha256,
+                        "size": self.size,
+                        "segment_size": self.segment_size,
+                        "done": done,
+                    },
+                    f,
+                )
+
+    def _remove_partial(self):
+        for path in (self.part_path, self.state_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _download_segments(self) -> str:
+        count = max(1, -(-self.size // self.segment_size))
+        self._load_state(count)
+        self._pending = [index for index in range(count) if index not in self._done]
+        heapq.heapify(self._pending)
+        self._log(
+            f"Downloading {self.size} bytes in {count} segments over {self.connections} connections"
+        )
+        with open(self.part_path, "rb") as part:
+            # Segments done by an earlier run are read back once to be hashed
+            self._part = part
+            with self._cond:
+                self._advance_hash()
+            threads = [
+                threading.Thread(target=self._worker, daemon=True)
+                for _ in range(min(self.connections, len(self._pending)))
+            ]
+            for thread in threads:
+                thread.start()
+            try:
+                for thread in threads:
+                    thread.join()
+            except BaseException:
+                # Interrupted, the completed segments are kept for the next run
+                with self._cond:
+                    self._error = DownloadError("Download interrupted")
+                    self._cond.notify_all()
+                raise
+        if self._error is not None:
+            raise self._error
+        digest = self._sha256.hexdigest()
+        try:
+            self._check_digest(digest)
+        except DownloadError:
+            # A corrupted segment can't be found, start over next time
+            self._remove_partial()
+            raise
+        with open(self.part_path, "rb+") as f:
+            os.fsync(f.fileno())
+        os.chmod(self.part_path, 0o644)
+        os.replace(self.part_path, self.path)
+        self._remove_partial()
+        for mirror in self.mirrors:
+            self._log(f"{mirror.url}: {mirror.throughput / 1e6:.2f} MB/s")
+        return digest
+
+    def _next_task(self) -> Optional[Tuple[int, Mirror]]:
+        # Called with the condition held, waits for a segment within the window and a mirror
+        while True:
+            if self._error is not None:
+                return None
+            if not self._pending and not self._in_flight:
+                return None
+            if self._pending and self._pending[0] < self._hashed + self.window:
+                mirrors = [mirror for mirror in self.mirrors if mirror.usable]
+                if not mirrors:
+                    self._error = DownloadError("No mirror left to download from")
+                    self._cond.notify_all()
+                    return None
+                mirror = max(
+                    mirrors, key=lambda mirror: mirror.throughput / (mirror.active + 1)
+                )
+                mirror.active += 1
+                self._in_flight += 1
+                return heapq.heappop(self._pending), mirror
+            self._cond.wait()
+
+    def _worker(self):
+        with open(self.part_path, "rb+") as out_file:
+            while True:
+                with self._cond:
+                    task = self._next_task()
+                if task is None:
+                    return
+                index, mirror = task
+                started = time.monotonic()
+                try:
+                    data = self._fetch(mirror, index)
+                    out_file.seek(index * self.segment_size)
+                    out_file.write(data)
+                    out_file.flush()
+                except Exception as e:
+                    self._failed(index, mirror, e)
+                    continue
+                self._completed(index, mirror, data, time.monotonic() - started)
+
+    def _fetch(self, mirror: Mirror, index: int) -> bytearray:
+        start, end = self._segment(index)
+        with self.pool.request(
+            mirror.url, {"Range": f"bytes={start}-{end}"}
+        ) as response:
+            if response.status != 206:
+                mirror.ranges = False
+                raise DownloadError(f"{mirror.url} stopped supporting range requests")
+            first, last, total = _content_range(response.headers.get("Content-Range"))
+            if (first, last) != (start, end) or total not in (None, self.size):
+                raise DownloadError(
+                    f"Requested bytes {start}-{end}/{self.size}, got {response.headers.get('Content-Range')}"
+                )
+            data = bytearray()
+            while True:
+                block = response.read(READ_BLOCK_SIZE)
+                if not block:
+                    break
+                data += block
+        if len(data) != end - start + 1:
+            raise DownloadError(
+                f"Short segment: {len(data)} of {end - start + 1} bytes"
+            )
+        return data
+
+    def _failed(self, index: int, mirror: Mirror, error: Exception):
+        self._log(f"Segment {index} from {mirror.url} failed: {error}")
+        with self._cond:
+            mirror.active -= 1
+            mirror.failures += 1
+            self._in_flight -= 1
+            self._attempts[index] = self._attempts.get(index, 0) + 1
+            if self._attempts[index] >= MAX_SEGMENT_ATTEMPTS:
+                self._error = DownloadError(
+                    f"Segment {index} failed {MAX_SEGMENT_ATTEMPTS} times, last error: {error}"
+                )
+            else:
+                heapq.heappush(self._pending, index)
+            self._cond.notify_all()
+
+    def _completed(self, index: int, mirror: Mirror, data: bytearray, seconds: float):
+        with self._cond:
+            mirror.active -= 1
+            mirror.record(len(data), seconds)
+            self._in_flight -= 1
+            self._done.add(index)
+            self._buffers[index] = data
+            self._advance_hash()
+            self._cond.notify_all()
+        self._save_state()
+
+    def _advance_hash(self):
+        # Hash the completed segments following the hashed prefix, called with the condition held
+        while self._hashed in self._done:
+            data = self._buffers.pop(self._hashed, None)
+            if data is None:
+                start, end = self._segment(self._hashed)
+                self._part.seek(start)
+                data = self._part.read(end - start + 1)
+            self._sha256.update(data)
+            self._hashed += 1
@@ -0,0 +1,328 @@
+import json
+import os
+import socket
+import stat
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingUnixStreamServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+from .metrics import metrics
+from .stats import PackageStatistics
+from .utils import ALL_AVAILABLE_ARCHS, ArchUtils, Config, Logger
+
+config = Config.instance()
+
+
+class StatsSnapshot:
+    """
+    Immutable in-memory copy of the statistics of one mirror and architecture.
+    The ranking is already sorted, so top-N queries are a slice and package
+    lookups a single dictionary access.
+    """
+
+    def __init__(self, ranking: List[Tuple[str, int]], signature: Tuple = ()):
+        self.ranking = ranking
+        self.signature = signature
+        self.counts = dict(ranking)
+        self.total_files = sum(self.counts.values())
+        self.loaded_at = time.time()
+
+    @staticmethod
+    def file_signature(package_stats: PackageStatistics) -> Tuple:
+        # Changes whenever the stats file is rewritten
+        stat = os.stat(package_stats.stats_file_path)
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    @classmethod
+    def load(cls, package_stats: PackageStatistics) -> "StatsSnapshot":
+        with package_stats._open_stats() as store:
+            ranking = list(store.items())
+        return cls(ranking, cls.file_signature(package_stats))
+
+    def top(self, n: int) -> List[Tuple[str, int]]:
+        return self.ranking[:n]
+
+
+class StatsService:
+    """
+    Keeps the statistics of the configured mirrors and architectures in memory and
+    refreshes them on a background thread. A refreshed snapshot replaces the old one
+    in a single assignment, so readers never wait for a download or a reparse.
+    """
+
+    LOG_FILE_PATH = config["DEFAULT_LOG_DIR_PATH"] + "packstats.log"
+
+    def __init__(
+        self,
+        mirror_urls: List[str],
+        archs: List[str],
+        refresh_interval: int = config["DEFAULT_SERVE_REFRESH_INTERVAL"],
+    ):
+        self.logger = Logger(StatsService.LOG_FILE_PATH)
+        self.refresh_interval = refresh_interval
+        self.targets = []
+        for mirror_url in mirror_urls:
+            mirror_archs = archs
+            if ALL_AVAILABLE_ARCHS in archs:
+                mirror_archs = sorted(set(ArchUtils(mirror_url).get_available_archs()))
+            for arch in mirror_archs:
+                self.targets.append(
+                    PackageStatistics(
+                        arch=arch,
+                        mirror_url=mirror_url,
+                        top_n=config["DEFAULT_TOP_N"],
+                        refresh=False,
+                        revalidate=True,
+                        logger=self.logger,
+                    )
+                )
+        self._snapshots = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _key(self, package_stats: PackageStatistics) -> Tuple[str, str, str, str]:
+        return (
+            package_stats.mirror_domain,
+            package_stats.suite,
+            package_stats.component,
+            package_stats.arch,
+        )
+
+    def load_cached(self):
+        # Serve whatever is already cached on disk right away
+        for package_stats in self.targets:
+            if package_stats.has_cached_stats():
+                self._snapshots[self._key(package_stats)] = StatsSnapshot.load(
+                    package_stats
+                )
+
+    def refresh(self, package_stats: PackageStatistics):
+        current = self._snapshots.get(self._key(package_stats))
+        try:
+            package_stats.update_stats()
+            if current is not None and current.signature == (
+                StatsSnapshot.file_signature(package_stats)
+            ):
+                # The statistics didn't change
+                return
+            snapshot = StatsSnapshot.load(package_stats)
+        except (Exception, SystemExit) as e:
+            # Keep serving the previous snapshot
+            self.logger.log_error(
+                f"Refreshing {package_stats.arch} on {package_stats.mirror_domain} failed: {e}"
+            )
+            return
+        # Swapping the reference is atomic, readers see either the old or the new snapshot
+        snapshots = dict(self._snapshots)
+        snapshots[self._key(package_stats)] = snapshot
+        self._snapshots = snapshots
+        self.logger.log_info(
+            f"Loaded {len(snapshot.counts)} packages for {package_stats.arch} on {package_stats.mirror_domain}"
+        )
+
+    def refresh_all(self):
+        for package_stats in self.targets:
+            self.refresh(package_stats)
+
+    def _refresh_loop(self):
+        while not self._stop.is_set():
+            self.refresh_all()
+            self._stop.wait(self.refresh_interval)
+
+    def start(self):
+        self.load_cached()
+        self._thread = threading.Thread(target=self._refresh_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def snapshot(
+        self,
+        arch: str,
+        mirror_domain: Optional[str] = None,
+        suite: Optional[str] = None,
+        component: Optional[str] = None,
+    ) -> Optional[StatsSnapshot]:
+        # The first loaded snapshot matching the given filters
+        snapshots = self._snapshots
+        for key, snapshot in snapshots.items():
+            if key[3] == arch and all(
+                wanted in (None, value)
+                for wanted, value in zip((mirror_domain, suite, component), key)
+            ):
+                return snapshot
+        return None
+
+    def describe(self) -> List[Dict]:
+        snapshots = self._snapshots
+        return [
+            {
+                "mirror": domain,
+                "suite": suite,
+                "component": component,
+                "arch": arch,
+                "packages": len(snapshot.counts),
+                "files": snapshot.total_files,
+                "loaded_at": snapshot.loaded_at,
+            }
+            for (domain, suite, component, arch), snapshot in sorted(snapshots.items())
+        ]
+
+
+class StatsRequestHandler(BaseHTTPRequestHandler):
+    """
+    JSON API:
+        GET /archs                              loaded mirrors and architectures
+        GET /top?arch=amd64&n=10[&mirror=host]  top packages of an architecture
+        GET /package?arch=amd64&name=sec/pkg    number of files of one package
+        /top and /package also take suite and component when several are served
+        GET /metrics                            stage metrics, Prometheus text format
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        service = self.server.service
+        if url.path == "/archs":
+            return self._send(200, service.describe())
+        if url.path == "/metrics":
+            return self._send_text(metrics.to_prometheus())
+
+        if url.path not in ("/top", "/package"):
+            return self._send(404, {"error": f"Unknown endpoint {url.path}"})
+        arch = params.get("arch")
+        if not arch:
+            return self._send(400, {"error": "arch is required"})
+        snapshot = service.snapshot(
+            arch, params.get("mirror"), params.get("suite"), params.get("component")
+        )
+        if snapshot is None:
+            return self._send(404, {"error": f"No statistics loaded for {arch}"})
+
+        if url.path == "/top":
+            try:
+                n = int(params.get("n", config["DEFAULT_TOP_N"]))
+            except ValueError:
+                n = 0
+            if n < 1:
+                return self._send(400, {"error": "n should be greater than 0"})
+            return self._send(
+                200,
+                {
+                    "arch": arch,
+                    "packages": [
+                        {"package": package, "files": files}
+                        for package, files in snapshot.top(n)
+                    ],
+                },
+            )
+        name = params.get("name")
+        if not name:
+            return self._send(400, {"error": "name is required"})
+        files = snapshot.counts.get(name)
+        if files is None:
+            return self._send(404, {"error": f"Package {name} not found"})
+        return self._send(200, {"arch": arch, "package": name, "files": files})
+
+    def _send(self, status: int, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_text(self, text: str):
+        data = text.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self) -> str:
+        # Unix socket clients have no address
+        return str(self.client_address[0]) if self.client_address else "unix"
+
+    def log_message(self, format: str, *args):
+        self.server.service.logger.log_debug(format % args)
+
+
+class StatsHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service: StatsService):
+        self.service = service
+        super().__init__(address, StatsRequestHandler)
+
+
+class StatsUnixServer(ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, service: StatsService):
+        self.service = service
+        self._bound = False
+        super().__init__(socket_path, StatsRequestHandler)
+
+    def server_bind(self):
+        # A socket left behind by a daemon that was killed makes bind() fail, remove it
+        # unless another daemon still answers on it
+        try:
+            is_socket = stat.S_ISSOCK(os.lstat(self.server_address).st_mode)
+        except FileNotFoundError:
+            is_socket = False
+        if is_socket:
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.server_address)
+            except ConnectionRefusedError:
+                os.remove(self.server_address)
+            else:
+                raise OSError(f"{self.server_address} is used by a running server")
+            finally:
+                probe.close()
+        super().server_bind()
+        self._bound = True
+
+    def server_close(self):
+        super().server_close()
+        # Only remove the socket this server created
+        if self._bound:
+            self._bound = False
+            try:
+                os.remove(self.server_address)
+            except FileNotFoundError:
+                pass
+
+
+def serve(
+    service: StatsService,
+    host: str = config["DEFAULT_SERVE_HOST"],
+    port: int = config["DEFAULT_SERVE_PORT"],
+    socket_path: Optional[str] = None,
+):
+    # Run the API until interrupted, on a Unix socket if a path is given. The stages of
+    # the background refreshes are measured for /metrics.
+    metrics.enable()
+    if socket_path:
+        server = StatsUnixServer(socket_path, service)
+        print(f"Serving package statistics on {socket_path}")
+    else:
+        server = StatsHTTPServer((host, port), service)
+        print(f"Serving package statistics on http://{host}:{server.server_port}/")
+    # Only refresh once the address could be bound
+    service.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
@@ -0,0 +1,101 @@
+import heapq
+from typing import Dict, List, Tuple
+
+
+class SpaceSaving:
+    """
+    Space-Saving heavy hitters sketch keeping at most `capacity` counters.
+    Every reported count overestimates the true one by at most its error,
+    and no error is larger than total / capacity. Sketches of separate parts
+    of a stream (worker chunks, architectures) can be merged with the same
+    guarantee over the combined stream.
+    """
+
+    def __init__(self, capacity: int):
+        if capacity < 1:
+            raise ValueError("The sketch capacity should be greater than 0")
+        self.capacity = capacity
+        self.total = 0
+        self.counts = {}
+        self.errors = {}
+        # Min-heap of (count, item), entries left behind by increments are skipped lazily
+        self._heap = []
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def _push(self, item: str, count: int):
+        heapq.heappush(self._heap, (count, item))
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(count, item) for item, count in self.counts.items()]
+            heapq.heapify(self._heap)
+
+    def _pop_minimum(self) -> Tuple[int, str]:
+        while True:
+            count, item = heapq.heappop(self._heap)
+            if self.counts.get(item) == count:
+                return count, item
+
+    def minimum(self) -> int:
+        # Smallest monitored count once the sketch is full, an upper bound for any item
+        # that isn't monitored. 0 while there is room left.
+        if len(self.counts) < self.capacity:
+            return 0
+        while self.counts.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0]
+
+    def update(self, item: str, weight: int = 1):
+        self.total += weight
+        counts = self.counts
+        if item in counts:
+            counts[item] += weight
+        elif len(counts) < self.capacity:
+            counts[item] = weight
+            self.errors[item] = 0
+        else:
+            # Replace the smallest counter, the new item inherits its count as error
+            minimum, victim = self._pop_minimum()
+            del counts[victim]
+            del self.errors[victim]
+            counts[item] = minimum + weight
+            self.errors[item] = minimum
+        self._push(item, counts[item])
+
+    def update_counts(self, counts: Dict[str, int]):
+        # Add exact partial counts, e.g. the packages of one block of the Contents file
+        for item, weight in counts.items():
+            self.update(item, weight)
+
+    def merge(self, other: "SpaceSaving") -> "SpaceSaving":
+        # Items missing from one sketch may have been counted up to its minimum there
+        first_minimum, second_minimum = self.minimum(), other.minimum()
+        merged = SpaceSaving(max(self.capacity, other.capacity))
+        candidates = []
+        for item in self.counts.keys() | other.counts.keys():
+            candidates.append(
+                (
+                    self.counts.get(item, first_minimum)
+                    + other.counts.get(item, second_minimum),
+                    self.errors.get(item, first_minimum)
+                    + other.errors.get(item, second_minimum),
+                    item,
+                )
+            )
+        candidates.sort(key=lambda candidate: (-candidate[0], candidate[2]))
+        for count, error, item in candidates[: merged.capacity]:
+            merged.counts[item] = count
+            merged.errors[item] = error
+        merged._heap = [(count, item) for item, count in merged.counts.items()]
+        heapq.heapify(merged._heap)
+        merged.total = self.total + other.total
+        return merged
+
+    def error_bound(self) -> int:
+        # No count is more than this above the true count
+        return self.total // self.capacity
+
+    def top(self, n: int) -> List[Tuple[str, int, int]]:
+        # (item, count, error) of the n largest counters, the true count is in [count - error, count]
+        ranked = sorted(self.counts.items(), key=lambda entry: (-entry[1], entry[0]))
+        return [(item, count, self.errors[item]) for item, count in ranked[:n]]
@@ -1,54 +1,144 @@
 import sys
 import os
-import gzip
 import json
-import shutil
-from typing import List
+import time
+from typing import TYPE_CHECKING, List, Optional
 from urllib.parse import urlparse
-from urllib.request import urlopen
+from collections import Counter
+from .atomic import FileLock, atomic_write
+from .metrics import metrics
+from .release import Release, branch_path, branch_url, component_name, suite_name
+from .store import open_stats_store, write_stats_store
 from .utils import ArchUtils, Config
 from .utils import Logger
 
+# Modules only needed to download and parse Contents files are imported in the
+# methods using them, so that queries answered from the cache start as fast as possible
+if TYPE_CHECKING:
+    from .connection import ConnectionPool
+    from .pdiff import PdiffIndex
+    from .sketch import SpaceSaving
+
 config = Config.instance()
 
+# Block size used when copying the Contents file to disk
+COPY_BLOCK_SIZE = 1024 * 1024
+
 
 class PackageStatistics:
 
     DEFAULT_DATA_DIR_PATH = config["DEFAULT_DATA_DIR_PATH"]
     LOG_FILE_PATH = config["DEFAULT_LOG_DIR_PATH"] + "packstats.log"
+    # Contents files smaller than this are always parsed on a single core
+    PARALLEL_MIN_SIZE = config["DEFAULT_PARALLEL_MIN_SIZE"]
 
-    def __init__(self, arch: str, mirror_url: str, top_n: int, refresh: bool):
-        self.logger = Logger(PackageStatistics.LOG_FILE_PATH)
+    def __init__(
+        self,
+        arch: str,
+        mirror_url: str,
+        top_n: int,
+        refresh: bool,
+        workers: int = config["DEFAULT_WORKERS"],
+        stream: bool = config["DEFAULT_STREAM"],
+        keep_contents: bool = config["DEFAULT_KEEP_CONTENTS"],
+        revalidate: bool = config["DEFAULT_REVALIDATE"],
+        incremental: bool = config["DEFAULT_INCREMENTAL"],
+        path_index: bool = config["DEFAULT_PATH_INDEX"],
+        breakdowns: Optional[List[str]] = None,
+        segments: int = config["DEFAULT_SEGMENTS"],
+        extra_mirrors: Optional[List[str]] = None,
+        history: bool = config["DEFAULT_HISTORY"],
+        offline: bool = False,
+        validate: bool = True,
+        logger: Optional[Logger] = None,
+        http_pool: Optional["ConnectionPool"] = None,
+    ):
+        # Batch runs share one logger and connection pool and validate the mirror only once
+        self.logger = logger or Logger(PackageStatistics.LOG_FILE_PATH)
+        self.http_pool = http_pool
         self.arch = arch
         self.mirror_url = mirror_url
         self.top_packs_count = top_n
         self.refresh = refresh
+        self.workers = workers
+        self.stream = stream
+        # Incremental updates patch the cached Contents file and the path index is built
+        # from it, so it has to be kept
+        self.keep_contents = keep_contents or incremental or path_index
+        self.revalidate = revalidate
+        self.incremental = incremental
+        self.path_index = path_index
+        # Names of the aggregators run while parsing, see packstats.aggregate
+        self.breakdown_names = list(
+            config["DEFAULT_BREAKDOWNS"] if breakdowns is None else breakdowns
+        )
+        self.aggregators = None
+        # Parallel range requests per download, spread over the mirror and the extra mirrors
+        self.segments = segments
+        self.extra_mirrors = list(
+            config["DEFAULT_EXTRA_MIRRORS"] if extra_mirrors is None else extra_mirrors
+        )
+        # Record every refresh in the history database, see packstats.history
+        self.history = history
+        self.offline = offline
+        # HTTP validators and SHA256 of the last downloaded Contents file
+        self.contents_meta = None
+        # SHA256 of the decompressed Contents file, used to find it in the pdiff history
+        self.uncompressed_sha256 = None
 
         self.logger.log_info(
             "Initializing PackageStatistics object with the following parameters:"
         )
         self.logger.log_info(
-            f"Architecture: {self.arch}\tMirror URL: {self.mirror_url}\tTop N packages: {self.top_packs_count}\tRefresh: {self.refresh}"
+            f"Architecture: {self.arch}\tMirror URL: {self.mirror_url}\tTop N packages: {self.top_packs_count}\tRefresh: {self.refresh}\tWorkers: {self.workers}\tStream: {self.stream}\tKeep Contents: {self.keep_contents}\tRevalidate: {self.revalidate}\tIncremental: {self.incremental}\tPath Index: {self.path_index}\tBreakdowns: {self.breakdown_names}\tSegments: {self.segments}\tExtra Mirrors: {self.extra_mirrors}\tHistory: {self.history}\tOffline: {self.offline}"
         )
 
-        # Validate Input (top_n,mirror_url)
+        # Validate Input (top_n)
         self.logger.log_info("Validating input")
         self.check_input_sanity()
-        self.validate_mirror_url()
 
         # Extract the mirror domain as differnt mirriors can support different architectures
         self.mirror_domain = self._get_mirror_domain()
 
-        # Validate architecture
-        ArchUtils(self.mirror_url).validate_and_create_archs(self.arch)
+        # Suites and components of a mirror are cached side by side
+        self.suite = suite_name(self.mirror_url)
+        self.component = component_name(self.mirror_url)
 
         # Files paths
         self.contents_dir_path = (
             PackageStatistics.DEFAULT_DATA_DIR_PATH
-            + f"{self.mirror_domain}/{self.arch}/"
+            + branch_path(self.mirror_url)
+            + f"{self.arch}/"
         )
         self.contents_file_path = self.contents_dir_path + "/Contents.gz"
-        self.stats_file_path = self.contents_dir_path + "/packages_stats.json"
+        self.stats_file_path = self.contents_dir_path + "/packages_stats.bin"
+        # Stats cache written by older versions, migrated on first use
+        self.legacy_stats_file_path = self.contents_dir_path + "/packages_stats.json"
+        self.meta_file_path = self.contents_dir_path + "/contents_meta.json"
+        self.path_index_file_path = self.contents_dir_path + "/paths.idx"
+        self.breakdowns_file_path = self.contents_dir_path + "/breakdowns.json"
+        # Shared by every mirror and architecture
+        self.history_file_path = (
+            PackageStatistics.DEFAULT_DATA_DIR_PATH + "history.sqlite"
+        )
+        # Held while the files of this mirror and architecture are being rewritten
+        self.lock_file_path = self.contents_dir_path + "/refresh.lock"
+        self._migrate_unkeyed_cache()
+
+        # The mirror URL and architecture are only validated when the cached stats can't
+        # answer the query, cached queries don't touch the network at all
+        self.validated = not validate
+        if self.offline:
+            if self.refresh or not self.has_cached_stats():
+                print(
+                    "No cached statistics for this mirror and architecture, run without --offline first"
+                )
+                self.logger.log_error(
+                    f"No cached statistics in {self.contents_dir_path} for an offline query"
+                )
+                sys.exit(1)
+        elif self.refresh or not self.has_cached_stats():
+            self.validate()
 
     def _get_mirror_domain(self) -> str:
         # Extract the mirror domain as differnt mirriors can support different architectures
@@ -66,6 +156,45 @@ class PackageStatistics:
             )
             sys.exit(1)
 
+    def _migrate_unkeyed_cache(self):
+        # Older versions cached a single suite and component per mirror in
+        # <mirror>/<arch>/, move that cache here if it was downloaded from this URL
+        old_dir_path = (
+            PackageStatistics.DEFAULT_DATA_DIR_PATH
+            + f"{self.mirror_domain}/{self.arch}"
+        )
+        if os.path.exists(self.contents_dir_path) or not os.path.isdir(old_dir_path):
+            return
+        try:
+            try:
+                with open(old_dir_path + "/contents_meta.json", "r") as f:
+                    cached_url = json.load(f).get("url")
+            except FileNotFoundError:
+                # The first versions didn't record where the Contents file came from,
+                # their cache belongs to the suite and component of the default mirror
+                cached_url = (
+                    branch_url(
+                        self.mirror_url,
+                        suite_name(config["DEFAULT_MIRROR_URL"]),
+                        component_name(config["DEFAULT_MIRROR_URL"]),
+                    )
+                    + f"Contents-{self.arch}.gz"
+                )
+            if cached_url != self.contents_url():
+                return
+            os.makedirs(
+                os.path.dirname(self.contents_dir_path.rstrip("/")), exist_ok=True
+            )
+            os.rename(old_dir_path, self.contents_dir_path)
+            self.logger.log_info(
+                f"Moved the cached statistics from {old_dir_path} to {self.contents_dir_path}"
+            )
+        except (OSError, ValueError) as e:
+            # Refreshed from scratch instead
+            self.logger.log_warning(
+                f"Could not migrate the cache in {old_dir_path}: {e}"
+            )
+
     def check_input_sanity(self):
         if self.top_packs_count < 1:
             print("The number of packages to be shown should be greater than 0")
@@ -73,12 +202,52 @@ class PackageStatistics:
                 f"The number of packages to be shown should be greater than 0. User input: {self.top_packs_count,}",
             )
             sys.exit(1)
+        if self.workers < 1:
+            print("The number of workers should be greater than 0")
+            self.logger.log_error(
+                f"The number of workers should be greater than 0. User input: {self.workers}",
+            )
+            sys.exit(1)
+        if self.segments < 1:
+            print("The number of segments should be greater than 0")
+            self.logger.log_error(
+                f"The number of segments should be greater than 0. User input: {self.segments}",
+            )
+            sys.exit(1)
+        from .aggregate import AGGREGATORS
+
+        unknown = [name for name in self.breakdown_names if name not in AGGREGATORS]
+        if unknown:
+            print(
+                f"Unknown breakdowns {', '.join(unknown)}, available: {', '.join(AGGREGATORS)}"
+            )
+            self.logger.log_error(f"Unknown breakdowns. User input: {unknown}")
+            sys.exit(1)
+
+    def validate(self):
+        # Validate the mirror URL and the architecture once, before anything is downloaded
+        if self.validated:
+            return
+        with metrics.stage("validate", **self._labels()):
+            self.validate_mirror_url()
+            ArchUtils(self.mirror_url).validate_and_create_archs(self.arch)
+        self.validated = True
+
+    def _labels(self) -> dict:
+        # Labels of the metrics of this mirror and architecture
+        return {
+            "mirror": self.mirror_domain,
+            "suite": self.suite,
+            "component": self.component,
+            "arch": self.arch,
+        }
 
     def validate_mirror_url(self):
+        # A mirror is valid if it lists its architectures, the validation of the
+        # architecture then reuses them without another request
         self.logger.log_info(f"Validating mirror URL {self.mirror_url}")
         try:
-            with urlopen(self.mirror_url) as response:
-                response.read()
+            ArchUtils(self.mirror_url).load_available_archs()
             self.logger.log_info("Mirror URL is valid")
         except Exception as e:
             print(
@@ -88,7 +257,9 @@ class PackageStatistics:
             sys.exit(1)
 
     def download_contents_file(self):
-        contents_url = self.mirror_url + f"Contents-{self.arch}.gz"
+        import hashlib
+
+        contents_url = self.contents_url()
 
         contents_dir_path = self.contents_dir_path
         if not os.path.exists(contents_dir_path):
@@ -96,77 +267,734 @@ class PackageStatistics:
 
         contents_file_path = self.contents_file_path
         try:
-            with urlopen(contents_url) as response, open(
-                contents_file_path, "wb"
-            ) as out_file:
-                shutil.copyfileobj(response, out_file)
+            sha256 = hashlib.sha256()
+            with metrics.stage("download", **self._labels()) as stage, self._open_url(
+                contents_url
+            ) as response, atomic_write(contents_file_path) as out_file:
+                # Hash while copying so the digest doesn't need a second pass over the file
+                while True:
+                    block = response.read(COPY_BLOCK_SIZE)
+                    if not block:
+                        break
+                    sha256.update(block)
+                    out_file.write(block)
+                    stage.bytes += len(block)
+                self._set_contents_meta(response.headers, sha256.hexdigest())
         except Exception as e:
             print(f"An error occurred while trying to download the Contents file: {e} ")
             sys.exit(1)
 
+    def download_contents_file_segmented(self):
+        # Download the Contents file as parallel byte ranges from the mirror and the extra
+        # mirrors, checked against the SHA256 of the Release file
+        from .release import fetch_release
+        from .segmented import DownloadError, SegmentedDownload
+
+        os.makedirs(self.contents_dir_path, exist_ok=True)
+        sha256, size = None, None
+        try:
+            sha256, size = fetch_release(self.mirror_url).contents_entry(
+                self.mirror_url, self.arch
+            )
+        except Exception as e:
+            self.logger.log_warning(f"Could not fetch the Release file: {e}")
+        if sha256 is None:
+            self.logger.log_warning(
+                "The Contents file isn't listed in the Release file, it can't be verified"
+            )
+        download = SegmentedDownload(
+            [self.contents_url()]
+            + [
+                mirror_url.rstrip("/") + f"/Contents-{self.arch}.gz"
+                for mirror_url in self.extra_mirrors
+            ],
+            self.contents_file_path,
+            size=size,
+            sha256=sha256,
+            connections=self.segments,
+            segment_size=config["DEFAULT_SEGMENT_SIZE"],
+            pool=self.http_pool,
+            logger=self.logger,
+        )
+        try:
+            with metrics.stage("download", **self._labels()) as stage:
+                digest = download.run()
+                stage.bytes = download.size or 0
+        except DownloadError as e:
+            print(f"An error occurred while trying to download the Contents file: {e} ")
+            self.logger.log_error(
+                f"An error occurred while trying to download the Contents file: {e}"
+            )
+            sys.exit(1)
+        self._set_contents_meta(download.headers or {}, digest)
+
+    def download_and_parse_contents_file(self):
+        # Decompress and count the packages while the Contents file is still downloading.
+        # The raw archive is only written to disk when keep_contents is set.
+        try:
+            with self._open_url(self.contents_url()) as response:
+                package_dict = self.stream_contents(response)
+        except Exception as e:
+            print(
+                f"An error occurred while trying to download and parse the Contents file: {e} "
+            )
+            self.logger.log_error(
+                f"An error occurred while trying to download and parse the Contents file: {e}"
+            )
+            sys.exit(1)
+        self._save_stats(package_dict)
+
+    def stream_contents(self, response) -> dict:
+        # Count the packages of a Contents file response (a file object with headers) as
+        # it arrives, shared with the async API which hands in a bridge to its own stream
+        import gzip
+        import hashlib
+        from contextlib import ExitStack, closing
+        from .parser import PrefetchReader
+
+        os.makedirs(self.contents_dir_path, exist_ok=True)
+        with ExitStack() as stack:
+            out_file = None
+            if self.keep_contents:
+                # Only published once the whole file was downloaded
+                out_file = stack.enter_context(atomic_write(self.contents_file_path))
+            elif os.path.exists(self.contents_file_path):
+                # Left over from an earlier run, it would no longer match the stats
+                os.remove(self.contents_file_path)
+            # Overlaps with the decompress and parse stages
+            stage = stack.enter_context(metrics.stage("download", **self._labels()))
+            size = int(response.headers.get("Content-Length") or 0)
+            sha256 = hashlib.sha256()
+            # Stopped before the kept file is closed if the parser fails midway
+            reader = stack.enter_context(
+                closing(PrefetchReader(response, copy_to=out_file, hasher=sha256))
+            )
+            with gzip.GzipFile(fileobj=reader) as buffer:
+                package_dict = self._count_packages(buffer, size)
+            stage.bytes = reader.bytes_read
+            self._set_contents_meta(response.headers, sha256.hexdigest())
+        return package_dict
+
+    def _open_url(self, url: str, headers: Optional[dict] = None):
+        # Use the shared connection pool when there is one, urllib otherwise
+        if self.http_pool is not None:
+            return self.http_pool.request(url, headers)
+        from urllib.request import Request, urlopen
+
+        return urlopen(Request(url, headers=headers or {}))
+
+    def contents_url(self) -> str:
+        return self.mirror_url + f"Contents-{self.arch}.gz"
+
+    def _set_contents_meta(self, headers, sha256: str):
+        self.contents_meta = {
+            "url": self.contents_url(),
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "sha256": sha256,
+        }
+
+    def _load_contents_meta(self) -> dict:
+        try:
+            with open(self.meta_file_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def is_cache_fresh(self) -> bool:
+        # Cheap freshness check of the cached stats: first against the SHA256 listed in the
+        # suite's Release file, then with a conditional request for the Contents file itself
+        from urllib.error import HTTPError
+        from .release import fetch_release
+
+        meta = self._load_contents_meta()
+        if meta.get("url") != self.contents_url():
+            self.logger.log_info("No validators for the cached Contents file")
+            return False
+        try:
+            release = fetch_release(self.mirror_url)
+        except Exception as e:
+            self.logger.log_warning(f"Could not fetch the Release file: {e}")
+            release = None
+        if release is not None:
+            fresh = self.release_freshness(release, meta)
+            if fresh is not None:
+                return fresh
+
+        headers = self.conditional_headers(meta)
+        if not headers:
+            return False
+        try:
+            with self._open_url(self.contents_url(), headers):
+                self.logger.log_info(
+                    "The Contents file changed since the last download"
+                )
+                return False
+        except HTTPError as e:
+            if e.code == 304:
+                self.logger.log_info("The Contents file is not modified")
+                return True
+            self.logger.log_warning(f"Conditional request failed: {e}")
+        except Exception as e:
+            self.logger.log_warning(f"Conditional request failed: {e}")
+        # Keep serving the cached stats when the mirror can't be reached
+        self.logger.log_warning(
+            "Could not revalidate the cached statistics, using them anyway"
+        )
+        return True
+
+    def release_freshness(self, release: "Release", meta: dict) -> Optional[bool]:
+        # Compare the cached Contents file with the SHA256 listed in the Release file,
+        # None when either side doesn't know it
+        release_sha256, _ = release.contents_entry(self.mirror_url, self.arch)
+        cached_sha256 = meta.get("sha256")
+        if cached_sha256 is None:
+            # Contents files patched from pdiffs are only known by their uncompressed digest
+            release_sha256, _ = release.contents_entry(
+                self.mirror_url, self.arch, compressed=False
+            )
+            cached_sha256 = meta.get("uncompressed_sha256")
+        if release_sha256 is None or cached_sha256 is None:
+            return None
+        fresh = release_sha256 == cached_sha256
+        self.logger.log_info(
+            f"Release file SHA256 {release_sha256}, cached {cached_sha256}, fresh: {fresh}"
+        )
+        return fresh
+
+    def conditional_headers(self, meta: dict) -> dict:
+        # Headers of a conditional request for the cached Contents file
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
     def parse_contents_file(self):
         # Parse the Contents file and return a dictionary with the package name as the key and the number of files associated with the package as the value
-        package_dict = {}
+        import gzip
+
         with gzip.open(self.contents_file_path, "rb") as buffer:
-            for line in buffer:
-                line = line.decode("utf-8").strip()
-                if line == "":
-                    continue
-                # Split the line into file name and packages
-                file_name, packages = line.rsplit(" ", maxsplit=1)
-                packages = packages.split(",")
-                # For every package in the packages list for a given file add a counter to the dictionary entry for that package
-                for package in packages:
-                    if file_name != "EMPTY_PACKAGE":
-                        if package not in package_dict:
-                            package_dict[package] = 1
-                        else:
-                            package_dict[package] = package_dict[package] + 1
-        # Save the dictionary to a json file
-        with open(self.stats_file_path, "w+") as f:
-            json.dump(package_dict, f)
+            package_dict = self._count_packages(
+                buffer, os.path.getsize(self.contents_file_path)
+            )
+        self._save_stats(package_dict)
 
-    def sort_and_return_top_packages(self):
+    def _count_packages(self, buffer, size: int) -> dict:
+        import hashlib
+        from .parser import HashingReader
+
+        if self.incremental:
+            sha256 = hashlib.sha256()
+            package_dict = self._count_packages_in(HashingReader(buffer, sha256), size)
+            self.uncompressed_sha256 = sha256.hexdigest()
+            return package_dict
+        return self._count_packages_in(buffer, size)
+
+    def _count_packages_in(self, buffer, size: int) -> dict:
+        # Spawning worker processes only pays off for large Contents files.
+        # The breakdowns are computed in the same pass.
+        from .aggregate import make_aggregators
+        from .parser import count_stream, parse_stream_parallel
+
+        self.aggregators = (
+            make_aggregators(self.breakdown_names) if self.breakdown_names else None
+        )
+        # The time spent reading the decompressed stream is the decompress stage (and the
+        # network when streaming), the rest of the pass is the parse stage
+        started = time.perf_counter()
+        reader = metrics.reader(buffer)
+        if self.workers > 1 and size >= self.PARALLEL_MIN_SIZE:
+            self.logger.log_info(
+                f"Parsing the Contents file with {self.workers} worker processes"
+            )
+            package_dict = parse_stream_parallel(
+                reader, self.workers, aggregators=self.aggregators
+            )
+        else:
+            package_dict = count_stream(reader, aggregators=self.aggregators)
+        if reader is not buffer:
+            metrics.add(
+                "decompress", reader.seconds, bytes=reader.bytes, **self._labels()
+            )
+            metrics.add(
+                "parse",
+                time.perf_counter() - started - reader.seconds,
+                bytes=reader.bytes,
+                lines=reader.lines,
+                **self._labels(),
+            )
+        return package_dict
+
+    def _save_stats(self, package_dict: dict):
+        # Save the dictionary to the binary stats file, ranking is precomputed here
+        with metrics.stage("serialize", **self._labels()) as stage:
+            write_stats_store(self.stats_file_path, package_dict)
+            stage.bytes = os.path.getsize(self.stats_file_path)
+        # The breakdowns and the path index cached by earlier runs were computed again
+        # in this pass, see _manage_cached_artifacts
+        if self.aggregators:
+            with atomic_write(self.breakdowns_file_path, "w") as f:
+                json.dump(
+                    {
+                        aggregator.name: aggregator.result()
+                        for aggregator in self.aggregators
+                    },
+                    f,
+                )
+            self.aggregators = None
+        if self.path_index:
+            self.build_path_index()
+        if self.contents_meta is not None:
+            with atomic_write(self.meta_file_path, "w") as f:
+                json.dump(
+                    dict(
+                        self.contents_meta,
+                        uncompressed_sha256=self.uncompressed_sha256,
+                    ),
+                    f,
+                )
+        if self.history:
+            self.record_history(package_dict)
+
+    def record_history(self, package_dict: dict):
+        # A failure to record the snapshot doesn't invalidate the refreshed stats
+        import sqlite3
+        from .history import HistoryStore, legacy_series
+
+        try:
+            os.makedirs(PackageStatistics.DEFAULT_DATA_DIR_PATH, exist_ok=True)
+            with HistoryStore(self.history_file_path) as history:
+                legacy = legacy_series(self.mirror_url)
+                if legacy is not None:
+                    history.adopt_series(legacy, self.history_series())
+                history.record(
+                    self.history_series(),
+                    self.arch,
+                    package_dict,
+                    sha256=(self.contents_meta or {}).get("sha256"),
+                )
+        except (sqlite3.Error, ValueError) as e:
+            self.logger.log_error(
+                f"Could not record the statistics in the history: {e}"
+            )
+
+    def history_series(self) -> str:
+        # Mirror of the history series: one per suite and component
+        return f"{self.mirror_domain}/{self.suite}/{self.component}"
+
+    def _open_stats(self):
         try:
-            with open(self.stats_file_path, "r") as f:
-                package_stats = json.load(f)
-            if package_stats is None or package_stats == {}:
+            return open_stats_store(self.stats_file_path, self.legacy_stats_file_path)
+        except Exception as e:
+            self.logger.log_error(
+                f"An error occurred while trying to open the package statistics file: File does not exisist! {e}",
+            )
+            print("An error occurred while trying to open the package statistics file")
+            sys.exit(1)
+
+    def sort_and_return_top_packages(self):
+        with metrics.stage("rank", **self._labels()), self._open_stats() as store:
+            if len(store) == 0:
                 self.logger.log_error(
                     "The package statistics file is empty! Please check the mirror URL and architecture"
                 )
                 print("The package statistics file is empty! No Stats to show!")
                 sys.exit(1)
-            top_packages = dict(
-                sorted(package_stats.items(), key=lambda item: item[1], reverse=True)[
-                    : self.top_packs_count
-                ]
+            return store.top(self.top_packs_count)
+
+    def has_cached_stats(self) -> bool:
+        return os.path.exists(self.stats_file_path) or os.path.exists(
+            self.legacy_stats_file_path
+        )
+
+    def needs_update(self) -> bool:
+        # Check if the stats file exists, is outdated or has to be refreshed anyway
+        self.logger.log_info("Checking if the stats file exists")
+        return (
+            not self.has_cached_stats()
+            or self.refresh
+            or (self.revalidate and not self.is_cache_fresh())
+        )
+
+    def pdiff_url(self, name: str) -> str:
+        return self.mirror_url + f"Contents-{self.arch}.diff/{name}"
+
+    def update_from_pdiffs(self) -> bool:
+        # Bring the cached stats up to date by applying the published pdiffs to the cached
+        # Contents file and only counting the lines they add or remove.
+        # Returns False when a full refresh is needed instead: no cached Contents file, no
+        # pdiffs on the mirror or a broken chain. If the mirror can't be reached the cached
+        # stats are kept, like when they can't be revalidated.
+        import gzip
+        import zlib
+        from urllib.error import HTTPError
+        from .pdiff import PdiffError, PdiffIndex
+
+        meta = self._load_contents_meta()
+        cached_sha256 = meta.get("uncompressed_sha256")
+        if cached_sha256 is None or not os.path.exists(self.contents_file_path):
+            self.logger.log_info("No cached Contents file to apply pdiffs to")
+            return False
+        try:
+            with self._open_url(self.pdiff_url("Index")) as response:
+                index = PdiffIndex(response.read().decode("utf-8"))
+            names = index.patches_from(cached_sha256)
+            if names is None:
+                self.logger.log_info(
+                    "The cached Contents file is not in the pdiff history"
+                )
+                return False
+            if not names:
+                self.logger.log_info("The cached Contents file is up to date")
+                return True
+            self._apply_pdiffs(index, names)
+        except HTTPError as e:
+            if e.code != 404:
+                self.logger.log_warning(f"Could not download the pdiffs: {e}")
+                return True
+            self.logger.log_info(f"The mirror doesn't publish this pdiff: {e}")
+            return False
+        except (PdiffError, ValueError, EOFError, gzip.BadGzipFile, zlib.error) as e:
+            self.logger.log_warning(f"Could not update the stats from pdiffs: {e}")
+            return False
+        except OSError as e:
+            self.logger.log_warning(
+                f"Could not download the pdiffs, using the cached statistics: {e}"
             )
-            return top_packages
+            return True
+        return True
+
+    def _apply_pdiffs(self, index: "PdiffIndex", names: List[str]):
+        import gzip
+        import hashlib
+        from .parser import count_fields, decode_fields
+        from .pdiff import PdiffError, apply_ed_script, parse_ed_script
+
+        with self._open_stats() as store:
+            package_dict = dict(store.items())
+        source_path = self.contents_file_path
+        sha256 = None
+        for position, name in enumerate(names):
+            self.logger.log_info(f"Applying pdiff {name}")
+            with self._open_url(self.pdiff_url(name + ".gz")) as response:
+                archive = response.read()
+            if hashlib.sha256(archive).hexdigest() != index.downloads.get(name + ".gz"):
+                raise PdiffError(f"Checksum mismatch for the pdiff {name}")
+            operations = parse_ed_script(gzip.decompress(archive))
+
+            # Every patch is applied in a single streaming pass over the cached file
+            target_path = self.contents_file_path + f".pdiff{position}"
+            sha256 = hashlib.sha256()
+            with gzip.open(source_path, "rb") as source, gzip.open(
+                target_path, "wb", compresslevel=1
+            ) as target:
+                removed, added = apply_ed_script(source, operations, target, sha256)
+            if source_path != self.contents_file_path:
+                os.remove(source_path)
+            source_path = target_path
+
+            # Only the changed lines are counted
+            for package, files in decode_fields(
+                count_fields(b"\n".join(removed), Counter())
+            ).items():
+                package_dict[package] = package_dict.get(package, 0) - files
+            for package, files in decode_fields(
+                count_fields(b"\n".join(added), Counter())
+            ).items():
+                package_dict[package] = package_dict.get(package, 0) + files
+
+        if sha256.hexdigest() != index.current_sha256:
+            os.remove(source_path)
+            raise PdiffError("The patched Contents file doesn't match SHA256-Current")
+        os.replace(source_path, self.contents_file_path)
+        self.uncompressed_sha256 = index.current_sha256
+        self.contents_meta = {"url": self.contents_url()}
+        self._manage_cached_artifacts()
+        if self.breakdown_names:
+            # Breakdowns can't be patched, they are counted again from the patched file
+            self.parse_contents_file()
+            return
+        self._save_stats(
+            {package: files for package, files in package_dict.items() if files > 0}
+        )
+
+    def build_path_index(self):
+        from .pathindex import build_path_index
+
+        self.logger.log_info("Building the path index")
+        build_path_index(self.contents_file_path, self.path_index_file_path)
+
+    def _open_path_index(self):
+        # Build the path index from the cached Contents file, or download it first
+        from .pathindex import PathIndex
+
+        self.update_stats()
+        if not os.path.exists(self.path_index_file_path):
+            if self.offline:
+                print(
+                    "No cached path index for this mirror and architecture, run without --offline first"
+                )
+                self.logger.log_error(
+                    f"No cached path index in {self.contents_dir_path} for an offline query"
+                )
+                sys.exit(1)
+            with self._refresh_lock():
+                # Another process may have built it while this one was waiting
+                if os.path.exists(self.path_index_file_path):
+                    pass
+                elif os.path.exists(self.contents_file_path):
+                    self.build_path_index()
+                else:
+                    self.path_index = self.keep_contents = True
+                    self._refresh_stats()
+        try:
+            return PathIndex(self.path_index_file_path)
         except Exception as e:
             self.logger.log_error(
-                f"An error occurred while trying to retrieve the top packages: File does not exisist! {e}",
+                f"An error occurred while trying to open the path index: {e}"
             )
-            print("An error occurred while trying to retrieve the top packages: ")
+            print("An error occurred while trying to open the path index")
             sys.exit(1)
 
-    def get_top_packages(self):
-        # Check if the stats file exists and if it doesn't download the contents file and parse it
-        self.logger.log_info("Checking if the stats file exists")
-        if not os.path.exists(self.stats_file_path) or self.refresh:
+    def find_path(self, path: str) -> List[str]:
+        # Packages shipping the given file
+        self.logger.log_info(f"Looking up path {path}")
+        with self._open_path_index() as index:
+            return index.packages(path)
+
+    def find_prefix(self, prefix: str, limit: Optional[int] = None) -> List[tuple]:
+        # (path, packages) of every file under the given prefix
+        self.logger.log_info(f"Looking up paths starting with {prefix}")
+        with self._open_path_index() as index:
+            return list(index.prefix(prefix, limit))
+
+    def find_basename(self, name: str, limit: Optional[int] = None) -> List[tuple]:
+        # (path, packages) of every file with the given file name
+        self.logger.log_info(f"Looking up paths named {name}")
+        with self._open_path_index() as index:
+            return list(index.basename(name, limit))
+
+    def _load_breakdowns(self) -> dict:
+        try:
+            with open(self.breakdowns_file_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get_breakdown(self, name: str) -> dict:
+        # Number of files (or packages) per key of the given breakdown. A breakdown missing
+        # from the cache is computed together with the cached ones in a single pass,
+        # over the cached Contents file if there is one.
+        self.update_stats()
+        self.logger.log_info(f"Retrieving the {name} breakdown")
+        breakdowns = self._load_breakdowns()
+        if name not in breakdowns:
+            if self.offline:
+                print(
+                    f"No cached {name} breakdown for this mirror and architecture, run without --offline first"
+                )
+                self.logger.log_error(
+                    f"No cached {name} breakdown in {self.contents_dir_path} for an offline query"
+                )
+                sys.exit(1)
+            with self._refresh_lock():
+                # Another process may have computed it while this one was waiting
+                breakdowns = self._load_breakdowns()
+                if name not in breakdowns:
+                    self.breakdown_names = list(
+                        dict.fromkeys(list(breakdowns) + self.breakdown_names + [name])
+                    )
+                    self.check_input_sanity()
+                    if os.path.exists(self.contents_file_path):
+                        self.parse_contents_file()
+                    else:
+                        self._refresh_stats()
+                    breakdowns = self._load_breakdowns()
+        return breakdowns[name]
+
+    # Print the largest entries of a breakdown to the console
+    def print_breakdown(self, name: str):
+        breakdown = self.get_breakdown(name)
+        print(
+            f"Top {name} by number of {'packages' if 'packages' in name else 'files'}:"
+        )
+        for i, (key, count) in enumerate(
+            list(breakdown.items())[: self.top_packs_count], start=1
+        ):
+            print(f"{i}. {key} - {count}")
+
+    # Print the (path, packages) search results to the console
+    def print_paths(self, results: List[tuple]):
+        if not results:
+            print("No matching path in the Contents file")
+        for path, packages in results:
+            print(f"{path} - {','.join(packages)}")
+
+    def _manage_cached_artifacts(self):
+        # Called before the Contents file changes: the breakdowns and the path index cached
+        # by earlier runs are kept up to date by the refresh instead of going stale
+        from .aggregate import AGGREGATORS
+
+        cached = [name for name in self._load_breakdowns() if name in AGGREGATORS]
+        self.breakdown_names = list(dict.fromkeys(self.breakdown_names + cached))
+        if os.path.exists(self.path_index_file_path):
+            # Built from the cached Contents file
+            self.path_index = self.keep_contents = True
+
+    def _refresh_stats(self):
+        self.validate()
+        self._manage_cached_artifacts()
+        self.logger.log_info(
+            "Stats file doesn't exist, is outdated or refresh is set to True. Downloading the Contents file"
+        )
+        if self.segments > 1:
+            # Segments arrive out of order, the file is parsed once complete
             self.logger.log_info(
-                "Stats file doesn't exist or refresh is set to True. Downloading the Contents file"
+                f"Downloading the Contents file in {self.segments} parallel segments"
             )
+            self.download_contents_file_segmented()
+            self.logger.log_info("Parsing the Contents file")
+            self.parse_contents_file()
+        elif self.stream:
+            self.logger.log_info("Streaming and parsing the Contents file")
+            self.download_and_parse_contents_file()
+        else:
             self.download_contents_file()
             self.logger.log_info("Parsing the Contents file")
             self.parse_contents_file()
+
+    def _refresh_lock(self) -> FileLock:
+        # Lock of this mirror and architecture, shared by every process using the data directory
+        return FileLock(self.lock_file_path)
+
+    def _stats_signature(self) -> Optional[tuple]:
+        # Changes whenever the stats file is published again
+        try:
+            stat = os.stat(self.stats_file_path)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns)
+
+    def update_stats(self):
+        if self.offline:
+            return
+        # Single flight: one process refreshes a mirror and architecture at a time, the
+        # others wait for it and reuse its result instead of downloading again
+        signature = self._stats_signature()
+        with self._refresh_lock() as lock:
+            if lock.waited and self._stats_signature() != signature:
+                self.logger.log_info(
+                    "The stats were refreshed by another process, using its result"
+                )
+                return
+            self._update_stats()
+
+    def _update_stats(self):
+        # If the stats file needs an update download the contents file and parse it
+        if not self.needs_update():
+            return
+        # With incremental updates the pdiffs are tried first, a broken chain falls back to a full refresh
+        if self.incremental and not self.refresh and self.has_cached_stats():
+            if self.update_from_pdiffs():
+                return
+            self.logger.log_info("Falling back to a full refresh")
+        self._refresh_stats()
+
+    def get_top_packages(self):
+        self.update_stats()
         self.logger.log_info("Retrieving the top packages")
         top_packages = self.sort_and_return_top_packages()
         self.logger.log_info(f"Top packages: {top_packages}")
         return top_packages
 
+    def sketch_contents(
+        self, sketch_size: int = config["DEFAULT_SKETCH_SIZE"]
+    ) -> "SpaceSaving":
+        # Stream the Contents file through a Space-Saving sketch of sketch_size counters.
+        # Memory doesn't grow with the number of packages and the exact cache is left alone.
+        import gzip
+        from contextlib import closing
+        from .parser import PrefetchReader, sketch_stream, sketch_stream_parallel
+
+        if self.offline:
+            print(
+                "Approximate counts are computed from the mirror, run without --offline"
+            )
+            self.logger.log_error("Approximate counts can't be computed offline")
+            sys.exit(1)
+        if sketch_size < self.top_packs_count:
+            print(
+                "The sketch size should be at least the number of top packages to retrieve"
+            )
+            self.logger.log_error(
+                f"The sketch size should be at least the number of top packages. User input: {sketch_size}"
+            )
+            sys.exit(1)
+        self.validate()
+        self.logger.log_info(
+            f"Streaming the Contents file through a sketch of {sketch_size} counters"
+        )
+        try:
+            with self._open_url(self.contents_url()) as response, closing(
+                PrefetchReader(response)
+            ) as reader:
+                with gzip.GzipFile(fileobj=reader) as buffer:
+                    if self.workers > 1:
+                        return sketch_stream_parallel(buffer, sketch_size, self.workers)
+                    return sketch_stream(buffer, sketch_size)
+        except Exception as e:
+            print(
+                f"An error occurred while trying to download and parse the Contents file: {e} "
+            )
+            self.logger.log_error(
+                f"An error occurred while trying to download and parse the Contents file: {e}"
+            )
+            sys.exit(1)
+
+    def get_approx_top_packages(
+        self, sketch_size: int = config["DEFAULT_SKETCH_SIZE"]
+    ) -> List[tuple]:
+        # (package, files, error) of the top packages, the true number of files is in
+        # [files - error, files]
+        top_packages = self.sketch_contents(sketch_size).top(self.top_packs_count)
+        self.logger.log_info(f"Approximate top packages: {top_packages}")
+        return top_packages
+
+    def get_package_count(self, package: str):
+        # Number of files of a single package, None if the package isn't in the Contents file
+        self.update_stats()
+        self.logger.log_info(f"Looking up package {package}")
+        with self._open_stats() as store:
+            return store.get(package)
+
+    # Print the number of files of a single package to the console
+    def print_package_count(self, package: str):
+        files = self.get_package_count(package)
+        if files is None:
+            print(f"Package {package} was not found in the Contents file")
+        else:
+            print(f"{package} - {files} files")
+
+    # Print the approximate top packages with the range of their true number of files
+    def print_approx_top_packages(
+        self, sketch_size: int = config["DEFAULT_SKETCH_SIZE"]
+    ):
+        print_approx_packages(self.get_approx_top_packages(sketch_size))
+
     # Print the top packages to the console
     def print_top_packages(self):
         top_packages = self.get_top_packages()
         print("Top packages by number of files:")
         for i, (package, files) in enumerate(top_packages.items(), start=1):
             print(f"{i}. {package} - {files} files")
+
+
+def print_approx_packages(top_packages: List[tuple]):
+    print("Top packages by approximate number of files:")
+    for i, (package, files, error) in enumerate(top_packages, start=1):
+        if error:
+            print(f"{i}. {package} - {files - error} to {files} files")
+        else:
+            print(f"{i}. {package} - {files} files")
@@ -0,0 +1,141 @@
+import json
+import mmap
+import os
+import struct
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+from .atomic import atomic_write
+
+# Binary stats file layout (all integers are little endian u32):
+#   header      magic, version, package count, size of the names blob
+#   offsets     count + 1 offsets into the names blob, names are sorted by their utf-8 bytes
+#   counts      number of files for every package, in name order
+#   ranking     name order indices sorted by number of files (descending)
+#   names       the concatenated utf-8 package names
+MAGIC = b"PKST"
+VERSION = 1
+HEADER = struct.Struct("<4sIII")
+U32 = struct.Struct("<I")
+
+
+def write_stats_store(path: str, package_dict: Dict[str, int]):
+    # Rank before sorting by name so that ties keep the order of the parser output,
+    # exactly like sorting the JSON dictionary did
+    names = [package.encode("utf-8") for package in package_dict]
+    counts = list(package_dict.values())
+    by_name = sorted(range(len(names)), key=names.__getitem__)
+    name_position = [0] * len(names)
+    for position, index in enumerate(by_name):
+        name_position[index] = position
+    ranking = sorted(range(len(names)), key=counts.__getitem__, reverse=True)
+
+    offsets = [0]
+    for index in by_name:
+        offsets.append(offsets[-1] + len(names[index]))
+    count = len(names)
+    # Published atomically, memory mapped readers keep the file they opened
+    with atomic_write(path) as f:
+        f.write(HEADER.pack(MAGIC, VERSION, count, offsets[-1]))
+        f.write(struct.pack(f"<{count + 1}I", *offsets))
+        f.write(struct.pack(f"<{count}I", *(counts[index] for index in by_name)))
+        f.write(struct.pack(f"<{count}I", *(name_position[i] for i in ranking)))
+        f.write(b"".join(names[index] for index in by_name))
+
+
+def migrate_json_stats(json_path: str, store_path: str):
+    # Convert a packages_stats.json file written by older versions to the binary format
+    with open(json_path, "r") as f:
+        package_dict = json.load(f)
+    write_stats_store(store_path, package_dict or {})
+
+
+class StatsStore:
+    """
+    Read-only, memory mapped view of a binary stats file. Opening the file
+    and answering queries never reads more than the requested entries.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count, names_size = HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != VERSION:
+            self._map.close()
+            raise ValueError(f"{path} is not a package statistics file")
+        self._offsets_start = HEADER.size
+        self._counts_start = self._offsets_start + (self.count + 1) * U32.size
+        self._ranking_start = self._counts_start + self.count * U32.size
+        self._names_start = self._ranking_start + self.count * U32.size
+        if len(self._map) != self._names_start + names_size:
+            self._map.close()
+            raise ValueError(f"{path} is truncated or corrupted")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def close(self):
+        self._map.close()
+
+    def _u32(self, start: int, index: int) -> int:
+        return U32.unpack_from(self._map, start + index * U32.size)[0]
+
+    def _name_bytes(self, position: int) -> bytes:
+        start, end = struct.unpack_from(
+            "<II", self._map, self._offsets_start + position * U32.size
+        )
+        return self._map[self._names_start + start : self._names_start + end]
+
+    def _entry(self, position: int) -> Tuple[str, int]:
+        return (
+            self._name_bytes(position).decode("utf-8"),
+            self._u32(self._counts_start, position),
+        )
+
+    def top(self, n: int) -> Dict[str, int]:
+        # Only the first n entries of the precomputed ranking are read
+        return dict(
+            self._entry(self._u32(self._ranking_start, rank))
+            for rank in range(min(n, self.count))
+        )
+
+    def get(self, package: str) -> Optional[int]:
+        # Binary search over the sorted name table
+        key = package.encode("utf-8")
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._name_bytes(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self._name_bytes(low) == key:
+            return self._u32(self._counts_start, low)
+        return None
+
+    def items(self) -> Iterator[Tuple[str, int]]:
+        # Every package in ranking order
+        for rank in range(self.count):
+            yield self._entry(self._u32(self._ranking_start, rank))
+
+
+def open_stats_store(store_path: str, json_path: str) -> StatsStore:
+    # Open the binary stats file, migrating an old JSON cache first if that is all there is
+    if not os.path.exists(store_path) and os.path.exists(json_path):
+        migrate_json_stats(json_path, store_path)
+    return StatsStore(store_path)
+
+
+def merge_stats_stores(stores: Iterable[StatsStore]) -> Dict[str, int]:
+    # Sum the number of files of every package over several stats files (partial counts
+    # of suites, components or architectures), in the order of the first file listing it
+    merged = {}
+    for stats_store in stores:
+        for package, files in stats_store.items():
+            merged[package] = merged.get(package, 0) + files
+    return merged
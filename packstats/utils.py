@@ -1,10 +1,10 @@
 import os
 import sys
-from typing import List
+from typing import List, Optional
 from urllib.parse import urlparse
-from urllib.request import urlopen
 import time
 import json
+import threading
 import logging.handlers
 
 # Class to handle logging for .stats and .utils modules
@@ -14,15 +14,25 @@ class Logger:
         self.setup_log_folder()
         self.log = logging.getLogger("packstats")
         self.log.setLevel(logging.DEBUG)
-        self.loghandler = logging.handlers.RotatingFileHandler(
-            self.log_file_path, maxBytes=100000, backupCount=5
-        )
-        self.loghandler.setLevel(logging.DEBUG)
-        self.loghandler.setFormatter(
-            logging.Formatter("%(asctime)s %(levelname)s %(message)s")
-        )
-        self.log.addHandler(self.loghandler)
-        self.log.info("\n")  # space between each run
+        # Every instance shares the handler of its log file, a new one would log each line again
+        self.loghandler = self._find_handler()
+        if self.loghandler is None:
+            self.loghandler = logging.handlers.RotatingFileHandler(
+                self.log_file_path, maxBytes=100000, backupCount=5
+            )
+            self.loghandler.setLevel(logging.DEBUG)
+            self.loghandler.setFormatter(
+                logging.Formatter("%(asctime)s %(levelname)s %(message)s")
+            )
+            self.log.addHandler(self.loghandler)
+            self.log.info("\n")  # space between each run
+
+    def _find_handler(self) -> Optional[logging.Handler]:
+        path = os.path.abspath(self.log_file_path)
+        for handler in self.log.handlers:
+            if getattr(handler, "baseFilename", None) == path:
+                return handler
+        return None
 
     def setup_log_folder(self):
         config = Config.instance()
@@ -70,7 +80,8 @@ class Config(object):
         try:
             with open("./config/packstat_defaults.json", "r") as f:
                 config = json.load(f)
-            return config
+            # Fill in keys missing from config files written by older versions
+            return {**cls._get_default_config(), **config}
         except Exception as e:
             print(
                 "Using default configuration values instead and saving them in a ./config/packstat_defaults.json file."
@@ -89,28 +100,59 @@ class Config(object):
             "DEFAULT_REFRESH": False,
             "DEFAULT_ARCH": "all",
             "DEFAULT_DATA_DIR_PATH": "./data/",
+            "DEFAULT_ARCHS_TTL": 86400,
             "DEFAULT_LOG_DIR_PATH": "./logs/",
+            "DEFAULT_WORKERS": 1,
+            "DEFAULT_PARALLEL_MIN_SIZE": 4194304,
+            "DEFAULT_STREAM": True,
+            "DEFAULT_KEEP_CONTENTS": False,
+            "DEFAULT_REVALIDATE": False,
+            "DEFAULT_DOWNLOAD_THREADS": 4,
+            "DEFAULT_SEGMENTS": 1,
+            "DEFAULT_SEGMENT_SIZE": 4194304,
+            "DEFAULT_EXTRA_MIRRORS": [],
+            "DEFAULT_INCREMENTAL": False,
+            "DEFAULT_PATH_INDEX": False,
+            "DEFAULT_SKETCH_SIZE": 1024,
+            "DEFAULT_BREAKDOWNS": [],
+            "DEFAULT_HISTORY": False,
+            "DEFAULT_SERVE_HOST": "127.0.0.1",
+            "DEFAULT_SERVE_PORT": 8080,
+            "DEFAULT_SERVE_REFRESH_INTERVAL": 3600,
         }
 
 
 # Load the configuration file
 config = Config.instance()
 
-# Check if the available architectures file and if its older than the given number of days
+# Architecture argument selecting every architecture available on the mirror
+ALL_AVAILABLE_ARCHS = "all-available"
+
+
+# Architectures of every mirror (suite and component) known to this process, shared by
+# all the ArchUtils instances: arch file path -> (fetch time, architectures)
+_archs_cache = {}
+# One lock per mirror so that concurrent callers wait for a single fetch
+_archs_locks = {}
+_archs_locks_lock = threading.Lock()
+
+
+# Available architectures of a mirror, from its Release file
 class ArchUtils:
     DEFAULT_DATA_DIR_PATH = config["DEFAULT_DATA_DIR_PATH"]
-    DEFAULT_MIRROR_URL = config["DEFAULT_MIRROR_URL"]
     LOG_FILE_PATH = config["DEFAULT_LOG_DIR_PATH"] + "packstats.log"
+    # Seconds the architectures of a mirror are trusted before the Release file is fetched again
+    ARCHS_TTL = config["DEFAULT_ARCHS_TTL"]
 
     def __init__(self, mirror_url: str):
         self.logger = Logger(ArchUtils.LOG_FILE_PATH)
         self.mirror_url = mirror_url
         self.mirror_domain = self.get_mirror_domain()
-        self.arch_file_path = (
-            ArchUtils.DEFAULT_DATA_DIR_PATH
-            + f"{self.mirror_domain}/"
-            + "/available_archs.txt"
-        )
+        # Suites and components of a mirror don't all have the same architectures
+        from .release import branch_path
+
+        self.mirror_dir_path = ArchUtils.DEFAULT_DATA_DIR_PATH + branch_path(mirror_url)
+        self.arch_file_path = self.mirror_dir_path + "available_archs.txt"
 
     def get_mirror_domain(self) -> str:
         return urlparse(self.mirror_url).netloc
@@ -122,55 +164,22 @@ class ArchUtils:
         self.logger.log_info(
             f"Validating architecture {arch} on mirror {self.mirror_domain}"
         )
-        # If the available architectures file exists and is not older than 1 day, use it
-        if os.path.exists(
-            self.arch_file_path
-        ) and not self.is_available_arch_older_than(1):
-            with open(self.arch_file_path, "r") as f:
-                archs = f.read().splitlines()
-                if arch not in archs:
-                    print(
-                        "The given architecture is not available on this Debian Mirror"
-                    )
-                    self.logger.log_error(
-                        f"The given architecture {arch} is not available on this Debian Mirror {self.mirror_domain}"
-                    )
-                    sys.exit(1)
-                else:
-                    return True
-        else:
-            # If the available architectures file doesn't exist, create it
-            self.logger.log_info(
-                f"Creating available architectures file for mirror {self.mirror_domain}"
-            )
-            os.makedirs(
-                ArchUtils.DEFAULT_DATA_DIR_PATH + f"{self.mirror_domain}", exist_ok=True
+        if arch not in self.get_available_archs():
+            print("The given architecture is not available on this Debian Mirror")
+            self.logger.log_error(
+                f"The given architecture {arch} is not available on this Debian Mirror {self.mirror_domain}"
             )
-            self.create_arch_file()
-            return True if self.validate_and_create_archs(arch) else False
+            sys.exit(1)
+        return True
 
-    def create_arch_file(self, mirror_url: str = DEFAULT_MIRROR_URL) -> List[str]:
+    def get_available_archs(self) -> List[str]:
+        """
+        Return the architectures available on the mirror. Once known they are
+        served from memory, then from the available architectures file, and
+        the Release file is only fetched again when both are older than the TTL.
+        """
         try:
-            self.logger.log_info(
-                f"Creating available architectures file for mirror {self.mirror_domain}"
-            )
-            with urlopen(mirror_url) as response:
-                raw_html = response.read()
-                html = raw_html.decode("utf-8")
-
-            # Find the available architectures
-            archs = html.split("Contents-")[1:]
-            valid_archs = [arch.split(".gz")[0] for arch in archs]
-            self.logger.log_info(
-                f"Available architectures for mirror {self.mirror_domain}: {valid_archs}"
-            )
-
-            # Save the available architectures in a file
-            with open(self.arch_file_path, "w") as f:
-                # Remove duplicates
-                for arch in list(set(valid_archs)):
-                    f.write(arch + "\n")
-            return valid_archs
+            return self.load_available_archs()
         except Exception as e:
             self.logger.log_error(
                 f"An error occurred while trying to retrieve the available architectures for mirror {self.mirror_domain}: {e}"
@@ -180,23 +189,77 @@ class ArchUtils:
             )
             sys.exit(1)
 
-    def is_available_arch_older_than(self, days: int) -> bool:
-        # Check if the available architectures file is older than the given number of days
+    def load_available_archs(self) -> List[str]:
+        # get_available_archs raising the errors of the fetch
+        archs = self.cached_archs()
+        if archs is not None:
+            return archs
+        with _archs_locks_lock:
+            lock = _archs_locks.setdefault(self.arch_file_path, threading.Lock())
+        with lock:
+            # Fetched by another thread meanwhile
+            archs = self.cached_archs()
+            if archs is not None:
+                return archs
+            from .atomic import FileLock
+
+            os.makedirs(self.mirror_dir_path, exist_ok=True)
+            # Only one process fetches the list, the others wait and read its file
+            with FileLock(self.mirror_dir_path + "archs.lock"):
+                archs = self.cached_archs()
+                if archs is None:
+                    archs = self.create_arch_file()
+            return archs
+
+    def cached_archs(self) -> Optional[List[str]]:
+        # The architectures known to this process or listed in a file younger than the TTL,
+        # None when they have to be fetched
+        fetched_at, archs = _archs_cache.get(self.arch_file_path, (0, None))
+        if archs is not None and fetched_at + ArchUtils.ARCHS_TTL > time.time():
+            return archs
+        try:
+            modified_at = os.path.getmtime(self.arch_file_path)
+        except OSError:
+            return None
+        if modified_at + ArchUtils.ARCHS_TTL <= time.time():
+            self.logger.log_info(
+                f"Available architectures file for mirror {self.mirror_domain} is older than {ArchUtils.ARCHS_TTL} seconds and needs an update"
+            )
+            return None
+        archs = self.read_arch_file()
+        _archs_cache[self.arch_file_path] = (modified_at, archs)
+        return archs
+
+    def create_arch_file(self) -> List[str]:
+        # Fetch the architectures from the Release file of the suite, a few kilobytes
+        # shared by every component, and save them in the available architectures file
+        from .metrics import metrics
+        from .release import cached_release, contents_archs
+
+        self.logger.log_info(
+            f"Creating available architectures file for mirror {self.mirror_domain}"
+        )
+        with metrics.stage("arch_discovery", mirror=self.mirror_domain):
+            release = cached_release(self.mirror_url, ArchUtils.ARCHS_TTL)
+        valid_archs = contents_archs(release, self.mirror_url)
+        self.write_arch_file(valid_archs)
+        return sorted(set(valid_archs))
+
+    def write_arch_file(self, valid_archs: List[str]):
         self.logger.log_info(
-            f"Checking if available architectures file for mirror {self.mirror_domain} is older than {days} days"
+            f"Available architectures for mirror {self.mirror_domain}: {valid_archs}"
         )
-        arch_file_path = self.arch_file_path
-        if os.path.exists(arch_file_path):
-            arch_file_mod_time = os.path.getmtime(arch_file_path)
-            if arch_file_mod_time < (time.time() - (days * 24 * 60 * 60)):
-                self.logger.log_info(
-                    f"Available architectures file for mirror {self.mirror_domain} is older than {days} days and needs an update"
-                )
-                return True
-            else:
-                self.logger.log_info(
-                    f"Available architectures file for mirror {self.mirror_domain} is not older than {days} days. Continuing..."
-                )
-                return False
-        else:
-            return True
+        # Save the available architectures in a file, published atomically
+        from .atomic import atomic_write
+
+        os.makedirs(os.path.dirname(self.arch_file_path), exist_ok=True)
+        # Remove duplicates
+        archs = sorted(set(valid_archs))
+        with atomic_write(self.arch_file_path, "w") as f:
+            for arch in archs:
+                f.write(arch + "\n")
+        _archs_cache[self.arch_file_path] = (time.time(), archs)
+
+    def read_arch_file(self) -> List[str]:
+        with open(self.arch_file_path, "r") as f:
+            return f.read().splitlines()
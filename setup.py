@@ -18,6 +18,9 @@ setuptools.setup(
         "Operating System :: OS Independent",
     ],
     python_requires=">=3.8",
+    extras_require={
+        "matrix": ["numpy"],
+    },
     entry_points={
         "console_scripts": [
             "package_statistics=package_statistics:run_cli",
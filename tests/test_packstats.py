@@ -2,12 +2,145 @@
 
 import unittest
 import time
+import io
+import os
+import gzip
+import json
+import hashlib
+import tempfile
+import threading
+import difflib
+import socket
+import asyncio
+import urllib.request
+import urllib.error
+import http.client
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import logging.handlers
-from packstats import stats, utils
+import importlib.util
+from packstats import (
+    aggregate,
+    asyncpool,
+    asyncstats,
+    atomic,
+    batch,
+    benchmark,
+    combined,
+    connection,
+    history,
+    localmirror,
+    metrics,
+    parser,
+    pathindex,
+    pdiff,
+    release,
+    segmented,
+    server,
+    sketch,
+    stats,
+    store,
+    utils,
+)
 
 config = utils.Config.instance()
 
+# NumPy is an optional dependency (comparison matrix)
+HAS_NUMPY = importlib.util.find_spec("numpy") is not None
+
+
+# Build a small synthetic Contents file with multi package lines and EMPTY_PACKAGE entries
+def make_contents(lines: int = 2000) -> bytes:
+    rows = []
+    for i in range(lines):
+        packages = f"utils/pkg{i % 37}"
+        if i % 5 == 0:
+            packages += f",libs/lib{i % 11}"
+        rows.append(f"usr/share/doc/file {i}.txt{' ' * (i % 7 + 1)}{packages}")
+    rows.insert(3, "EMPTY_PACKAGE admin/empty")
+    rows.insert(10, "")
+    return ("\n".join(rows) + "\n").encode("utf-8")
+
+
+# Build an ed script (as written by diff --ed) turning the old lines into the new ones
+def make_ed_script(old_lines, new_lines) -> bytes:
+    commands = []
+    matcher = difflib.SequenceMatcher(a=old_lines, b=new_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+        lines = i1 + 1 if i2 == i1 + 1 else f"{i1 + 1},{i2}"
+        if tag == "replace":
+            commands += [f"{lines}c"] + new_lines[j1:j2] + ["."]
+        elif tag == "delete":
+            commands.append(f"{lines}d")
+        elif tag == "insert":
+            commands += [f"{i1}a"] + new_lines[j1:j2] + ["."]
+    return ("\n".join(commands) + "\n").encode("utf-8")
+
+
+class RecordingHandler(localmirror.QuietHandler):
+    # Static file handler that keeps track of the requested paths
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        super().do_GET()
+
+
+class RangeHandler(RecordingHandler):
+    # Static file handler also answering single byte range requests, like Debian mirrors.
+    # Requests starting at broken_from or later fail.
+    ranges = []
+    broken_from = None
+
+    def do_GET(self):
+        header = self.headers.get("Range")
+        if header is None:
+            return super().do_GET()
+        self.requests.append(self.path)
+        try:
+            with open(self.translate_path(self.path), "rb") as f:
+                data = f.read()
+        except OSError:
+            return self.send_error(404)
+        start, end = (int(value) for value in header.split("=")[1].split("-"))
+        end = min(end, len(data) - 1)
+        self.ranges.append((self.server.server_port, start))
+        if self.broken_from is not None and start >= self.broken_from:
+            return self.send_error(500)
+        body = data[start : end + 1]
+        self.send_response(206)
+        self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class RedirectHandler(RecordingHandler):
+    # Redirects every request to the same path under target, like a mirror redirector
+    target = None
+    status = 302
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        self.send_response(self.status)
+        self.send_header("Location", self.target + self.path)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    do_HEAD = do_GET
+
+
+class LocalMirror(localmirror.LocalMirror):
+    # Shared stand-in mirror, recording the requests it answers
+    def __init__(self, root: str, handler_class=RecordingHandler):
+        RecordingHandler.requests = []
+        super().__init__(root, handler_class)
+
+    @property
+    def requests(self):
+        return RecordingHandler.requests
+
 
 class TestPackstats(unittest.TestCase):
     def setUp(self):
@@ -94,3 +227,1599 @@ class TestPackstats(unittest.TestCase):
     def tearDown(self):
         self.log.info("Test finished")
         self.log.removeHandler(self.loghandler)
+
+
+class TestParser(unittest.TestCase):
+    def setUp(self):
+        self.contents = make_contents()
+        self.expected = parser.count_lines(io.BytesIO(self.contents))
+
+    def test_count_lines(self):
+        self.assertEqual(self.expected["utils/pkg0"], 55)
+        self.assertEqual(self.expected["libs/lib0"], 37)
+        self.assertNotIn("admin/empty", self.expected)
+
+    def test_count_stream_matches_line_parser(self):
+        contents = self.contents + b"usr/bin/x y  \r\nEMPTY_PACKAGE  admin/kept\n\n  \n"
+        counts = parser.count_stream(io.BytesIO(contents), chunk_size=512)
+        self.assertEqual(counts["y"], 1)
+        self.assertEqual(counts["admin/kept"], 1)
+        self.assertEqual(counts["utils/pkg0"], self.expected["utils/pkg0"])
+        self.assertEqual(list(counts)[: len(self.expected)], list(self.expected))
+
+    def test_matches_reference_parser(self):
+        # Trailing spaces, blank lines and EMPTY_PACKAGE lines at the edges of the blocks
+        contents = (
+            b"EMPTY_PACKAGE admin/empty\n"
+            + self.contents.replace(b"utils/pkg7\n", b"utils/pkg7 \n")
+            + b"usr/bin/z utils/z  \n\nEMPTY_PACKAGE admin/last"
+        )
+        for chunk_size in (64, 1000, len(contents)):
+            counts = parser.count_stream(io.BytesIO(contents), chunk_size=chunk_size)
+            self.assertEqual(
+                list(counts.items()),
+                list(benchmark.count_reference(io.BytesIO(contents)).items()),
+            )
+
+    def test_iter_chunks_are_line_aligned(self):
+        chunks = list(parser.iter_chunks(io.BytesIO(self.contents), chunk_size=100))
+        self.assertEqual(b"".join(chunks), self.contents)
+        for chunk in chunks:
+            self.assertTrue(chunk.endswith(b"\n"))
+
+    def test_parallel_matches_serial(self):
+        stream = gzip.GzipFile(fileobj=io.BytesIO(gzip.compress(self.contents)))
+        counts = parser.parse_stream_parallel(stream, workers=2, chunk_size=1000)
+        self.assertEqual(list(counts.items()), list(self.expected.items()))
+
+    def test_prefetch_reader_streams_and_copies(self):
+        archive = gzip.compress(self.contents)
+        copy = io.BytesIO()
+        reader = parser.PrefetchReader(io.BytesIO(archive), copy_to=copy)
+        with gzip.GzipFile(fileobj=reader) as buffer:
+            counts = parser.count_lines(buffer)
+        self.assertEqual(counts, self.expected)
+        self.assertEqual(copy.getvalue(), archive)
+
+    def test_prefetch_reader_close_stops_the_thread(self):
+        class EndlessSource:
+            # A download far larger than the prefetch queue
+            reads = 0
+            closed = False
+
+            def read(self, size):
+                self.reads += 1
+                return b"x" * size
+
+            def close(self):
+                self.closed = True
+
+        source = EndlessSource()
+        reader = parser.PrefetchReader(source)
+        self.assertEqual(len(reader.read(10)), 10)
+        # The consumer failed midway, the thread is blocked on a full queue
+        time.sleep(0.2)
+        reader.close()
+        reader._thread.join(5)
+        self.assertFalse(reader._thread.is_alive())
+        self.assertTrue(source.closed)
+        self.assertLessEqual(source.reads, parser.PREFETCH_MAX_BLOCKS + 2)
+
+
+class TestStatsStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store_path = os.path.join(self.tmp_dir.name, "packages_stats.bin")
+        self.package_dict = parser.count_lines(io.BytesIO(make_contents()))
+
+    def test_top_matches_sorted_dict(self):
+        store.write_stats_store(self.store_path, self.package_dict)
+        expected = dict(
+            sorted(self.package_dict.items(), key=lambda item: item[1], reverse=True)[
+                :10
+            ]
+        )
+        with store.StatsStore(self.store_path) as stats_store:
+            self.assertEqual(len(stats_store), len(self.package_dict))
+            self.assertEqual(list(stats_store.top(10).items()), list(expected.items()))
+            self.assertEqual(len(stats_store.top(1000)), len(self.package_dict))
+
+    def test_get_package(self):
+        store.write_stats_store(self.store_path, self.package_dict)
+        with store.StatsStore(self.store_path) as stats_store:
+            for package, files in self.package_dict.items():
+                self.assertEqual(stats_store.get(package), files)
+            self.assertIsNone(stats_store.get("utils/missing"))
+
+    def test_migrate_json_cache(self):
+        json_path = os.path.join(self.tmp_dir.name, "packages_stats.json")
+        with open(json_path, "w") as f:
+            json.dump(self.package_dict, f)
+        with store.open_stats_store(self.store_path, json_path) as stats_store:
+            self.assertEqual(dict(stats_store.items()), self.package_dict)
+        self.assertTrue(os.path.exists(self.store_path))
+
+    def test_empty_store(self):
+        store.write_stats_store(self.store_path, {})
+        with store.StatsStore(self.store_path) as stats_store:
+            self.assertEqual(len(stats_store), 0)
+            self.assertEqual(stats_store.top(10), {})
+            self.assertIsNone(stats_store.get("utils/pkg0"))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+
+class LocalMirrorTestCase(unittest.TestCase):
+    # Runs a local mirror and points the data directory to a temporary directory
+    archs = ["amd64"]
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.mirror = LocalMirror(os.path.join(self.tmp_dir.name, "mirror"))
+        self.data_dir = os.path.join(self.tmp_dir.name, "data") + "/"
+        self.patches = [
+            mock.patch.object(
+                stats.PackageStatistics, "DEFAULT_DATA_DIR_PATH", self.data_dir
+            ),
+            mock.patch.object(utils.ArchUtils, "DEFAULT_DATA_DIR_PATH", self.data_dir),
+        ]
+        for patch in self.patches:
+            patch.start()
+        # Release files cached by an earlier test on the same port
+        release._releases.clear()
+        # Architecture discovery is not under test here
+        mirror_dir = (
+            self.data_dir + f"127.0.0.1:{self.mirror.server.server_port}/stable/main"
+        )
+        os.makedirs(mirror_dir)
+        with open(mirror_dir + "/available_archs.txt", "w") as f:
+            f.write("\n".join(self.archs) + "\n")
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.mirror.close()
+        self.tmp_dir.cleanup()
+
+    def redirecting_mirror(self, target: str, status: int = 302):
+        # Redirector in front of the mirror, with its own list of requests
+        handler = type(
+            "Redirect", (RedirectHandler,), {"target": target, "status": status}
+        )
+        redirect = LocalMirror(os.path.join(self.tmp_dir.name, "redirect"), handler)
+        handler.requests = []
+        self.addCleanup(redirect.close)
+        return redirect, handler.requests
+
+
+class TestRevalidation(LocalMirrorTestCase):
+    def get_stats(self):
+        return stats.PackageStatistics(
+            "amd64", self.mirror.mirror_url, 10, False, revalidate=True
+        )
+
+    def contents_downloads(self):
+        return [path for path in self.mirror.requests if "Contents-" in path]
+
+    def test_release_file(self):
+        self.mirror.publish(make_contents())
+        entry = release.fetch_release(self.mirror.mirror_url).contents_entry(
+            self.mirror.mirror_url, "amd64"
+        )
+        with open(os.path.join(self.mirror.main_dir, "Contents-amd64.gz"), "rb") as f:
+            self.assertEqual(entry[0], hashlib.sha256(f.read()).hexdigest())
+
+    def test_revalidate_with_release_file(self):
+        self.mirror.publish(make_contents())
+        first = self.get_stats().get_top_packages()
+        self.assertEqual(len(self.contents_downloads()), 1)
+        self.assertEqual(self.get_stats().get_top_packages(), first)
+        self.assertEqual(len(self.contents_downloads()), 1)
+
+        self.mirror.publish(make_contents(3000))
+        changed = self.get_stats().get_top_packages()
+        self.assertEqual(len(self.contents_downloads()), 2)
+        self.assertNotEqual(changed, first)
+
+    def test_revalidate_with_conditional_request(self):
+        self.mirror.publish(make_contents(), release=False)
+        self.get_stats().get_top_packages()
+        # Answered with 304 Not Modified
+        self.assertTrue(self.get_stats().is_cache_fresh())
+        contents_path = os.path.join(self.mirror.main_dir, "Contents-amd64.gz")
+        modified = time.time() + 60
+        os.utime(contents_path, (modified, modified))
+        self.assertFalse(self.get_stats().is_cache_fresh())
+
+    def test_unreachable_mirror(self):
+        self.mirror.publish(make_contents(), release=False)
+        self.get_stats().get_top_packages()
+        self.mirror.close()
+        # Logged, stdout only carries the statistics
+        with mock.patch("sys.stdout", new_callable=io.StringIO) as stdout:
+            with self.assertLogs("packstats", "WARNING") as logs:
+                self.assertTrue(self.get_stats().is_cache_fresh())
+        self.assertEqual(stdout.getvalue(), "")
+        self.assertIn(
+            "Could not revalidate the cached statistics, using them anyway",
+            logs.output[-1],
+        )
+
+
+class TestBatch(LocalMirrorTestCase):
+    archs = ["amd64", "arm64", "i386"]
+
+    def setUp(self):
+        super().setUp()
+        self.contents = {
+            arch: make_contents(1000 * (i + 1)) for i, arch in enumerate(self.archs)
+        }
+        for arch, contents in self.contents.items():
+            self.mirror.publish(contents, arch)
+
+    def test_all_available_archs(self):
+        batch_stats = batch.BatchStatistics(
+            [batch.ALL_AVAILABLE_ARCHS], self.mirror.mirror_url, 5, False, workers=2
+        )
+        top_packages = batch_stats.get_top_packages()
+        self.assertEqual(list(top_packages), self.archs)
+        for arch, contents in self.contents.items():
+            counts = parser.count_lines(io.BytesIO(contents))
+            self.assertEqual(
+                top_packages[arch],
+                dict(
+                    sorted(counts.items(), key=lambda item: item[1], reverse=True)[:5]
+                ),
+            )
+        combined = batch_stats.get_combined_top_packages()
+        self.assertEqual(
+            combined["utils/pkg0"],
+            sum(
+                parser.count_lines(io.BytesIO(c))["utils/pkg0"]
+                for c in self.contents.values()
+            ),
+        )
+
+    def test_approx_top_packages(self):
+        batch_stats = batch.BatchStatistics(
+            self.archs, self.mirror.mirror_url, 5, False
+        )
+        per_arch, combined = batch_stats.get_approx_top_packages(64)
+        self.assertEqual(list(per_arch), self.archs)
+        totals = {}
+        for contents in self.contents.values():
+            parser.merge_counts(totals, parser.count_lines(io.BytesIO(contents)))
+        self.assertEqual(
+            [(package, files) for package, files, _ in combined],
+            sorted(totals.items(), key=lambda item: (-item[1], item[0]))[:5],
+        )
+
+    def test_invalid_arch(self):
+        with self.assertRaises(SystemExit):
+            batch.BatchStatistics(["amd64", "mips"], self.mirror.mirror_url, 5, False)
+
+    def test_invalid_download_threads(self):
+        # Rejected before the connection pool is set up
+        with mock.patch.object(batch, "ConnectionPool") as pool:
+            with mock.patch("sys.stdout", new_callable=io.StringIO):
+                with self.assertRaises(SystemExit):
+                    batch.BatchStatistics(
+                        self.archs, self.mirror.mirror_url, 5, False, download_threads=0
+                    )
+        pool.assert_not_called()
+
+    def test_options(self):
+        batch_stats = batch.BatchStatistics(
+            self.archs[:2],
+            self.mirror.mirror_url,
+            5,
+            False,
+            breakdowns=["extension"],
+            path_index=True,
+            segments=2,
+        )
+        batch_stats.update_stats()
+        for package_stats in batch_stats.arch_stats:
+            self.assertIn("extension", package_stats._load_breakdowns())
+            self.assertEqual(
+                package_stats.find_path("usr/share/doc/file 6.txt"), ["utils/pkg6"]
+            )
+
+    def test_refresh_keeps_cached_artifacts(self):
+        stats.PackageStatistics(
+            "amd64",
+            self.mirror.mirror_url,
+            5,
+            False,
+            breakdowns=["directory"],
+            path_index=True,
+        ).get_top_packages()
+        self.mirror.publish(b"usr/bin/new   utils/new\n" + self.contents["amd64"])
+        batch.BatchStatistics(
+            self.archs[:2], self.mirror.mirror_url, 5, True
+        ).update_stats()
+        package_stats = stats.PackageStatistics(
+            "amd64", self.mirror.mirror_url, 5, False
+        )
+        self.assertEqual(package_stats._load_breakdowns()["directory"]["usr/bin"], 1)
+        self.assertEqual(package_stats.find_path("usr/bin/new"), ["utils/new"])
+
+    @unittest.skipUnless(HAS_NUMPY, "NumPy is not installed")
+    def test_comparison_matrix(self):
+        from packstats import matrix
+
+        self.mirror.publish(make_contents(500) + b"usr/bin/only   admin/only\n", "i386")
+        batch_stats = batch.BatchStatistics(
+            self.archs, self.mirror.mirror_url, 5, False
+        )
+        arch_matrix = batch_stats.comparison_matrix()
+        counts = {
+            arch: parser.count_lines(io.BytesIO(contents))
+            for arch, contents in self.contents.items()
+        }
+        counts["i386"] = parser.count_lines(
+            io.BytesIO(make_contents(500) + b"usr/bin/only   admin/only\n")
+        )
+        totals = {}
+        for arch_counts in counts.values():
+            for package, files in arch_counts.items():
+                totals[package] = totals.get(package, 0) + files
+        self.assertEqual(
+            arch_matrix.top_by_total(5),
+            sorted(totals.items(), key=lambda item: item[1], reverse=True)[:5],
+        )
+        self.assertEqual(
+            arch_matrix.package("utils/pkg0"),
+            {arch: counts[arch]["utils/pkg0"] for arch in self.archs},
+        )
+        self.assertEqual(arch_matrix.only_on("i386"), [("admin/only", 1)])
+        self.assertEqual(arch_matrix.only_on("amd64"), [])
+        package, spread = arch_matrix.divergence(1, ["arm64", "i386"])[0]
+        self.assertEqual(
+            spread["arm64"] - spread["i386"],
+            max(
+                counts["arm64"][name] - counts["i386"].get(name, 0)
+                for name in counts["arm64"]
+            ),
+        )
+        with self.assertRaises(ValueError):
+            arch_matrix.only_on("mips")
+        empty = matrix.ArchMatrix.from_stores({})
+        self.assertEqual(empty.top_by_total(5), [])
+
+    def test_redirecting_mirror(self):
+        redirect, redirected = self.redirecting_mirror(
+            f"http://127.0.0.1:{self.mirror.server.server_port}", 301
+        )
+        batch_stats = batch.BatchStatistics(
+            self.archs[:2], redirect.mirror_url, 5, False
+        )
+        top_packages = batch_stats.get_top_packages()
+        for arch in self.archs[:2]:
+            counts = parser.count_lines(io.BytesIO(self.contents[arch]))
+            self.assertEqual(top_packages[arch]["utils/pkg0"], counts["utils/pkg0"])
+        self.assertEqual(
+            sorted(path for path in redirected if path.endswith(".gz")),
+            [
+                f"/debian/dists/stable/main/Contents-{arch}.gz"
+                for arch in self.archs[:2]
+            ],
+        )
+
+    def test_redirect_loop(self):
+        # Redirected to the same path over and over
+        redirect, redirected = self.redirecting_mirror("")
+        pool = connection.ConnectionPool()
+        with self.assertRaises(urllib.error.HTTPError):
+            with pool.request(redirect.mirror_url + "Release"):
+                pass
+        pool.close()
+        self.assertEqual(len(redirected), connection.MAX_REDIRECTS + 1)
+
+    def test_connection_pool_reuses_connections(self):
+        pool = connection.ConnectionPool()
+        for arch in self.archs:
+            with pool.request(
+                self.mirror.mirror_url + f"Contents-{arch}.gz"
+            ) as response:
+                response.read()
+        self.assertEqual(
+            pool._idle_queue(
+                ("http", f"127.0.0.1:{self.mirror.server.server_port}")
+            ).qsize(),
+            1,
+        )
+        pool.close()
+
+
+class TestPdiff(LocalMirrorTestCase):
+    def setUp(self):
+        super().setUp()
+        self.old = make_contents(2000)
+        old_lines = self.old.decode("utf-8").splitlines()
+        new_lines = old_lines[:100] + ["usr/bin/new   utils/new"] + old_lines[150:]
+        new_lines[500] = "usr/bin/changed   utils/pkg1,utils/new"
+        del new_lines[-3:]
+        new_lines.append("usr/bin/last   utils/last")
+        self.new = ("\n".join(new_lines) + "\n").encode("utf-8")
+        self.script = make_ed_script(old_lines, new_lines)
+
+    def test_apply_ed_script(self):
+        out_file = io.BytesIO()
+        sha256 = hashlib.sha256()
+        removed, added = pdiff.apply_ed_script(
+            io.BytesIO(self.old), pdiff.parse_ed_script(self.script), out_file, sha256
+        )
+        self.assertEqual(out_file.getvalue(), self.new)
+        self.assertEqual(sha256.hexdigest(), hashlib.sha256(self.new).hexdigest())
+        self.assertIn(b"usr/bin/new   utils/new", added)
+        self.assertEqual(len(removed), 54)
+
+    def publish_pdiff(self, history_sha256: str):
+        diff_dir = os.path.join(self.mirror.main_dir, "Contents-amd64.diff")
+        os.makedirs(diff_dir, exist_ok=True)
+        patch = gzip.compress(self.script)
+        with open(os.path.join(diff_dir, "T-1-F.gz"), "wb") as f:
+            f.write(patch)
+        with open(os.path.join(diff_dir, "Index"), "w") as f:
+            f.write(
+                f"SHA256-Current: {hashlib.sha256(self.new).hexdigest()} {len(self.new)}\n"
+                f"SHA256-History:\n {history_sha256} {len(self.old)} T-1-F\n"
+                f"SHA256-Patches:\n {hashlib.sha256(self.script).hexdigest()} {len(self.script)} T-1-F\n"
+                f"SHA256-Download:\n {hashlib.sha256(patch).hexdigest()} {len(patch)} T-1-F.gz\n"
+                "X-Patch-Precedence: merged\n"
+            )
+
+    def get_stats(self, revalidate=True):
+        return stats.PackageStatistics(
+            "amd64",
+            self.mirror.mirror_url,
+            10,
+            False,
+            revalidate=revalidate,
+            incremental=True,
+        )
+
+    def full_downloads(self):
+        return [path for path in self.mirror.requests if path.endswith("amd64.gz")]
+
+    def test_incremental_update(self):
+        self.mirror.publish(self.old)
+        self.get_stats().get_top_packages()
+        self.mirror.publish(self.new)
+        self.publish_pdiff(hashlib.sha256(self.old).hexdigest())
+
+        packstats = self.get_stats()
+        packstats.update_stats()
+        self.assertEqual(len(self.full_downloads()), 1)
+        with packstats._open_stats() as stats_store:
+            self.assertEqual(
+                dict(stats_store.items()), parser.count_lines(io.BytesIO(self.new))
+            )
+        with gzip.open(packstats.contents_file_path) as f:
+            self.assertEqual(f.read(), self.new)
+        # Already up to date
+        self.get_stats().update_stats()
+        self.assertEqual(len(self.full_downloads()), 1)
+
+    def test_broken_chain_falls_back_to_full_refresh(self):
+        self.mirror.publish(self.old)
+        self.get_stats().get_top_packages()
+        self.mirror.publish(self.new)
+        self.publish_pdiff("0" * 64)
+
+        packstats = self.get_stats()
+        packstats.update_stats()
+        self.assertEqual(len(self.full_downloads()), 2)
+        with packstats._open_stats() as stats_store:
+            self.assertEqual(
+                dict(stats_store.items()), parser.count_lines(io.BytesIO(self.new))
+            )
+
+    def test_mirror_without_pdiffs(self):
+        self.mirror.publish(self.old)
+        self.get_stats().get_top_packages()
+        # Cached queries don't look for pdiffs, and don't download anything while the
+        # Contents file is unchanged
+        requests = len(self.mirror.requests)
+        self.get_stats(revalidate=False).get_top_packages()
+        self.assertEqual(len(self.mirror.requests), requests)
+        self.get_stats().get_top_packages()
+        self.get_stats().get_top_packages()
+        self.assertEqual(len(self.full_downloads()), 1)
+        self.assertFalse([path for path in self.mirror.requests if ".diff/" in path])
+
+        # Changed without pdiffs: the missing Index means a full refresh
+        self.mirror.publish(self.new)
+        packstats = self.get_stats()
+        packstats.update_stats()
+        self.assertEqual(len(self.full_downloads()), 2)
+        with packstats._open_stats() as stats_store:
+            self.assertEqual(
+                dict(stats_store.items()), parser.count_lines(io.BytesIO(self.new))
+            )
+
+    def test_unreachable_pdiffs_keep_the_cache(self):
+        self.mirror.publish(self.old)
+        self.get_stats().get_top_packages()
+        self.mirror.publish(self.new)
+        packstats = self.get_stats()
+        with mock.patch.object(
+            packstats, "pdiff_url", return_value="http://127.0.0.1:1/Index"
+        ):
+            packstats.update_stats()
+        self.assertEqual(len(self.full_downloads()), 1)
+
+
+class TestCachedQueries(LocalMirrorTestCase):
+    def test_cached_query_without_network(self):
+        self.mirror.publish(make_contents())
+        top_packages = stats.PackageStatistics(
+            "amd64", self.mirror.mirror_url, 10, False
+        ).get_top_packages()
+        requests = len(self.mirror.requests)
+        self.mirror.close()
+        packstats = stats.PackageStatistics("amd64", self.mirror.mirror_url, 10, False)
+        self.assertEqual(packstats.get_top_packages(), top_packages)
+        self.assertEqual(packstats.get_package_count("utils/pkg0"), 55)
+        self.assertEqual(len(self.mirror.requests), requests)
+        self.assertFalse(packstats.validated)
+
+    def test_offline_without_cache(self):
+        with self.assertRaises(SystemExit):
+            stats.PackageStatistics(
+                "amd64", self.mirror.mirror_url, 10, False, offline=True
+            )
+
+
+class TestServer(LocalMirrorTestCase):
+    def setUp(self):
+        super().setUp()
+        self.mirror.publish(make_contents())
+        self.service = server.StatsService([self.mirror.mirror_url], ["amd64"])
+        self.service.refresh_all()
+        self.server = server.StatsHTTPServer(("127.0.0.1", 0), self.service)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def query(self, path: str):
+        with urllib.request.urlopen(
+            f"http://127.0.0.1:{self.server.server_port}{path}"
+        ) as response:
+            return json.load(response)
+
+    def test_queries(self):
+        counts = parser.count_lines(io.BytesIO(make_contents()))
+        top = sorted(counts.items(), key=lambda item: item[1], reverse=True)[:3]
+        self.assertEqual(
+            self.query("/top?arch=amd64&n=3")["packages"],
+            [{"package": package, "files": files} for package, files in top],
+        )
+        self.assertEqual(
+            self.query("/package?arch=amd64&name=utils/pkg0")["files"],
+            counts["utils/pkg0"],
+        )
+        archs = self.query("/archs")
+        self.assertEqual([entry["arch"] for entry in archs], ["amd64"])
+        self.assertEqual(archs[0]["packages"], len(counts))
+        with self.assertRaises(urllib.error.HTTPError) as error:
+            self.query("/top?arch=mips")
+        self.assertEqual(error.exception.code, 404)
+        for path in (
+            "/top",
+            "/top?n=3",
+            "/package?name=utils/pkg0",
+            "/package?arch=amd64",
+        ):
+            with self.assertRaises(urllib.error.HTTPError) as error:
+                self.query(path)
+            self.assertEqual(error.exception.code, 400)
+
+    def test_refresh_swaps_snapshot(self):
+        old_snapshot = self.service.snapshot("amd64")
+        self.mirror.publish(make_contents(3000))
+        self.service.refresh_all()
+        self.assertIsNot(self.service.snapshot("amd64"), old_snapshot)
+        self.assertEqual(
+            self.query("/package?arch=amd64&name=utils/pkg0")["files"],
+            parser.count_lines(io.BytesIO(make_contents(3000)))["utils/pkg0"],
+        )
+        # Unchanged statistics and an unreachable mirror keep the current snapshot
+        snapshot = self.service.snapshot("amd64")
+        self.service.refresh_all()
+        self.assertIs(self.service.snapshot("amd64"), snapshot)
+        self.mirror.close()
+        self.service.refresh_all()
+        self.assertIs(self.service.snapshot("amd64"), snapshot)
+
+    def test_unix_socket(self):
+        path = os.path.join(self.tmp_dir.name, "stats.sock")
+        # Left behind by a daemon that was killed
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(path)
+        stale.close()
+        unix_server = server.StatsUnixServer(path, self.service)
+        # A running daemon keeps its socket
+        with self.assertRaises(OSError):
+            server.StatsUnixServer(path, self.service)
+        self.assertTrue(os.path.exists(path))
+        unix_server.server_close()
+        self.assertFalse(os.path.exists(path))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super().tearDown()
+
+
+class TestPathIndex(LocalMirrorTestCase):
+    def setUp(self):
+        super().setUp()
+        self.contents = make_contents()
+        self.mirror.publish(self.contents)
+
+    def test_index_lookups(self):
+        index_path = os.path.join(self.tmp_dir.name, "paths.idx")
+        # Small runs so that the external sort merges several of them
+        with mock.patch.object(pathindex, "RUN_SIZE", 300):
+            pathindex.write_path_index(
+                index_path, reversed(self.contents.splitlines(keepends=True))
+            )
+        with pathindex.PathIndex(index_path) as index:
+            self.assertEqual(len(index), 2000)
+            self.assertEqual(
+                index.packages("/usr/share/doc/file 5.txt"),
+                ["utils/pkg5", "libs/lib5"],
+            )
+            self.assertEqual(index.packages("usr/share/doc/file 6.txt"), ["utils/pkg6"])
+            self.assertEqual(index.packages("usr/share/doc/file"), [])
+            self.assertEqual(
+                [path for path, _ in index.prefix("usr/share/doc/file 199")],
+                ["usr/share/doc/file 199.txt"]
+                + [f"usr/share/doc/file {i}.txt" for i in range(1990, 2000)],
+            )
+            self.assertEqual(len(list(index.prefix("usr/", limit=10))), 10)
+            self.assertEqual(
+                list(index.basename("file 42.txt")),
+                [("usr/share/doc/file 42.txt", ["utils/pkg5"])],
+            )
+            self.assertEqual(list(index.basename("missing")), [])
+
+    def test_index_built_on_refresh(self):
+        packstats = stats.PackageStatistics(
+            "amd64", self.mirror.mirror_url, 10, False, path_index=True
+        )
+        packstats.get_top_packages()
+        self.assertTrue(os.path.exists(packstats.path_index_file_path))
+        self.assertEqual(
+            stats.PackageStatistics(
+                "amd64", self.mirror.mirror_url, 10, False, offline=True
+            ).find_path("usr/share/doc/file 10.txt"),
+            ["utils/pkg10", "libs/lib10"],
+        )
+        # A refresh without the option keeps the index up to date
+        self.mirror.publish(b"usr/bin/new   utils/new\n" + make_contents())
+        stats.PackageStatistics(
+            "amd64", self.mirror.mirror_url, 10, True
+        ).update_stats()
+        self.assertEqual(
+            stats.PackageStatistics(
+                "amd64", self.mirror.mirror_url, 10, False, offline=True
+            ).find_path("usr/bin/new"),
+            ["utils/new"],
+        )
+
+
+class TestSketch(LocalMirrorTestCase):
+    def setUp(self):
+        super().setUp()
+        self.contents = make_contents(3000)
+        self.counts = parser.count_lines(io.BytesIO(self.contents))
+
+    def assert_bounds(self, space_saving: sketch.SpaceSaving, counts: dict):
+        for package, files, error in space_saving.top(len(space_saving)):
+            self.assertLessEqual(files - error, counts.get(package, 0))
+            self.assertGreaterEqual(files, counts.get(package, 0))
+            self.assertLessEqual(error, space_saving.error_bound())
+
+    def test_small_sketch_bounds(self):
+        # 48 packages in 20 counters, fed line by line
+        space_saving = sketch.SpaceSaving(20)
+        for line in self.contents.splitlines():
+            space_saving.update_counts(parser.count_lines([line]))
+        self.assertEqual(len(space_saving), 20)
+        self.assertEqual(space_saving.total, sum(self.counts.values()))
+        self.assert_bounds(space_saving, self.counts)
+        # Every package with more files than the error bound is monitored
+        for package, files in self.counts.items():
+            if files > space_saving.error_bound():
+                self.assertIn(package, space_saving.counts)
+
+    def test_merge(self):
+        lines = self.contents.splitlines(keepends=True)
+        halves = [b"".join(lines[:1000]), b"".join(lines[1000:])]
+        sketches = [
+            parser.sketch_stream(io.BytesIO(half), 20, chunk_size=4096)
+            for half in halves
+        ]
+        merged = sketches[0].merge(sketches[1])
+        self.assertEqual(merged.total, sum(self.counts.values()))
+        self.assert_bounds(merged, self.counts)
+        # Large enough sketches are exact
+        exact = parser.sketch_stream(io.BytesIO(halves[0]), 100).merge(
+            parser.sketch_stream(io.BytesIO(halves[1]), 100)
+        )
+        self.assertEqual(exact.counts, self.counts)
+
+    def test_approx_top_packages(self):
+        self.mirror.publish(self.contents)
+        packstats = stats.PackageStatistics("amd64", self.mirror.mirror_url, 5, False)
+        top_packages = packstats.get_approx_top_packages(64)
+        self.assertEqual(
+            [(package, files) for package, files, _ in top_packages],
+            sorted(self.counts.items(), key=lambda item: (-item[1], item[0]))[:5],
+        )
+        self.assertFalse(packstats.has_cached_stats())
+        with self.assertRaises(SystemExit):
+            packstats.get_approx_top_packages(4)
+
+
+class TestBreakdowns(LocalMirrorTestCase):
+    def test_aggregators(self):
+        contents = make_contents() + (
+            b"usr/bin/tool   admin/tool\netc/.profile   non-free/shells/profile\n"
+        )
+        aggregators = aggregate.make_aggregators(list(aggregate.AGGREGATORS))
+        self.assertEqual(
+            parser.count_stream(io.BytesIO(contents), aggregators=aggregators),
+            parser.count_lines(io.BytesIO(contents)),
+        )
+        results = {aggregator.name: aggregator.result() for aggregator in aggregators}
+        self.assertEqual(
+            results["section-files"],
+            {"utils": 2000, "libs": 400, "admin": 1, "non-free/shells": 1},
+        )
+        self.assertEqual(
+            results["section-packages"],
+            {"utils": 37, "libs": 11, "admin": 1, "non-free/shells": 1},
+        )
+        self.assertEqual(
+            results["directory"],
+            {"usr/share/doc": 2000, "usr/bin": 1, "etc": 1},
+        )
+        self.assertEqual(results["extension"], {"txt": 2000, "(none)": 2})
+
+        # Worker processes fill their own aggregators, merged in order
+        parallel = aggregate.make_aggregators(list(aggregate.AGGREGATORS))
+        parser.parse_stream_parallel(
+            io.BytesIO(contents), 2, chunk_size=4096, aggregators=parallel
+        )
+        self.assertEqual(
+            {aggregator.name: aggregator.result() for aggregator in parallel}, results
+        )
+        with self.assertRaises(ValueError):
+            aggregate.make_aggregators(["color"])
+
+        # An aggregator has to implement the whole interface
+        class UpdateOnly(aggregate.Aggregator):
+            def update(self, paths, fields):
+                pass
+
+        with self.assertRaises(TypeError):
+            UpdateOnly()
+
+    def test_cached_breakdowns(self):
+        self.mirror.publish(make_contents())
+        packstats = stats.PackageStatistics(
+            "amd64", self.mirror.mirror_url, 10, False, breakdowns=["section-files"]
+        )
+        packstats.get_top_packages()
+        contents_requests = [
+            path for path in self.mirror.requests if "Contents" in path
+        ]
+        self.assertEqual(len(contents_requests), 1)
+        offline = stats.PackageStatistics(
+            "amd64", self.mirror.mirror_url, 10, False, offline=True
+        )
+        self.assertEqual(
+            offline.get_breakdown("section-files"), {"utils": 2000, "libs": 400}
+        )
+        # A missing breakdown is computed in a new pass
+        self.assertEqual(
+            stats.PackageStatistics(
+                "amd64", self.mirror.mirror_url, 10, False
+            ).get_breakdown("extension"),
+            {"txt": 2000},
+        )
+        self.assertEqual(
+            set(offline._load_breakdowns()), {"section-files", "extension"}
+        )
+        with self.assertRaises(SystemExit):
+            offline.get_breakdown("directory")
+
+
+class TestConcurrentRefresh(LocalMirrorTestCase):
+    def test_atomic_write(self):
+        path = os.path.join(self.tmp_dir.name, "published")
+        with atomic.atomic_write(path, "w") as f:
+            f.write("old")
+        with self.assertRaises(RuntimeError):
+            with atomic.atomic_write(path, "w") as f:
+                f.write("partial")
+                raise RuntimeError()
+        with open(path) as f:
+            self.assertEqual(f.read(), "old")
+        self.assertEqual(os.listdir(self.tmp_dir.name).count("published"), 1)
+        self.assertEqual(len(os.listdir(self.tmp_dir.name)), 3)
+
+    def test_waiting_refresh_reuses_result(self):
+        self.mirror.publish(make_contents())
+        packstats = stats.PackageStatistics("amd64", self.mirror.mirror_url, 3, True)
+        # Another process holds the lock and publishes fresh stats meanwhile
+        lock = atomic.FileLock(packstats.lock_file_path)
+        lock.acquire()
+        waiting = threading.Thread(target=packstats.update_stats)
+        waiting.start()
+        while not waiting.is_alive():
+            time.sleep(0.01)
+        time.sleep(0.2)
+        store.write_stats_store(packstats.stats_file_path, {"utils/other": 7})
+        lock.release()
+        waiting.join()
+        self.assertEqual(
+            [path for path in self.mirror.requests if "Contents" in path], []
+        )
+        with packstats._open_stats() as stats_store:
+            self.assertEqual(dict(stats_store.items()), {"utils/other": 7})
+
+    def test_lock_is_exclusive(self):
+        path = os.path.join(self.tmp_dir.name, "exclusive.lock")
+        with atomic.FileLock(path) as first:
+            self.assertFalse(first.waited)
+            second = atomic.FileLock(path)
+            waiter = threading.Thread(target=second.acquire)
+            waiter.start()
+            waiter.join(0.2)
+            self.assertTrue(waiter.is_alive())
+        waiter.join()
+        self.assertTrue(second.waited)
+        second.release()
+
+
+class TestSegmentedDownload(LocalMirrorTestCase):
+    def setUp(self):
+        super().setUp()
+        RangeHandler.ranges = []
+        RangeHandler.broken_from = None
+        self.mirrors = [self.mirror] + [
+            LocalMirror(os.path.join(self.tmp_dir.name, name), handler_class)
+            for name, handler_class in (
+                ("ranges", RangeHandler),
+                ("other", RangeHandler),
+            )
+        ]
+        self.archive = gzip.compress(make_contents(20000), mtime=0)
+        for mirror in self.mirrors:
+            mirror.publish(make_contents(20000))
+        for mirror in self.mirrors[1:]:
+            mirror_dir = (
+                self.data_dir + f"127.0.0.1:{mirror.server.server_port}/stable/main"
+            )
+            os.makedirs(mirror_dir)
+            with open(mirror_dir + "/available_archs.txt", "w") as f:
+                f.write("amd64\n")
+        self.sha256 = hashlib.sha256(self.archive).hexdigest()
+        self.path = os.path.join(self.tmp_dir.name, "Contents.gz")
+
+    def tearDown(self):
+        for mirror in self.mirrors[1:]:
+            mirror.close()
+        super().tearDown()
+
+    def url(self, mirror: LocalMirror) -> str:
+        return mirror.mirror_url + "Contents-amd64.gz"
+
+    def download(self, mirrors, **kwargs) -> segmented.SegmentedDownload:
+        kwargs.setdefault("sha256", self.sha256)
+        return segmented.SegmentedDownload(
+            [self.url(mirror) for mirror in mirrors],
+            self.path,
+            connections=4,
+            segment_size=4096,
+            **kwargs,
+        )
+
+    def test_segments_over_several_mirrors(self):
+        # The first mirror doesn't support range requests and is left out
+        digest = self.download(self.mirrors).run()
+        self.assertEqual(digest, self.sha256)
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), self.archive)
+        self.assertFalse(os.path.exists(self.path + ".part"))
+        self.assertFalse(os.path.exists(self.path + ".part.json"))
+        ports = {port for port, start in RangeHandler.ranges}
+        self.assertEqual(
+            ports, {mirror.server.server_port for mirror in self.mirrors[1:]}
+        )
+        starts = sorted({start for port, start in RangeHandler.ranges if start})
+        self.assertEqual(starts, list(range(4096, len(self.archive), 4096)))
+
+    def test_without_range_support(self):
+        digest = self.download(self.mirrors[:1]).run()
+        self.assertEqual(digest, self.sha256)
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), self.archive)
+
+    def test_resume_after_failure(self):
+        RangeHandler.broken_from = 5 * 4096
+        with self.assertRaises(segmented.DownloadError):
+            self.download(self.mirrors[1:2]).run()
+        self.assertFalse(os.path.exists(self.path))
+        with open(self.path + ".part.json") as f:
+            self.assertEqual(json.load(f)["done"], [0, 1, 2, 3, 4])
+        RangeHandler.broken_from = None
+        RangeHandler.ranges = []
+        self.assertEqual(self.download(self.mirrors[1:2]).run(), self.sha256)
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), self.archive)
+        # Only the probe and the missing segments were requested again
+        starts = sorted(start for port, start in RangeHandler.ranges)
+        self.assertEqual(starts, [0] + list(range(5 * 4096, len(self.archive), 4096)))
+
+    def test_checksum_mismatch(self):
+        with self.assertRaises(segmented.DownloadError):
+            self.download(self.mirrors[1:], sha256="0" * 64).run()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(self.path + ".part"))
+
+    def test_segmented_refresh(self):
+        with mock.patch.dict(stats.config, {"DEFAULT_SEGMENT_SIZE": 4096}):
+            packstats = stats.PackageStatistics(
+                "amd64",
+                self.mirrors[1].mirror_url,
+                5,
+                True,
+                segments=4,
+                extra_mirrors=[self.mirrors[2].mirror_url],
+            )
+            top_packages = packstats.get_top_packages()
+        self.assertEqual(packstats._load_contents_meta()["sha256"], self.sha256)
+        streamed = stats.PackageStatistics("amd64", self.mirror.mirror_url, 5, True)
+        self.assertEqual(top_packages, streamed.get_top_packages())
+
+
+class TestHistory(LocalMirrorTestCase):
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.tmp_dir.name, "history.sqlite")
+
+    def test_only_changes_are_stored(self):
+        with history.HistoryStore(self.path) as store:
+            store.record("mirror", "amd64", {"a": 5, "b": 3, "c": 1}, taken_at=100)
+            store.record("mirror", "amd64", {"a": 5, "b": 4, "d": 2}, taken_at=200)
+            store.record("mirror", "amd64", {"a": 5, "b": 4, "d": 2}, taken_at=300)
+            store.record("mirror", "arm64", {"a": 1}, taken_at=300)
+            self.assertEqual(
+                store._db.execute("SELECT COUNT(*) FROM changes").fetchone()[0], 7
+            )
+            self.assertEqual(
+                store.snapshots("mirror", "amd64"),
+                [(100, 3, 9), (200, 3, 11), (300, 3, 11)],
+            )
+            self.assertEqual(store.package_history("mirror", "amd64", "a"), [(100, 5)])
+            self.assertEqual(
+                store.package_history("mirror", "amd64", "c"), [(100, 1), (200, 0)]
+            )
+            with self.assertRaises(ValueError):
+                store.record("mirror", "amd64", {}, taken_at=250)
+
+    def test_many_new_packages(self):
+        # More new names than fit in a single lookup
+        counts = {
+            f"utils/pkg{i}": i + 1 for i in range(2 * history.LOOKUP_BATCH_SIZE + 1)
+        }
+        with history.HistoryStore(self.path) as store:
+            store.record("mirror", "amd64", counts, taken_at=100)
+            store.record(
+                "mirror", "amd64", dict(counts, **{"utils/pkg5": 1}), taken_at=200
+            )
+            self.assertEqual(
+                store.package_history("mirror", "amd64", "utils/pkg5"),
+                [(100, 6), (200, 1)],
+            )
+            self.assertEqual(
+                store.package_history("mirror", "amd64", "utils/pkg1800"),
+                [(100, 1801)],
+            )
+
+    def test_growth_and_movers(self):
+        with history.HistoryStore(self.path) as store:
+            store.record("mirror", "amd64", {"a": 10, "b": 10, "c": 10}, taken_at=100)
+            store.record("mirror", "amd64", {"a": 12, "b": 10, "c": 10}, taken_at=200)
+            store.record("mirror", "amd64", {"a": 11, "b": 20, "d": 3}, taken_at=300)
+            self.assertEqual(
+                store.growth("mirror", "amd64", 250, 10),
+                [("b", 10, 20), ("d", 0, 3)],
+            )
+            self.assertEqual(
+                store.movers("mirror", "amd64", 0, 2),
+                [("b", 10, 20), ("c", 10, 0)],
+            )
+            self.assertEqual(
+                store.changes("mirror", "amd64", 100, until=200), [("a", 10, 12)]
+            )
+            self.assertEqual(store.growth("mirror", "amd64", 300, 10), [])
+            self.assertEqual(store.growth("other", "amd64", 0, 10), [])
+
+    def test_parse_time(self):
+        self.assertEqual(history.parse_time("2d", now=1000000), 1000000 - 2 * 86400)
+        self.assertEqual(
+            history.parse_time("2026-09-01"),
+            time.mktime((2026, 9, 1, 0, 0, 0, 0, 0, -1)),
+        )
+        with self.assertRaises(ValueError):
+            history.parse_time("last month")
+
+    def test_refresh_records_snapshot(self):
+        self.mirror.publish(make_contents())
+        packstats = stats.PackageStatistics(
+            "amd64", self.mirror.mirror_url, 5, True, history=True
+        )
+        packstats.get_top_packages()
+        with history.HistoryStore(packstats.history_file_path) as store:
+            snapshots = store.snapshots(packstats.history_series(), "amd64")
+            self.assertEqual(len(snapshots), 1)
+            with packstats._open_stats() as stats_store:
+                self.assertEqual(snapshots[0][1], len(stats_store))
+                self.assertEqual(
+                    store.package_history(
+                        packstats.history_series(), "amd64", "utils/pkg0"
+                    )[0][1],
+                    stats_store.get("utils/pkg0"),
+                )
+
+    def test_history_failure_is_logged(self):
+        self.mirror.publish(make_contents())
+        # Not a database
+        os.makedirs(self.data_dir + "history.sqlite")
+        packstats = stats.PackageStatistics(
+            "amd64", self.mirror.mirror_url, 5, True, history=True
+        )
+        with mock.patch("sys.stdout", new_callable=io.StringIO) as stdout:
+            with self.assertLogs("packstats", "ERROR") as logs:
+                packstats.update_stats()
+        self.assertEqual(stdout.getvalue(), "")
+        self.assertIn("Could not record the statistics in the history", logs.output[-1])
+        self.assertTrue(packstats.has_cached_stats())
+
+    def test_legacy_series(self):
+        # Recorded by a version keying the series by mirror host only
+        host = f"127.0.0.1:{self.mirror.server.server_port}"
+        with history.HistoryStore(self.data_dir + "history.sqlite") as store:
+            store.record(host, "amd64", {"utils/pkg0": 1}, taken_at=100)
+        self.mirror.publish(make_contents())
+        packstats = stats.PackageStatistics(
+            "amd64", self.mirror.mirror_url, 5, True, history=True
+        )
+        packstats.get_top_packages()
+        with history.HistoryStore(packstats.history_file_path) as store:
+            snapshots = store.snapshots(packstats.history_series(), "amd64")
+            self.assertEqual(snapshots[0][0], 100)
+            self.assertEqual(len(snapshots), 2)
+            self.assertEqual(store.snapshots(host, "amd64"), [])
+        self.assertEqual(history.legacy_series(self.mirror.mirror_url), host)
+        self.assertIsNone(
+            history.legacy_series(
+                release.branch_url(self.mirror.mirror_url, "testing", "contrib")
+            )
+        )
+
+
+class TestBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_generated_contents(self):
+        path = os.path.join(self.tmp_dir.name, "Contents.gz")
+        counts = benchmark.generate_contents(path, lines=5000, packages=300, seed=3)
+        self.assertEqual(parser.count_contents_file(path), counts)
+        with gzip.open(path, "rb") as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 5000 + 10)
+        self.assertTrue(any(b"," in line for line in lines))
+        self.assertTrue(any(line.startswith(b"EMPTY_PACKAGE") for line in lines))
+        # The largest packages have far more files than the median one
+        files = sorted(counts.values())
+        self.assertGreater(files[-1], 20 * files[len(files) // 2])
+
+    def test_run_and_compare(self):
+        results = benchmark.run_benchmark(
+            lines=2000,
+            packages=100,
+            repeat=1,
+            queries=2,
+            stages=["dispatch", "rank", "cached_query"],
+        )
+        self.assertEqual(
+            list(results["stages"]), ["baseline", "dispatch", "rank", "cached_query"]
+        )
+        # The padded lines of the decompressed file reached the workers
+        self.assertGreater(results["stages"]["dispatch"]["bytes"], 2000 * 60)
+        self.assertGreater(results["stages"]["rank"]["seconds"], 0)
+        self.assertGreater(results["stages"]["cached_query"]["seconds"], 0)
+        path = os.path.join(self.tmp_dir.name, "results.json")
+        benchmark.save_results(results, path)
+        self.assertEqual(
+            benchmark.compare_results(benchmark.load_results(path), results), []
+        )
+        slower = json.loads(json.dumps(results))
+        slower["stages"]["cached_query"]["seconds"] *= 2
+        self.assertEqual(
+            [
+                regression[:2]
+                for regression in benchmark.compare_results(results, slower)
+            ],
+            [("cached_query", "seconds")],
+        )
+        with self.assertRaises(ValueError):
+            benchmark.run_benchmark(lines=10, packages=2, stages=["unknown"])
+
+
+class TestMetrics(LocalMirrorTestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.metrics.reset()
+        metrics.metrics.enable()
+
+    def tearDown(self):
+        metrics.metrics.enabled = False
+        metrics.metrics.reset()
+        super().tearDown()
+
+    def stages(self):
+        return {stage.name: stage for stage in metrics.metrics.stages()}
+
+    def test_refresh_stages(self):
+        contents = make_contents()
+        self.mirror.publish(contents)
+        for stream in (True, False):
+            metrics.metrics.reset()
+            packstats = stats.PackageStatistics(
+                "amd64", self.mirror.mirror_url, 3, True, stream=stream
+            )
+            packstats.get_top_packages()
+            stages = self.stages()
+            self.assertEqual(
+                set(stages),
+                {"validate", "download", "decompress", "parse", "serialize", "rank"},
+            )
+            self.assertEqual(
+                stages["download"].bytes,
+                os.path.getsize(
+                    os.path.join(self.mirror.main_dir, "Contents-amd64.gz")
+                ),
+            )
+            self.assertEqual(stages["parse"].bytes, len(contents))
+            self.assertEqual(stages["parse"].lines, contents.count(b"\n"))
+            self.assertEqual(stages["parse"].labels["arch"], "amd64")
+            self.assertGreater(stages["parse"].peak_rss_bytes, 0)
+
+    def test_export(self):
+        metrics.metrics.add("parse", 2.0, bytes=10, lines=4, arch="amd64")
+        metrics.metrics.add("parse", 1.0, bytes=5, lines=2, arch="amd64")
+        metrics.metrics.add("rank", 0.5, arch='we"ird')
+        text = metrics.metrics.to_prometheus()
+        self.assertIn('packstats_stage_runs_total{stage="parse",arch="amd64"} 2', text)
+        self.assertIn('packstats_stage_lines_total{stage="parse",arch="amd64"} 6', text)
+        self.assertIn(
+            'packstats_stage_seconds_total{stage="rank",arch="we\\"ird"} 0.5', text
+        )
+        self.assertIn("# TYPE packstats_stage_bytes_total counter", text)
+        records = json.loads(metrics.metrics.to_json())["stages"]
+        self.assertEqual(len(records), 3)
+        self.assertEqual(records[0]["lines_per_second"], 2.0)
+        path = os.path.join(self.tmp_dir.name, "packstats.prom")
+        metrics.metrics.export("prometheus", path)
+        with open(path) as f:
+            self.assertEqual(f.read(), text)
+        with self.assertRaises(ValueError):
+            metrics.metrics.export("xml")
+
+    def test_disabled(self):
+        metrics.metrics.enabled = False
+        with metrics.metrics.stage("rank") as stage:
+            stage.bytes += 1
+        metrics.metrics.add("parse", 1.0)
+        self.assertEqual(metrics.metrics.stages(), [])
+        source = io.BytesIO(b"a\n")
+        self.assertIs(metrics.metrics.reader(source), source)
+
+    def test_server_endpoint(self):
+        self.mirror.publish(make_contents())
+        service = server.StatsService([self.mirror.mirror_url], ["amd64"])
+        service.refresh_all()
+        http_server = server.StatsHTTPServer(("127.0.0.1", 0), service)
+        threading.Thread(target=http_server.serve_forever, daemon=True).start()
+        try:
+            with urllib.request.urlopen(
+                f"http://127.0.0.1:{http_server.server_port}/metrics"
+            ) as response:
+                self.assertTrue(
+                    response.headers["Content-Type"].startswith("text/plain")
+                )
+                text = response.read().decode("utf-8")
+        finally:
+            http_server.shutdown()
+            http_server.server_close()
+        self.assertIn('packstats_stage_runs_total{stage="parse",arch="amd64"', text)
+
+    def test_logger_handler_is_shared(self):
+        path = config["DEFAULT_LOG_DIR_PATH"] + "packstats.log"
+        first = utils.Logger(path)
+        handlers = len(first.get_logger().handlers)
+        for _ in range(3):
+            utils.Logger(path)
+            stats.PackageStatistics(
+                "amd64", self.mirror.mirror_url, 3, False, validate=False
+            )
+        self.assertEqual(len(first.get_logger().handlers), handlers)
+
+
+class TestAsyncStats(LocalMirrorTestCase):
+    def run_async(self, make_coroutine):
+        async def run():
+            async with asyncstats.AsyncPackageStatistics(
+                self.mirror.mirror_url
+            ) as package_stats:
+                return await make_coroutine(package_stats)
+
+        return asyncio.run(run())
+
+    def test_queries(self):
+        contents = make_contents()
+        self.mirror.publish(contents)
+        counts = parser.count_lines(io.BytesIO(contents))
+
+        async def queries(package_stats):
+            return (
+                await package_stats.top("amd64", 3),
+                await package_stats.lookup("amd64", "libs/lib3"),
+                await package_stats.lookup("amd64", "utils/missing"),
+            )
+
+        top, files, missing = self.run_async(queries)
+        self.assertEqual(
+            list(top.items()),
+            sorted(counts.items(), key=lambda item: item[1], reverse=True)[:3],
+        )
+        self.assertEqual(files, counts["libs/lib3"])
+        self.assertIsNone(missing)
+        # Same files as the CLI
+        self.assertEqual(
+            stats.PackageStatistics(
+                "amd64", self.mirror.mirror_url, 3, False
+            ).get_top_packages(),
+            top,
+        )
+
+    def test_errors(self):
+        self.mirror.publish(make_contents())
+        with self.assertRaises(ValueError):
+            self.run_async(lambda package_stats: package_stats.top("amd64", 0))
+        with self.assertRaises(asyncstats.StatsError):
+            self.run_async(lambda package_stats: package_stats.top("mips"))
+        self.mirror.close()
+        with self.assertRaises(asyncstats.StatsError):
+            self.run_async(lambda package_stats: package_stats.top("amd64"))
+
+    def test_file_access_off_the_loop(self):
+        self.mirror.publish(make_contents())
+        threads = []
+
+        def on_thread(method):
+            def record(*args):
+                threads.append(threading.current_thread())
+                return method(*args)
+
+            return record
+
+        patches = [
+            mock.patch.object(cls, name, on_thread(getattr(cls, name)))
+            for cls, name in (
+                (stats.PackageStatistics, "_migrate_unkeyed_cache"),
+                (stats.PackageStatistics, "_load_contents_meta"),
+                (stats.PackageStatistics, "has_cached_stats"),
+                (stats.PackageStatistics, "_stats_signature"),
+                (utils.ArchUtils, "cached_archs"),
+            )
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        async def queries(package_stats):
+            await package_stats.top("amd64")
+            await package_stats.refresh("amd64")
+
+        self.run_async(queries)
+        self.assertTrue(threads)
+        # asyncio.run runs the event loop on the main thread
+        self.assertNotIn(threading.main_thread(), threads)
+
+    def test_concurrent_refreshes_share_one_download(self):
+        self.mirror.publish(make_contents())
+
+        async def refreshes(package_stats):
+            return await asyncio.gather(
+                *(package_stats.refresh("amd64", force=True) for _ in range(5)),
+                *(package_stats.top("amd64", 3) for _ in range(5)),
+            )
+
+        results = self.run_async(refreshes)
+        self.assertEqual(results[:5], [True] * 5)
+        self.assertEqual(
+            self.mirror.requests.count("/debian/dists/stable/main/Contents-amd64.gz"),
+            1,
+        )
+
+    def test_refresh_revalidates(self):
+        self.mirror.publish(make_contents())
+
+        async def refreshes(package_stats):
+            await package_stats.top("amd64")
+            unchanged = await package_stats.refresh("amd64")
+            self.mirror.publish(make_contents(3000))
+            changed = await package_stats.refresh("amd64")
+            return unchanged, changed, await package_stats.lookup("amd64", "utils/pkg0")
+
+        unchanged, changed, files = self.run_async(refreshes)
+        self.assertFalse(unchanged)
+        self.assertTrue(changed)
+        self.assertEqual(
+            files, parser.count_lines(io.BytesIO(make_contents(3000)))["utils/pkg0"]
+        )
+
+    def test_redirecting_mirror(self):
+        contents = make_contents()
+        self.mirror.publish(contents)
+        redirect, redirected = self.redirecting_mirror(
+            f"http://127.0.0.1:{self.mirror.server.server_port}", 307
+        )
+
+        async def top():
+            async with asyncstats.AsyncPackageStatistics(
+                redirect.mirror_url
+            ) as package_stats:
+                return await package_stats.top("amd64", 3)
+
+        counts = parser.count_lines(io.BytesIO(contents))
+        self.assertEqual(
+            list(asyncio.run(top()).items()),
+            sorted(counts.items(), key=lambda item: item[1], reverse=True)[:3],
+        )
+        self.assertIn("/debian/dists/stable/main/Contents-amd64.gz", redirected)
+
+    def test_chunked_response(self):
+        async def read():
+            reader = asyncio.StreamReader()
+            reader.feed_data(
+                b"5;ext=1\r\nhello\r\n7\r\n, world\r\n0\r\nX-Trailer: 1\r\n\r\n"
+            )
+            headers = http.client.parse_headers(
+                io.BytesIO(b"Transfer-Encoding: chunked\r\n\r\n")
+            )
+            response = asyncpool.AsyncResponse(
+                reader, "HTTP/1.1", 200, "OK", headers, "GET", 5
+            )
+            return await response.read(3), await response.read(), response.done
+
+        self.assertEqual(asyncio.run(read()), (b"hel", b"lo, world", True))
+
+
+class TestCombinedStatistics(LocalMirrorTestCase):
+    components = {"main": b"", "contrib": b"contrib/", "non-free": b"non-free/"}
+
+    def setUp(self):
+        super().setUp()
+        self.contents = {}
+        for component, prefix in self.components.items():
+            lines = {"main": 2000, "contrib": 500, "non-free": 300}[component]
+            contents = make_contents(lines).replace(b"utils/", prefix + b"utils/")
+            self.contents[component] = contents
+            self.mirror.publish(contents, component=component)
+            arch_dir = self.data_dir + (
+                f"127.0.0.1:{self.mirror.server.server_port}/stable/{component}/"
+            )
+            os.makedirs(arch_dir, exist_ok=True)
+            with open(arch_dir + "available_archs.txt", "w") as f:
+                f.write("amd64\n")
+
+    def combined_stats(self, components, top_n=5):
+        return combined.CombinedStatistics(
+            ["amd64"], self.mirror.mirror_url, top_n, False, components=components
+        )
+
+    def expected(self, components):
+        counts = {}
+        for component in components:
+            for package, files in parser.count_lines(
+                io.BytesIO(self.contents[component])
+            ).items():
+                counts[package] = counts.get(package, 0) + files
+        return counts
+
+    def contents_requests(self):
+        return [path for path in self.mirror.requests if path.endswith(".gz")]
+
+    def test_merges_partials(self):
+        combined_stats = self.combined_stats(["main", "contrib"], top_n=1000)
+        counts = self.expected(["main", "contrib"])
+        self.assertEqual(
+            combined_stats.get_top_packages(),
+            dict(sorted(counts.items(), key=lambda item: item[1], reverse=True)),
+        )
+        self.assertEqual(
+            combined_stats.get_package_count("contrib/utils/pkg0"),
+            counts["contrib/utils/pkg0"],
+        )
+        self.assertEqual(
+            combined_stats.get_package_count("libs/lib0"), counts["libs/lib0"]
+        )
+        # Both components are cached side by side
+        for package_stats in combined_stats.partials:
+            self.assertTrue(package_stats.has_cached_stats())
+        self.assertEqual(len(self.contents_requests()), 2)
+
+    def test_adding_a_component_only_processes_it(self):
+        self.combined_stats(["main", "contrib"]).get_top_packages()
+        combined_stats = self.combined_stats(["main", "contrib", "non-free"])
+        self.assertEqual(
+            combined_stats.get_package_count("libs/lib0"),
+            self.expected(self.components)["libs/lib0"],
+        )
+        self.assertEqual(
+            sorted(self.contents_requests()),
+            [
+                f"/debian/dists/stable/{component}/Contents-amd64.gz"
+                for component in ("contrib", "main", "non-free")
+            ],
+        )
+        # The merged view is reused until a partial changes
+        signature = os.stat(combined_stats.stats_file_path).st_mtime_ns
+        combined_stats.get_top_packages()
+        self.assertEqual(os.stat(combined_stats.stats_file_path).st_mtime_ns, signature)
+        self.assertTrue(combined_stats.is_view_fresh())
+        combined_stats.partials[2]._save_stats({"non-free/utils/pkg0": 1})
+        self.assertFalse(combined_stats.is_view_fresh())
+
+    def test_all_components(self):
+        combined_stats = self.combined_stats([combined.ALL_COMPONENTS])
+        self.assertEqual(combined_stats.components, ["contrib", "main", "non-free"])
+        counts = self.expected(self.components)
+        self.assertEqual(
+            combined_stats.get_package_count("non-free/utils/pkg1"),
+            counts["non-free/utils/pkg1"],
+        )
+
+    def test_migrates_unkeyed_cache(self):
+        package_stats = stats.PackageStatistics(
+            "amd64", self.mirror.mirror_url, 3, False
+        )
+        top = package_stats.get_top_packages()
+        old_dir = self.data_dir + f"127.0.0.1:{self.mirror.server.server_port}/amd64"
+        os.rename(package_stats.contents_dir_path, old_dir)
+        requests = len(self.contents_requests())
+        package_stats = stats.PackageStatistics(
+            "amd64", self.mirror.mirror_url, 3, False
+        )
+        self.assertFalse(os.path.exists(old_dir))
+        self.assertEqual(package_stats.get_top_packages(), top)
+        self.assertEqual(len(self.contents_requests()), requests)
+        # A cache of another component stays where it is
+        os.rename(package_stats.contents_dir_path, old_dir)
+        stats.PackageStatistics(
+            "amd64",
+            release.branch_url(self.mirror.mirror_url, "stable", "contrib"),
+            3,
+            False,
+        )
+        self.assertTrue(os.path.exists(old_dir))
+
+    def test_migrates_baseline_cache(self):
+        # The first versions only wrote data/<mirror>/<arch>/packages_stats.json
+        old_dir = self.data_dir + f"127.0.0.1:{self.mirror.server.server_port}/amd64"
+        os.makedirs(old_dir)
+        with open(old_dir + "/packages_stats.json", "w") as f:
+            json.dump({"utils/pkg0": 12, "libs/lib0": 3}, f)
+        self.mirror.requests.clear()
+        package_stats = stats.PackageStatistics(
+            "amd64", self.mirror.mirror_url, 3, False
+        )
+        self.assertFalse(os.path.exists(old_dir))
+        self.assertEqual(
+            package_stats.get_top_packages(), {"utils/pkg0": 12, "libs/lib0": 3}
+        )
+        self.assertTrue(os.path.exists(package_stats.stats_file_path))
+        self.assertEqual(self.mirror.requests, [])
+
+
+class TestArchDiscovery(LocalMirrorTestCase):
+    def setUp(self):
+        super().setUp()
+        self.mirror.publish(make_contents())
+        self.mirror.publish(make_contents(100), arch="arm64")
+        self.mirror.publish(make_contents(100), arch="arm64", component="contrib")
+        self.arch_utils = utils.ArchUtils(self.mirror.mirror_url)
+        os.remove(self.arch_utils.arch_file_path)
+
+    def release_requests(self):
+        return [path for path in self.mirror.requests if "Release" in path]
+
+    def test_release_discovery(self):
+        self.assertEqual(self.arch_utils.get_available_archs(), ["amd64", "arm64"])
+        self.assertEqual(self.release_requests(), ["/debian/dists/stable/Release"])
+        with open(self.arch_utils.arch_file_path) as f:
+            self.assertEqual(f.read(), "amd64\narm64\n")
+        # Other instances, the validation and the components of the suite share the
+        # fetched Release file, the warm cache doesn't even read the file
+        os.remove(self.arch_utils.arch_file_path)
+        stats.PackageStatistics("amd64", self.mirror.mirror_url, 3, True).validate()
+        contrib = utils.ArchUtils(
+            release.branch_url(self.mirror.mirror_url, "stable", "contrib")
+        )
+        self.assertEqual(contrib.get_available_archs(), ["arm64"])
+        self.assertEqual(len(self.release_requests()), 1)
+        self.assertEqual(
+            [path for path in self.mirror.requests if path.endswith("/")], []
+        )
+
+    def test_ttl_expiry(self):
+        self.arch_utils.get_available_archs()
+        self.mirror.publish(make_contents(100), arch="i386")
+        self.assertEqual(self.arch_utils.get_available_archs(), ["amd64", "arm64"])
+        with mock.patch.object(utils.ArchUtils, "ARCHS_TTL", 0):
+            self.assertEqual(
+                self.arch_utils.get_available_archs(), ["amd64", "arm64", "i386"]
+            )
+        self.assertEqual(len(self.release_requests()), 2)
+
+    def test_concurrent_callers_fetch_once(self):
+        with ThreadPoolExecutor(max_workers=8) as threads:
+            results = list(
+                threads.map(
+                    lambda _: utils.ArchUtils(
+                        self.mirror.mirror_url
+                    ).get_available_archs(),
+                    range(8),
+                )
+            )
+        self.assertEqual(results, [["amd64", "arm64"]] * 8)
+        self.assertEqual(len(self.release_requests()), 1)
+
+    def test_inrelease_fallback(self):
+        suite_dir = os.path.join(self.mirror.main_dir, "..")
+        with open(os.path.join(suite_dir, "Release")) as f:
+            text = f.read()
+        os.remove(os.path.join(suite_dir, "Release"))
+        with open(os.path.join(suite_dir, "InRelease"), "w") as f:
+            f.write(
+                "-----BEGIN PGP SIGNED MESSAGE-----\nHash: SHA512\n\n"
+                + text
+                + "-----BEGIN PGP SIGNATURE-----\nabc\n-----END PGP SIGNATURE-----\n"
+            )
+        self.assertEqual(self.arch_utils.get_available_archs(), ["amd64", "arm64"])
+
+    def test_async_discovery(self):
+        async def archs():
+            async with asyncstats.AsyncPackageStatistics(
+                self.mirror.mirror_url
+            ) as package_stats:
+                return await package_stats.archs(), await package_stats.archs()
+
+        self.assertEqual(asyncio.run(archs()), (["amd64", "arm64"],) * 2)
+        self.assertEqual(len(self.release_requests()), 1)
+        self.assertEqual(self.arch_utils.get_available_archs(), ["amd64", "arm64"])
+        self.assertEqual(len(self.release_requests()), 1)